@@ -6,3 +6,7 @@ admin.site.register(m.EnrolledUser)
 admin.site.register(m.Coursework)
 admin.site.register(m.Submission)
 admin.site.register(m.TestMatch)
+admin.site.register(m.TestCaseResult)
+admin.site.register(m.SubmissionVersion)
+admin.site.register(m.Blob)
+admin.site.register(m.Notification)
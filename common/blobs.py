@@ -0,0 +1,81 @@
+"""Content addressed storage for submission files. With
+SUBMISSION_STORAGE = 'blobs', each distinct file content is stored once
+in SUBMISSION_BLOB_ROOT, named by its sha256, and every submission
+version that has it gets a hard link to it in its usual directory, so
+everything that reads the files from there still works. Blob rows count
+how many manifest entries use each blob; `manage.py gc_blobs` removes the
+ones nothing uses any more. Only this module touches the blob directory."""
+
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+
+BLOBS = 'blobs'
+DIRECTORY = 'directory'
+
+CHUNK = 65536
+
+
+def enabled():
+    return settings.SUBMISSION_STORAGE == BLOBS
+
+
+def blob_path(sha256):
+    return os.path.join(settings.SUBMISSION_BLOB_ROOT, sha256[:2], sha256)
+
+
+def write(chunks, destination):
+    """Write the bytes in the iterable @chunks to the open file @destination.
+    @return their size and sha256 hex digest"""
+    sha = hashlib.sha256()
+    size = 0
+    for chunk in chunks:
+        sha.update(chunk)
+        size += len(chunk)
+        destination.write(chunk)
+    return size, sha.hexdigest()
+
+
+def write_temp(chunks):
+    """Write @chunks to a new file in the blob directory.
+    @return its path, size and sha256 hex digest"""
+    os.makedirs(settings.SUBMISSION_BLOB_ROOT, exist_ok=True)
+    fd, path = tempfile.mkstemp(prefix='.upload-', dir=settings.SUBMISSION_BLOB_ROOT)
+    try:
+        with os.fdopen(fd, 'wb') as destination:
+            size, sha256 = write(chunks, destination)
+    except BaseException:
+        os.remove(path)
+        raise
+    return path, size, sha256
+
+
+def place(temp_path, sha256):
+    """Move the file at @temp_path to be the blob for @sha256"""
+    path = blob_path(sha256)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # blobs are shared by every version that has them, so no one may change one
+    os.chmod(temp_path, 0o444)
+    os.replace(temp_path, path)
+
+
+def link(sha256, path, replace=False):
+    """Give the file at @path the content of the blob for @sha256"""
+    if replace and os.path.lexists(path):
+        os.remove(path)
+    os.link(blob_path(sha256), path)
+
+
+def remove(sha256):
+    path = blob_path(sha256)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def stored():
+    """@return the paths of every file in the blob directory"""
+    for dirpath, _, files in os.walk(settings.SUBMISSION_BLOB_ROOT):
+        for name in files:
+            yield os.path.join(dirpath, name)
@@ -0,0 +1,108 @@
+"""The client that every call to the GitLab API goes through. It keeps
+connections to GitLab open between calls, gives every call a timeout,
+limits how many calls are made to each host at once, and remembers which
+projects the Peer-Testing user has already been added to, so that isn't
+asked for again on every fetch."""
+
+import threading
+from contextlib import contextmanager
+from urllib.parse import urlparse
+
+from django.conf import settings
+from django.core.cache import cache
+
+import main.local as local
+
+import requests
+from requests.adapters import HTTPAdapter
+
+import logging
+logger = logging.getLogger("django")
+
+# How long to remember that the Peer-Testing user is a member of a project
+REPORTER_CACHE_SECONDS = 24 * 3600
+
+
+class GitlabClient:
+    def __init__(self, api_url, connections, timeout):
+        """A client of the GitLab at @api_url, making at most @connections
+        calls to a host at once, and waiting @timeout seconds for each"""
+        self.api_url = api_url
+        self.connections = connections
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=connections)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.hosts = {}
+        self.hosts_lock = threading.Lock()
+
+    def project_url(self, user, project, endpoint=''):
+        """@return the url of the API @endpoint of @user's @project"""
+        return self.api_url + '/api/v4/projects/' + str(user) + '%2F' + str(project) + endpoint
+
+    @contextmanager
+    def host_limit(self, url):
+        """Wait until fewer than the allowed calls are being made to the host of @url"""
+        host = urlparse(url).netloc
+        with self.hosts_lock:
+            limit = self.hosts.setdefault(host, threading.BoundedSemaphore(self.connections))
+        with limit:
+            yield
+
+    def request(self, method, url, **kwargs):
+        """Make a call to @url and read all of its response"""
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', settings.VERIFY_SSL)
+        with self.host_limit(url):
+            return self.session.request(method, url, **kwargs)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    @contextmanager
+    def download(self, url, **kwargs):
+        """Make a GET call to @url whose response is read as it arrives,
+        counting against the host's limit until it has been read"""
+        kwargs.setdefault('timeout', self.timeout)
+        kwargs.setdefault('verify', settings.VERIFY_SSL)
+        with self.host_limit(url):
+            response = self.session.get(url, stream=True, **kwargs)
+            try:
+                yield response
+            finally:
+                response.close()
+
+    def add_reporter(self, user, project, params):
+        """Make the Peer-Testing user a reporter on @user's @project, so it
+        can comment on it, unless it is known to be one already. @params
+        are those of the project owner's login"""
+        key = 'gitlab-reporter:%s/%s' % (user, project)
+        if cache.get(key):
+            return
+        logger.info("Add Peer-Testing as Raporter to %s/%s" % (user, project))
+        response = self.post(self.project_url(user, project, "/members"),
+                             data={'user_id': local.GITLAB_PT_USER_ID,
+                                   'access_level': local.GITLAB_PT_USER_ACCESS_LEVEL},
+                             params=params)
+        logger.info("Add Peer-Testing as Raporter to %s/%s: %s" % (user, project, response.content))
+        # 409 means it is a member already
+        if response.status_code in (201, 409):
+            cache.set(key, True, REPORTER_CACHE_SECONDS)
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def client():
+    """@return the GitlabClient shared by the whole process"""
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = GitlabClient(local.SOCIAL_AUTH_GITLAB_API_URL,
+                                   settings.GITLAB_MAX_CONNECTIONS, settings.GITLAB_TIMEOUT_SECONDS)
+        return _client
@@ -0,0 +1,45 @@
+import hashlib
+import os
+from datetime import datetime
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+import common.models as m
+
+
+class Command(BaseCommand):
+    help = "Write the file manifests of submission versions uploaded before manifests were kept"
+
+    def handle(self, *args, **options):
+        built = 0
+        for submission in m.load_manifests(m.Submission.objects.select_related(
+                'coursework__course', 'creator'), all_versions=True):
+            for version in range(submission.latest_version + 1):
+                if submission.manifest(version) is None and self.build(submission, version):
+                    built += 1
+        self.stdout.write("Wrote %d manifests" % built)
+
+    @transaction.atomic
+    def build(self, submission, version):
+        """Write the manifest of @version of @submission from its files.
+        @return False if it has no directory"""
+        path = submission.originals_path(version)
+        if not os.path.isdir(path):
+            return False
+        created = datetime.fromtimestamp(os.path.getctime(path), timezone.utc)
+        manifest = m.SubmissionVersion.objects.create(submission=submission, version=version, created=created)
+        files = []
+        for name in sorted(os.listdir(path)):
+            file_path = os.path.join(path, name)
+            if not os.path.isfile(file_path):
+                continue
+            sha = hashlib.sha256()
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    sha.update(chunk)
+            files.append(m.SubmissionFile(version=manifest, name=name,
+                                          size=os.path.getsize(file_path), sha256=sha.hexdigest()))
+        m.SubmissionFile.objects.bulk_create(files)
+        return True
@@ -0,0 +1,66 @@
+import os
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count
+
+import common.blobs as blobs
+import common.models as m
+
+# Files in the blob directory without a Blob row are only removed once
+# they are this old, so uploads still in progress are left alone
+ORPHAN_SECONDS = 3600
+
+
+class Command(BaseCommand):
+    help = "Recount the uses of each stored blob, and remove the blobs no submission uses any more"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only report what would be removed")
+
+    def handle(self, *args, **options):
+        dry_run = options['dry_run']
+        fixed = self.recount(dry_run)
+        removed, freed = 0, 0
+        for sha256 in m.Blob.objects.filter(refs__lte=0).values_list('sha256', flat=True):
+            size = self.remove(sha256, dry_run)
+            if size is not None:
+                removed += 1
+                freed += size
+        known = set(m.Blob.objects.values_list('sha256', flat=True))
+        orphans = 0
+        for path in blobs.stored():
+            if os.path.basename(path) not in known and time.time() - os.path.getmtime(path) > ORPHAN_SECONDS:
+                orphans += 1
+                if not dry_run:
+                    os.remove(path)
+        self.stdout.write("%s %d blobs (%d bytes) and %d orphaned files, fixed %d counts" %
+                          ("Would remove" if dry_run else "Removed", removed, freed, orphans, fixed))
+
+    def recount(self, dry_run):
+        """Set each blob's count to how many manifest entries use it, in
+        case deletions that didn't go through Submission.delete missed it.
+        @return how many counts were wrong"""
+        uses = dict(m.SubmissionFile.objects.filter(blob__isnull=False)
+                    .values_list('blob_id').annotate(Count('pk')))
+        fixed = 0
+        for sha256, refs in m.Blob.objects.values_list('sha256', 'refs'):
+            if refs != uses.get(sha256, 0):
+                fixed += 1
+                if not dry_run:
+                    m.Blob.objects.filter(sha256=sha256, refs=refs).update(refs=uses.get(sha256, 0))
+        return fixed
+
+    @transaction.atomic
+    def remove(self, sha256, dry_run):
+        """Remove the blob for @sha256 if it is still unused.
+        @return its size, or None if it is in use again"""
+        blob = m.Blob.objects.select_for_update().filter(sha256=sha256, refs__lte=0).first()
+        if blob is None or m.SubmissionFile.objects.filter(blob=blob).exists():
+            return None
+        if not dry_run:
+            blobs.remove(sha256)
+            blob.delete()
+        return blob.size
@@ -0,0 +1,26 @@
+import signal
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+import common.notify as n
+
+
+class Command(BaseCommand):
+    help = "Post the notifications waiting in the outbox as comments on the students' GitLab commits"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--threads', type=int, default=settings.NOTIFICATION_SENDER_THREADS,
+                            help="How many comments to post at once")
+        parser.add_argument('--poll', type=float, default=settings.NOTIFICATION_POLL_SECONDS,
+                            help="Seconds to wait between checks of an empty outbox")
+        parser.add_argument('--drain', action='store_true',
+                            help="Exit once no notifications are due instead of waiting for more")
+
+    def handle(self, *args, **options):
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            n.run_sender(options['threads'], options['poll'], drain=options['drain'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping notification sender")
@@ -2,31 +2,79 @@ import os
 import random
 import shutil
 import string
+import zlib
 from datetime import datetime
 
 from django.contrib.auth.models import User
 from django.db import models as m
 from django.db import transaction
+from django.db import IntegrityError
+from django.db.models import F, Prefetch, QuerySet
+from django.utils import timezone
 from django.conf import settings
+from django.dispatch import Signal
+
+import common.blobs as blobs
 
 import logging
 logger = logging.getLogger("django")
 
+# Sent with the submission whose latest_version has just been incremented.
+# Its new files are only in place once the transaction commits
+version_incremented = Signal(providing_args=['submission'])
+
 slug_characters = ['-', '_'] + list(string.ascii_letters) + list(string.digits)
 
 
-def new_random_slug(model, primary_key='id', length=8):
-    """For a given @model, find a new random slug of @length
-    which is unique against the primary key of the model. can
-    specify a @primary_key if it is different to 'id'"""
-    exists = True
-    new_slug = ""
-    while exists:
-        new_slug = ""
-        for count in range(length):
-            new_slug += random.choice(slug_characters)
-        exists = model.objects.filter(**{primary_key: new_slug}).count() > 0
-    return new_slug
+_random = random.SystemRandom()
+
+# Times a new object is given another slug if the one it got is taken
+SLUG_ATTEMPTS = 5
+
+
+def random_slug(length=8):
+    """A random slug of @length, from a cryptographically strong source"""
+    return ''.join(_random.choice(slug_characters) for _ in range(length))
+
+
+def random_slugs(count, length=8):
+    """@count different random slugs of @length"""
+    slugs = set()
+    while len(slugs) < count:
+        slugs.add(random_slug(length))
+    return list(slugs)
+
+
+def save_with_new_slug(instance, primary_key='id', length=8):
+    """Save the new model @instance with a random slug of @length as its
+    @primary_key. The slug isn't looked up first, which costs a query on
+    every save: with 64^8 possible slugs a clash is very unlikely, and if
+    one happens the primary key constraint rejects the insert and another
+    slug is tried. @return the @instance"""
+    for attempt in range(SLUG_ATTEMPTS):
+        setattr(instance, primary_key, random_slug(length))
+        try:
+            with transaction.atomic():
+                instance.save(force_insert=True)
+            return instance
+        except IntegrityError:
+            if attempt == SLUG_ATTEMPTS - 1:
+                raise
+
+
+def bulk_create_with_new_slugs(model, instances, primary_key='id', length=8):
+    """bulk_create the new @instances of @model, each with a random slug
+    as its @primary_key, trying a fresh set of slugs if any clash as
+    save_with_new_slug does. @return the created instances"""
+    for attempt in range(SLUG_ATTEMPTS):
+        for instance, slug in zip(instances, random_slugs(len(instances), length)):
+            setattr(instance, primary_key, slug)
+        try:
+            with transaction.atomic():
+                return model.objects.bulk_create(instances)
+        except IntegrityError:
+            if attempt == SLUG_ATTEMPTS - 1:
+                raise
 
 
 # noinspection PyClassHasNoInit
@@ -74,6 +122,15 @@ class Coursework(m.Model):
     execute_script = m.CharField(max_length=64)
     sol_path_re = m.CharField(max_length=256)
     test_path_re  = m.CharField(max_length=256)
+    # Execution profile of the tests, where None means no limit.
+    # Times are in seconds, memory in MB and output in bytes
+    wall_time_limit = m.IntegerField(default=30)
+    cpu_time_limit = m.IntegerField(null=True, blank=True)
+    memory_limit = m.IntegerField(null=True, blank=True)
+    process_limit = m.IntegerField(null=True, blank=True)
+    output_limit = m.IntegerField(null=True, blank=True)
+    # Re-run test matches that used an old version when a new one is uploaded
+    rerun_on_new_version = m.BooleanField(default=False)
 
     def is_visible(self):
         """Show if the coursework state allows it to be visible"""
@@ -83,6 +140,21 @@ class Coursework(m.Model):
         return self.name
 
 
+class ExecutionLimit:
+    WALL_TIME = 'w'
+    CPU_TIME = 'c'
+    MEMORY = 'm'
+    PROCESSES = 'p'
+    OUTPUT = 'o'
+    POSSIBLE_LIMITS = (
+        (WALL_TIME, 'wall clock time limit'),
+        (CPU_TIME, 'CPU time limit'),
+        (MEMORY, 'memory limit'),
+        (PROCESSES, 'process limit'),
+        (OUTPUT, 'output size limit'),
+    )
+
+
 class SubmissionType:
     SOLUTION = 's'
     TEST_CASE = 'c'
@@ -110,8 +182,11 @@ class Submission(m.Model):
     latest_version = m.IntegerField(default=0)
 
     def get_time_for_version(self, version=None):
-        '''Get the time the folder containing a
-        submission @version was created'''
+        '''Get the time the submission @version was uploaded,
+        or the folder containing it was created if it has no manifest'''
+        manifest = self.manifest(version)
+        if manifest is not None:
+            return manifest.created
         path_to_check = self.originals_path(version)
         if os.path.exists(path_to_check):
             timestamp = os.path.getctime(path_to_check)
@@ -160,11 +235,24 @@ class Submission(m.Model):
             version = self.latest_version
         return os.path.join(self.path(), str(version))
 
+    def manifest(self, version=None):
+        """The SubmissionVersion listing the files of @version, or None
+        if it was uploaded before manifests were kept. Uses the
+        manifests fetched by load_manifests if there are any"""
+        if version is None:
+            version = self.latest_version
+        loaded = getattr(self, '_manifests', None)
+        if loaded is not None and version in loaded:
+            return loaded[version]
+        return SubmissionVersion.objects.filter(submission=self, version=version) \
+            .prefetch_related(manifest_files()).first()
+
     def get_files(self, version=None):
         """Get the names of original files for
         this submission, without full path"""
-        if version is None:
-            version = self.latest_version
+        manifest = self.manifest(version)
+        if manifest is not None:
+            return [file.name for file in manifest.files.all()]
         path=self.originals_path(version)
         if os.path.exists(path):
             return [file for file in os.listdir(path)]
@@ -176,40 +264,180 @@ class Submission(m.Model):
         added, this method should be called"""
         self.latest_version += 1
         self.save()
+        self._manifests = None
+        SubmissionVersion.objects.create(submission=self, version=self.latest_version)
+        version_incremented.send(sender=Submission, submission=self)
+
+    @transaction.atomic
+    def store_file(self, name, chunks, replace=False):
+        """Write the bytes in the iterable @chunks to the file @name of
+        the current version, and record its size and hash in the
+        version's manifest. Only @replace a file that is already there
+        if asked to. With SUBMISSION_STORAGE = 'blobs' the file is a
+        link to the shared copy of its content"""
+        path = os.path.join(self.originals_path(), name)
+        os.makedirs(self.originals_path(), exist_ok=True)
+        if not replace and os.path.lexists(path):
+            raise FileExistsError("%s is already in %s" % (name, self))
+        blob = None
+        if blobs.enabled():
+            blob = Blob.store(chunks)
+            blobs.link(blob.sha256, path, replace)
+            size, sha256 = blob.size, blob.sha256
+        else:
+            with open(path, "wb") as destination:
+                size, sha256 = blobs.write(chunks, destination)
+        self._manifests = None
+        manifest, _ = SubmissionVersion.objects.get_or_create(submission=self, version=self.latest_version)
+        replaced = SubmissionFile.objects.filter(version=manifest, name=name, blob__isnull=False)
+        Blob.release(replaced.values_list('blob_id', flat=True))
+        SubmissionFile.objects.update_or_create(version=manifest, name=name, defaults={
+            'size': size,
+            'sha256': sha256,
+            'blob': blob
+        })
 
     def save_content_file(self, content, name):
         """Given the @content string for a new file
         with @name, store it in the current submission"""
-        path = os.path.join(self.originals_path(), name)
-        os.makedirs(self.originals_path(), exist_ok=True)
-        with open(path, "x") as file:
-            file.write(content)
+        self.store_file(name, [content.encode('utf-8')])
 
     def save_uploaded_file(self, file):
         """Given a @file a user has uploaded, store
         it in the current submission with @name"""
-        path = os.path.join(self.originals_path(), file.name)
-        os.makedirs(self.originals_path(), exist_ok=True)
-        with open(path, "xb") as destination:
-            for chunk in file.chunks():
-                destination.write(chunk)
+        self.store_file(file.name, file.chunks())
 
     def copy_file(self, file):
         """Given a @file path (originating from GitLab), store
         it in the current submission with @name"""
-        path = os.path.join(self.originals_path(), os.path.basename(file))
         logger.info("models.copy_file from " + file)
-        logger.info("models.copy_file from " + path)
-        os.makedirs(self.originals_path(), exist_ok=True)
-        shutil.copy(file,path)
+        with open(file, 'rb') as source:
+            self.store_file(os.path.basename(file), iter(lambda: source.read(65536), b''), replace=True)
 
     def delete(self, *args, **kargs):
         """Delete all of the files associated with this
         submission, by rm-ing the directory"""
+        Blob.release(SubmissionFile.objects.filter(version__submission=self, blob__isnull=False)
+                     .values_list('blob_id', flat=True))
         shutil.rmtree(self.path())
         super(Submission, self).delete(*args, **kargs)
 
 
+# noinspection PyClassHasNoInit
+class Blob(m.Model):
+    """A file content stored once for every submission version that
+    has it, when SUBMISSION_STORAGE is 'blobs', see common.blobs"""
+    sha256 = m.CharField(max_length=64, primary_key=True)
+    size = m.BigIntegerField()
+    # How many SubmissionFiles use it, `manage.py gc_blobs` removes it at 0
+    refs = m.IntegerField(default=0)
+
+    def __str__(self):
+        return "%s (%d refs)" % (self.sha256, self.refs)
+
+    @staticmethod
+    def store(chunks):
+        """Store the bytes in the iterable @chunks, unless a blob with the
+        same content is already there, and count one more use of it.
+        @return the Blob"""
+        temp_path, size, sha256 = blobs.write_temp(chunks)
+        try:
+            with transaction.atomic():
+                if Blob.objects.filter(sha256=sha256).update(refs=F('refs') + 1):
+                    return Blob.objects.get(sha256=sha256)
+                blobs.place(temp_path, sha256)
+                try:
+                    with transaction.atomic():
+                        return Blob.objects.create(sha256=sha256, size=size, refs=1)
+                except IntegrityError:
+                    Blob.objects.filter(sha256=sha256).update(refs=F('refs') + 1)
+                    return Blob.objects.get(sha256=sha256)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    @staticmethod
+    def release(sha256s):
+        """Count one less use of the blob of each of @sha256s"""
+        counts = {}
+        for sha256 in sha256s:
+            counts[sha256] = counts.get(sha256, 0) + 1
+        for sha256, count in counts.items():
+            Blob.objects.filter(sha256=sha256).update(refs=F('refs') - count)
+
+
+# noinspection PyClassHasNoInit
+class SubmissionVersion(m.Model):
+    """The manifest of one version of a submission, written as its files are
+    stored, so listing them doesn't have to look at the disk"""
+    submission = m.ForeignKey(Submission, m.CASCADE, related_name="versions")
+    version = m.IntegerField()
+    created = m.DateTimeField(default=timezone.now)
+    # The GitLab commit the files were fetched from, blank if they were uploaded
+    commit_sha = m.CharField(max_length=40, blank=True, default='')
+
+    class Meta:
+        unique_together = (('submission', 'version'),)
+
+    def __str__(self):
+        return "%s v%d" % (self.submission_id, self.version)
+
+
+# noinspection PyClassHasNoInit
+class SubmissionFile(m.Model):
+    """One file in a version of a submission"""
+    version = m.ForeignKey(SubmissionVersion, m.CASCADE, related_name="files")
+    name = m.CharField(max_length=255)
+    size = m.BigIntegerField()
+    sha256 = m.CharField(max_length=64)
+    # The shared copy of its content, if it was stored as a blob
+    blob = m.ForeignKey(Blob, m.PROTECT, null=True)
+
+    class Meta:
+        unique_together = (('version', 'name'),)
+
+    def __str__(self):
+        return "%s - %s" % (self.version, self.name)
+
+
+def manifest_files():
+    return Prefetch('files', queryset=SubmissionFile.objects.order_by('name'))
+
+
+def load_manifests(submissions, all_versions=False):
+    """Fetch the manifests of the latest versions of @submissions, a
+    queryset or list, or of all their versions, in two queries, so their
+    get_files and get_time_for_version don't need the database or the disk.
+    @return the submissions as a list"""
+    ids = submissions.values('id') if isinstance(submissions, QuerySet) else [s.id for s in submissions]
+    submissions = list(submissions)
+    manifests = SubmissionVersion.objects.filter(submission__in=ids).prefetch_related(manifest_files())
+    if not all_versions:
+        manifests = manifests.filter(version=F('submission__latest_version'))
+    found = {}
+    for manifest in manifests:
+        found.setdefault(manifest.submission_id, {})[manifest.version] = manifest
+    for submission in submissions:
+        submission._manifests = found.get(submission.id, {})
+        versions = range(submission.latest_version + 1) if all_versions else [submission.latest_version]
+        for version in versions:
+            submission._manifests.setdefault(version, None)
+    return submissions
+
+
+class TestStatus:
+    PASS = 'p'
+    FAIL = 'f'
+    ERROR = 'e'
+    SKIP = 's'
+    POSSIBLE_STATUSES = (
+        (PASS, 'Passed'),
+        (FAIL, 'Failed'),
+        (ERROR, 'Error'),
+        (SKIP, 'Skipped'),
+    )
+
+
 class TestType:
     SELF = 's'
     PEER = 'p'
@@ -228,8 +456,18 @@ class TestMatch(m.Model):
     test_version = m.IntegerField()
     solution = m.ForeignKey(Submission, m.CASCADE, related_name="tm_sol_sub")
     solution_version = m.IntegerField()
+    # Where the output of test matches run before it was kept in log
     result = m.ForeignKey(Submission, m.CASCADE, null=True, related_name="tm_res_sub")
     error_level = m.IntegerField(null=True)
+    # How many tests were run and passed, None if the output couldn't be read
+    tests_run = m.IntegerField(null=True)
+    tests_passed = m.IntegerField(null=True)
+    # The zlib compressed output of running the tests, unless RUNNER_KEEP_LOGS is off
+    log = m.BinaryField(null=True)
+    # Whether store_results has recorded the output, counts and test cases
+    results_stored = m.BooleanField(default=False)
+    # The limit of the coursework's execution profile that stopped the test, if any
+    limit_exceeded = m.CharField(max_length=1, choices=ExecutionLimit.POSSIBLE_LIMITS, null=True)
     coursework = m.ForeignKey(Coursework, m.CASCADE, related_name="tm_cw")
     type = m.CharField(max_length=1, choices=SubmissionType.POSSIBLE_TYPES)
     timestamp = m.DateTimeField(auto_now_add=True)
@@ -249,26 +487,98 @@ class TestMatch(m.Model):
         return TestMatch.objects.get(result=results_submission)
 
     @transaction.atomic
-    def set_error_level(self, error_level):
-        """update @test_match with @error_level of running the tests
+    def set_error_level(self, error_level, limit_exceeded=None):
+        """update @test_match with @error_level of running the tests, and
+        the ExecutionLimit that stopped them, if @limit_exceeded.
         only offer this helper method to TMs that haven't set a error level"""
         if self.error_level is not None:
             raise Exception("Can't change the error level of an already run test match")
         self.error_level = error_level
+        self.limit_exceeded = limit_exceeded
         self.save()
 
+    def has_results(self):
+        """return bool as to whether the results of running this test
+        match have been stored, or kept as a result submission"""
+        return self.results_stored or self.result_id is not None
+
     @transaction.atomic
-    def store_results(self, results):
-        """update @test_match with @results string of running the tests
-        only offer this helper method to TMs that haven't recorded results"""
-        if self.result is not None:
+    def store_results(self, output, cases=(), tests_run=None, tests_passed=None):
+        """update @test_match with the @output string of running the tests,
+        its @cases as (name, TestStatus, duration, message) tuples and
+        how many tests were run and passed. only offer this helper
+        method to TMs that haven't recorded results"""
+        claimed = TestMatch.objects.filter(id=self.id, results_stored=False, result__isnull=True) \
+            .update(results_stored=True)
+        if self.has_results() or not claimed:
             raise Exception("Can't change the results for an already run test match")
-        result_sub = Submission(id=new_random_slug(Submission),
-                                coursework=self.coursework,
-                                creator=self.test.creator,
-                                type=SubmissionType.TEST_RESULT,
-                                display_name="Test Results")
-        result_sub.save()
-        result_sub.save_content_file(results, "results.txt")
-        self.result = result_sub
+        self.results_stored = True
+        if settings.RUNNER_KEEP_LOGS:
+            self.log = zlib.compress(output.encode('utf-8'))
+        self.tests_run = tests_run
+        self.tests_passed = tests_passed
         self.save()
+        TestCaseResult.objects.bulk_create([
+            TestCaseResult(test_match=self, name=name[:255], status=status, duration=duration, message=message)
+            for name, status, duration, message in cases])
+
+    def log_text(self):
+        """The output of running the tests, None if it wasn't kept"""
+        if self.log is None:
+            return None
+        return zlib.decompress(bytes(self.log)).decode('utf-8', errors='replace')
+
+    def passed_summary(self):
+        """e.g. "3/4 passed", or "" if the results couldn't be counted"""
+        if self.tests_run is None:
+            return ""
+        return "%d/%d passed" % (self.tests_passed, self.tests_run)
+
+
+# noinspection PyClassHasNoInit
+class TestCaseResult(m.Model):
+    """The outcome of one test case in a run of a test match"""
+    test_match = m.ForeignKey(TestMatch, m.CASCADE, related_name="cases")
+    name = m.CharField(max_length=255)
+    status = m.CharField(max_length=1, choices=TestStatus.POSSIBLE_STATUSES)
+    # Seconds, if the test framework reported it
+    duration = m.FloatField(null=True)
+    message = m.TextField(blank=True)
+
+    def __str__(self):
+        return "%s - %s" % (self.test_match_id, self.name)
+
+
+class NotificationState:
+    PENDING = 'p'
+    SENT = 's'
+    FAILED = 'f'
+    POSSIBLE_STATES = (
+        (PENDING, 'Waiting to be posted to GitLab'),
+        (SENT, 'Posted to GitLab'),
+        (FAILED, 'Could not be posted to GitLab'),
+    )
+
+
+# noinspection PyClassHasNoInit
+class Notification(m.Model):
+    """A comment waiting in the outbox to be posted on a student's
+    latest GitLab commit, see common/notify.py"""
+    username = m.CharField(max_length=150)
+    # The name of the student's GitLab project, which is the coursework's name
+    project = m.CharField(max_length=255)
+    message = m.TextField()
+    state = m.CharField(max_length=1, choices=NotificationState.POSSIBLE_STATES,
+                        default=NotificationState.PENDING)
+    created = m.DateTimeField(default=timezone.now)
+    # A sender may post it from then on, later after each failed attempt
+    next_attempt = m.DateTimeField(default=timezone.now)
+    attempts = m.IntegerField(default=0)
+    error = m.TextField(blank=True)
+    sent = m.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        index_together = (('state', 'next_attempt'),)
+
+    def __str__(self):
+        return "%s/%s: %s" % (self.username, self.project, self.message)
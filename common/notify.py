@@ -1,42 +1,147 @@
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import timedelta
+
 from django.contrib.auth.decorators import login_required
 from django.conf import settings
 from django.contrib.auth.models import User, Group
+from django.db.models import F
+from django.utils import timezone
+
+import common.gitlab as gitlab
+import common.models as m
 
 import requests
 
 import logging
 logger = logging.getLogger("django")
 
-from main import local
-gitlab_project_api = local.SOCIAL_AUTH_GITLAB_API_URL + '/api/v4/projects/'
+# What happened to the notifications of one comment
+SENT = 'sent'
+RETRYING = 'retrying'
+FAILED = 'failed'
+
+# How long a sender has to post the notifications it has claimed before
+# another sender may claim them again
+CLAIM_SECONDS = 300
+
 
 def add_notification(user,cw,message):
-    """Adds a GitLab comment @message to @user's latest commit of @cw"""
-    logger.info("Add peer-testing notification for " + user)
-    gitlab_cw = user + "%2F" + str(cw)
-    gitlab_commits_comments = "/repository/commits/master/comments"
-    gitlab_data = { 'note' : '@' + user + ' ' + message}
-    gitlab_req = gitlab_project_api + gitlab_cw + gitlab_commits_comments
-    logger.info("Add peer-testing notification, API request: " + gitlab_req)
-    response = requests.post( gitlab_req,
-                              data=gitlab_data,
-                              params={'access_token': settings.PEER_TESTING_API_ACCESS_TOKEN},
-                             verify=False )
-    gitlab_info = str(response.__dict__)
-    content=response.content
-    logger.info("Add peer-testing notification, gitlab response: " + str(content))
+    """Adds a GitLab comment @message to @user's latest commit of @cw to the outbox"""
+    add_notifications([user], cw, message)
+
+
+def add_notifications(users, cw, message):
+    """Put a GitLab comment @message to the latest commit of @cw of each
+    of the usernames @users in the outbox, for send_notifications to post.
+    One that is already waiting to be sent isn't added again"""
+    project = str(cw)
+    waiting = set(m.Notification.objects.filter(
+        username__in=users, project=project, message=message, state=m.NotificationState.PENDING
+    ).values_list('username', flat=True))
+    new = [m.Notification(username=user, project=project, message=message)
+           for user in dict.fromkeys(users) if user not in waiting]
+    if new:
+        m.Notification.objects.bulk_create(new)
+        logger.info("Queued peer-testing notification for %s: %s" % (", ".join(n.username for n in new), message))
+
+
+def post_comment(client, user, project, messages):
+    """Post a GitLab comment with @messages to @user's latest commit
+    of @project, using the GitlabClient @client.
+    @return the status GitLab answered with, None if it didn't, and why it failed"""
+    gitlab_req = client.project_url(user, project, "/repository/commits/master/comments")
+    gitlab_data = {'note': '@' + user + ' ' + '\n\n'.join(messages)}
+    try:
+        response = client.post(gitlab_req,
+                               data=gitlab_data,
+                               params={'access_token': settings.PEER_TESTING_API_ACCESS_TOKEN})
+    except requests.RequestException as e:
+        return None, str(e)
+    return response.status_code, "GitLab answered %d: %s" % (response.status_code, response.text[:500])
+
+
+def record_attempt(notifications, status, reason):
+    """Record that posting the comment of @notifications got the
+    @status, with @reason. Errors on GitLab's side or on the way there
+    are retried, backing off, until NOTIFICATION_MAX_ATTEMPTS.
+    @return SENT, RETRYING or FAILED"""
+    now = timezone.now()
+    same = m.Notification.objects.filter(id__in=[n.id for n in notifications])
+    if status is not None and status < 300:
+        same.update(state=m.NotificationState.SENT, sent=now, attempts=F('attempts') + 1, error='')
+        return SENT
+    attempts = max(n.attempts for n in notifications) + 1
+    retry = status is None or status == 429 or status >= 500
+    if not retry or attempts >= settings.NOTIFICATION_MAX_ATTEMPTS:
+        same.update(state=m.NotificationState.FAILED, attempts=F('attempts') + 1, error=reason)
+        logger.warning("Gave up on notification for %s: %s" % (notifications[0].username, reason))
+        return FAILED
+    delay = settings.NOTIFICATION_RETRY_SECONDS * 2 ** (attempts - 1)
+    same.update(attempts=F('attempts') + 1, error=reason, next_attempt=now + timedelta(seconds=delay))
+    return RETRYING
+
+
+def claim_due(limit):
+    """Claim up to @limit of the notifications that are due, so no
+    other sender posts them, grouped by who they are for.
+    @return a dict of username and project to their notifications"""
+    now = timezone.now()
+    due = m.Notification.objects.filter(state=m.NotificationState.PENDING, next_attempt__lte=now) \
+        .order_by('next_attempt', 'id')[:limit]
+    grouped = OrderedDict()
+    for notification in due:
+        grouped.setdefault((notification.username, notification.project), []).append(notification)
+    claimed = OrderedDict()
+    for key, notifications in grouped.items():
+        ids = [n.id for n in notifications]
+        # only if all of them are still due, any that another sender got to first are left to it
+        taken = m.Notification.objects.filter(id__in=ids, state=m.NotificationState.PENDING, next_attempt__lte=now) \
+            .update(next_attempt=now + timedelta(seconds=CLAIM_SECONDS))
+        if taken == len(ids):
+            claimed[key] = notifications
+    return claimed
+
+
+def send_notifications(client, threads, limit=500):
+    """Post the notifications that are due, on @threads threads sharing the
+    GitlabClient @client. The notifications to the same user's project are
+    posted as one comment, and each message appears in it once.
+    @return a dict of SENT, RETRYING and FAILED to how many comments had that outcome"""
+    claimed = claim_due(limit)
+    counts = {SENT: 0, RETRYING: 0, FAILED: 0}
+    if not claimed:
+        return counts
+    with ThreadPoolExecutor(max_workers=threads) as pool:
+        futures = {}
+        for (user, project), notifications in claimed.items():
+            messages = list(dict.fromkeys(n.message for n in notifications))
+            futures[pool.submit(post_comment, client, user, project, messages)] = notifications
+        # the database is only used from this thread
+        for future in as_completed(futures):
+            status, reason = future.result()
+            counts[record_attempt(futures[future], status, reason)] += 1
+    return counts
+
+
+def run_sender(threads, poll_seconds, drain=False):
+    """Keep posting notifications as they fall due, checking the outbox
+    every @poll_seconds when there are none. If @drain is set, return
+    once none are due"""
+    client = gitlab.client()
+    logger.info("Notification sender starting with %d threads" % threads)
+    while True:
+        counts = send_notifications(client, threads)
+        if any(counts.values()):
+            logger.info("Notifications: %d sent, %d to retry, %d failed" %
+                        (counts[SENT], counts[RETRYING], counts[FAILED]))
+            continue
+        if drain:
+            return
+        time.sleep(poll_seconds)
 
 def add_peer_testing_as_reporter(request,cw):
-   social = request.user.social_auth.get(provider='gitlab')
-   gitlab_cw = str(request.user) + "%2F" + str(cw.name)
-   gitlab_params = {'access_token': social.extra_data['access_token']}
-   # Adding Peer-Testing to project as Reporter
-   logger.info("Add Peer-Testing as Raporter to " + gitlab_cw)
-   gitlab_add_pt_rep_data = { 'user_id' : local.GITLAB_PT_USER_ID,
-                              'access_level' : local.GITLAB_PT_USER_ACCESS_LEVEL }
-   gitlab_add_pt_rep_req = gitlab_api_projects + gitlab_cw + "/members"
-   resp_add_pt_rep = requests.post(gitlab_add_pt_rep_req,
-                                   data=gitlab_add_pt_rep_data,
-                                   params=gitlab_params,
-                                   verify=False)
-   logger.info("Add Peer-Testing as Raporter to %s: %s" % (gitlab_cw, resp_add_pt_rep.content))
+    """Make the Peer-Testing user a reporter on @request's user's project for @cw"""
+    social = request.user.social_auth.get(provider='gitlab')
+    gitlab.client().add_reporter(request.user, cw.name, {'access_token': social.extra_data['access_token']})
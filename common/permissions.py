@@ -1,6 +1,52 @@
 
 import common.models as m
 from django.http import HttpResponseForbidden, Http404
+from django.utils.functional import cached_property
+
+
+class Roles:
+    """What a user is: whether they are a teacher, the courses they are
+    enrolled on and the feedback groups they are in. Each is loaded with
+    one query when it is first needed, and then kept on the user object,
+    so for request.user each is loaded at most once per request"""
+
+    def __init__(self, user):
+        self.user = user
+
+    @cached_property
+    def teacher(self):
+        return self.user.pk is not None and 'teacher' in self.user.groups.values_list('name', flat=True)
+
+    @cached_property
+    def courses(self):
+        """The codes of the courses the user is enrolled on"""
+        if self.user.pk is None:
+            return set()
+        return set(m.EnrolledUser.objects.filter(login=self.user).values_list('course_id', flat=True))
+
+    @cached_property
+    def feedback_groups(self):
+        """The IDs of the user's feedback groups, each with the ID of its coursework"""
+        if self.user.pk is None:
+            return {}
+        return dict(self.user.feedbackmembership_set.values_list('group_id', 'group__coursework_id'))
+
+
+def roles(user):
+    """@return the Roles of @user, kept on it for as long as it
+    lives, which for request.user is the request"""
+    try:
+        return user.peer_testing_roles
+    except AttributeError:
+        user.peer_testing_roles = Roles(user)
+        return user.peer_testing_roles
+
+
+def forget_roles(user):
+    """Load the Roles of @user again when next needed,
+    after changing their groups or enrolments"""
+    if hasattr(user, 'peer_testing_roles'):
+        del user.peer_testing_roles
 
 
 def require_teacher(f):
@@ -35,7 +81,7 @@ def coursework_access(f):
 
 def is_teacher(user):
     """is @user a teacher?"""
-    return user.groups.filter(name='teacher').exists()
+    return roles(user).teacher
 
 
 def is_owner_of_solution(user, test_match_instance):
@@ -47,15 +93,24 @@ def is_owner_of_solution(user, test_match_instance):
 def can_view_coursework(user, coursework):
     """BOOL: Check if the given @user instance is
     allowed to view the specified @coursework instance"""
-    is_enrolled = m.EnrolledUser.objects.filter(login=user, course=coursework.course)
-    if not is_enrolled.exists():
+    if coursework.course_id not in roles(user).courses:
         return False
     return True if is_teacher(user) else coursework.is_visible()
 
 
 def is_enrolled_on_course(user, course):
-    """Determine if @user is enrolled on @course"""
-    return m.EnrolledUser.objects.filter(login=user, course=course).exists()
+    """Determine if @user is enrolled on @course, or the course with code @course"""
+    return getattr(course, 'pk', course) in roles(user).courses
+
+
+def is_in_feedback_group(user, group_id):
+    """Determine if @user is a member of the feedback group with @group_id,
+    which is False if @group_id isn't a number"""
+    try:
+        group_id = int(group_id)
+    except (TypeError, ValueError):
+        return False
+    return group_id in roles(user).feedback_groups
 
 
 def user_is_self_testing(user, test_match_instance):
@@ -1,8 +1,10 @@
+from django.contrib.auth.models import User
 from django.core.exceptions import ObjectDoesNotExist
+from django.db.models import Q
 
 import common.models as cm
 import feedback.models as fm
-from common.permissions import is_teacher
+from common.permissions import is_in_feedback_group, is_teacher, roles
 
 
 def nick_for_comment(user, group, requesting_user):
@@ -20,29 +22,41 @@ def nick_for_comment(user, group, requesting_user):
         return "Unknown User - %s, %s" % user.id, group.id
 
 
-def nick_for_display(group, requesting_user, submission, version):
+def nicknames_in_group(group):
+    """Map the id of each member of feedback @group to their
+    nickname, and of each teacher to None, so that a page
+    can name every submission of the group from two queries"""
+    nicknames = dict(fm.FeedbackMembership.objects.filter(group=group).values_list('user_id', 'nickname'))
+    nicknames.update(dict.fromkeys(User.objects.filter(groups__name='teacher').values_list('id', flat=True)))
+    return nicknames
+
+
+def nick_for_display(group, requesting_user, submission, version, nicknames=None):
     """Find the nickname, for the specified @user in
      feedback @group, and customize appropriate to
      the status and relationship to @requesting_user.
-     For use in preparing display name of @submission"""
-    try:
-        if requesting_user == submission.creator:
-            return "My %s%s" % (submission.display_name, " (v" + str(version) + ")" if submission.type == cm.SubmissionType.SOLUTION else "")
-        if is_teacher(requesting_user):
-            return "%s %s%s" % (submission.creator.username, submission.display_name, " (v" + str(version) + ")" if submission.type == cm.SubmissionType.SOLUTION else "")
-        if is_teacher(submission.creator):
-            return submission.display_name
-        nick = fm.FeedbackMembership.objects.get(group=group, user=submission.creator).nickname
-        return "%s %s%s" % (nick, submission.display_name, " (v" + str(version) + ")" if submission.type == cm.SubmissionType.SOLUTION else "")
-    except ObjectDoesNotExist:
-        return "Unknown User - %s, %s" % requesting_user.id, group.id
+     For use in preparing display name of @submission.
+     Pass the @nicknames of the group when naming many"""
+    version_name = " (v" + str(version) + ")" if submission.type == cm.SubmissionType.SOLUTION else ""
+    if requesting_user.pk == submission.creator_id:
+        return "My %s%s" % (submission.display_name, version_name)
+    if is_teacher(requesting_user):
+        return "%s %s%s" % (submission.creator.username, submission.display_name, version_name)
+    if nicknames is None:
+        nicknames = nicknames_in_group(group)
+    if submission.creator_id not in nicknames:
+        return "Unknown User - %s, %s" % (requesting_user.id, getattr(group, 'id', group))
+    if nicknames[submission.creator_id] is None:
+        return submission.display_name
+    return "%s %s%s" % (nicknames[submission.creator_id], submission.display_name, version_name)
 
 
 def get_feedback_groups_for_user_in_coursework(user, coursework):
     """Given @user trying to give feedback for @coursework
     get all of the groups they are assigned to as a list"""
-    return [mb.group for mb in fm.FeedbackMembership.objects.filter(user=user)
-            if mb.group.coursework == coursework]
+    groups = [group for group, group_coursework in roles(user).feedback_groups.items()
+              if group_coursework == coursework.pk]
+    return list(fm.FeedbackGroup.objects.filter(id__in=groups).order_by('id'))
 
 
 def get_all_users_in_feedback_group(group):
@@ -55,9 +69,13 @@ def get_all_test_matches_in_feedback_group(user, group):
     """"Given a feedback @group,
     get all of the associated test matches
     that @user should be able to access"""
-    return [detail_test_match_anon_names(user, tac.test, tac.group) for tac in
-            fm.TestAccessControl.objects.filter(group=group) if
-            tac.initiator == user or tac.test.solution.creator == user]
+    nicknames = nicknames_in_group(group)
+    return [(tac.test,
+             nick_for_display(group, user, tac.test.solution, tac.test.solution_version, nicknames),
+             nick_for_display(group, user, tac.test.test, tac.test.test_version, nicknames))
+            for tac in fm.TestAccessControl.objects.filter(
+                Q(initiator=user) | Q(test__solution__creator=user), group=group).select_related(
+                'test__solution__creator', 'test__test__creator').defer('test__log').order_by('id')]
 
 
 def detail_test_match_anon_names(user, tm, group=None):
@@ -105,5 +123,4 @@ def feedback_group_for_test_match(tm):
 
 def user_is_member_of_group(user, group_id):
     """Given a @user and a @group_id, determine if membership exists"""
-    group = fm.FeedbackGroup.objects.get(id=group_id)
-    return fm.FeedbackMembership.objects.filter(group=group, user=user).exists()
+    return is_in_feedback_group(user, group_id)
@@ -2,6 +2,7 @@ from django.contrib.auth.models import User
 from django.db import models as m
 
 import common.models as sm
+import common.permissions as cp
 
 
 # noinspection PyClassHasNoInit
@@ -37,13 +38,11 @@ class TestAccessControl(m.Model):
     def user_has_test_access(user, test_match_instance):
         """Return whether or not a user is a member of the
         feedback group for a given test match"""
-        tacs = TestAccessControl.objects.filter(test=test_match_instance)
-        if not tacs.exists():
+        tac = TestAccessControl.objects.filter(test=test_match_instance).first()
+        if tac is None:
             return False
-        tac = tacs.first()
-        group_membership = FeedbackMembership.objects.filter(group=tac.group, user=user)
-        return group_membership.exists() and ( tac.initiator == user or
-               tac.test.solution.creator == user )
+        return cp.is_in_feedback_group(user, tac.group_id) and ( tac.initiator_id == user.pk or
+               test_match_instance.solution.creator_id == user.pk )
     
     @staticmethod
     def user_has_submission_access(user, submission, test_context):
@@ -4,17 +4,18 @@ read -n 1
 
 # Reset the stored data for peer-testing. This will delete everything.
 rm db.sqlite3
-rm -r common/migrations feedback/migrations var
+rm -r common/migrations feedback/migrations runner/migrations var
 
 # Re-make the required data storage directories
 mkdir var
 mkdir var/test
 mkdir var/uploads
 mkdir var/log
+mkdir -p var/cache/build
 mkdir notify
 
 # Set up django
-./manage.py makemigrations common feedback
+./manage.py makemigrations common feedback runner
 ./manage.py migrate
 ./manage.py collectstatic --noinput
 touch db.sqlite3
@@ -22,6 +23,7 @@ touch db.sqlite3
 # Make the test runner scripts usable
 # If you add your own make sure to make them executable
 chmod +x libs/junit.sh
+chmod +x libs/junit-build.sh
 chmod +x libs/python.sh
 
 # Set the apache to to be able to access the peer testing directory and application
@@ -37,8 +39,8 @@ setfacl -Rm u:peer:r-x common feedback main runner teacher file_viewer libs noti
 chmod g+w .
 setfacl -m u:peer:rwx .
 setfacl -m u:peer:rwx var
-setfacl -Rm u:peer:rwx var/test var/uploads var/log
-setfacl -Rdm u:teacher:rwx var/test var/uploads var/log
+setfacl -Rm u:peer:rwx var/test var/uploads var/log var/cache
+setfacl -Rdm u:teacher:rwx var/test var/uploads var/log var/cache
 setfacl -m u:peer:rw- db.sqlite3
 
 # Populate an initial database with a superuser, required groups and an initial course
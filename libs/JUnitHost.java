@@ -0,0 +1,146 @@
+import java.io.BufferedReader;
+import java.io.File;
+import java.io.FileOutputStream;
+import java.io.FilterOutputStream;
+import java.io.IOException;
+import java.io.InputStreamReader;
+import java.io.OutputStream;
+import java.io.PrintStream;
+import java.net.URL;
+import java.net.URLClassLoader;
+import java.util.HashSet;
+import java.util.Set;
+
+import org.junit.internal.TextListener;
+import org.junit.runner.JUnitCore;
+
+/**
+ * Persistent JUnit test host, started by the runner when warm hosts are
+ * turned on. Reads one request per line on stdin: the workspace, the
+ * directory of compiled classes, the output file, the test class and
+ * the most bytes to write to the output file, tab separated. Each run
+ * loads the classes through a new class loader, so nothing static is
+ * shared between runs, and sends System.out and System.err to the
+ * output file, dropping whatever goes past its size. Writes the exit
+ * code JUnitCore would have exited with as one line on stdout, followed
+ * by a tab and "restart" if the run left threads running or replaced
+ * System.out or System.err, so that nothing of it can reach the next
+ * run. A test that calls System.exit ends the host, and the runner
+ * takes the host's exit code as the test's, as it would be without a
+ * warm host.
+ */
+public class JUnitHost {
+
+    public static void main(String[] args) throws IOException {
+        PrintStream protocol = System.out;
+        BufferedReader requests = new BufferedReader(new InputStreamReader(System.in, "UTF-8"));
+        String line;
+        while ((line = requests.readLine()) != null) {
+            String[] request = line.split("\t");
+            Set<Thread> before = new HashSet<>(Thread.getAllStackTraces().keySet());
+            Run run = run(new File(request[0]), new File(request[1]), new File(request[2]), request[3],
+                          Long.parseLong(request[4]));
+            boolean restart = run.changedStreams || leftOverThreads(before);
+            protocol.println(run.code + (restart ? "\trestart" : ""));
+            protocol.flush();
+        }
+    }
+
+    /** The exit code of a run, and whether its tests replaced the standard streams */
+    private static class Run {
+        final int code;
+        final boolean changedStreams;
+
+        Run(int code, boolean changedStreams) {
+            this.code = code;
+            this.changedStreams = changedStreams;
+        }
+    }
+
+    /**
+     * Whether any thread that wasn't in {@code before} is still running,
+     * after giving each a moment to finish
+     */
+    private static boolean leftOverThreads(Set<Thread> before) {
+        for (Thread thread : Thread.getAllStackTraces().keySet()) {
+            if (before.contains(thread)) {
+                continue;
+            }
+            try {
+                thread.join(100);
+            } catch (InterruptedException e) {
+                return true;
+            }
+            if (thread.isAlive()) {
+                return true;
+            }
+        }
+        return false;
+    }
+
+    /** Passes on at most {@code remaining} bytes, and drops the rest */
+    private static class LimitedOutputStream extends FilterOutputStream {
+        private long remaining;
+
+        LimitedOutputStream(OutputStream out, long limit) {
+            super(out);
+            this.remaining = limit;
+        }
+
+        @Override
+        public void write(int b) throws IOException {
+            if (remaining > 0) {
+                out.write(b);
+                remaining--;
+            }
+        }
+
+        @Override
+        public void write(byte[] b, int off, int len) throws IOException {
+            int kept = (int) Math.min(len, remaining);
+            if (kept > 0) {
+                out.write(b, off, kept);
+                remaining -= kept;
+            }
+        }
+    }
+
+    private static Run run(File workspace, File classes, File output, String testClass, long outputLimit)
+            throws IOException {
+        PrintStream savedOut = System.out;
+        PrintStream savedErr = System.err;
+        PrintStream capture = new PrintStream(
+                new LimitedOutputStream(new FileOutputStream(output), outputLimit), true, "UTF-8");
+        URLClassLoader loader = new URLClassLoader(
+                new URL[] {classes.toURI().toURL(), workspace.toURI().toURL()},
+                JUnitHost.class.getClassLoader());
+        System.setOut(capture);
+        System.setErr(capture);
+        int code = runTests(loader, testClass, capture);
+        boolean changedStreams = System.out != capture || System.err != capture;
+        System.setOut(savedOut);
+        System.setErr(savedErr);
+        capture.close();
+        loader.close();
+        return new Run(code, changedStreams);
+    }
+
+    private static int runTests(ClassLoader loader, String testClass, PrintStream capture) {
+        try {
+            capture.println("JUnit version " + junit.runner.Version.id());
+            Class<?> test;
+            try {
+                test = loader.loadClass(testClass);
+            } catch (ClassNotFoundException e) {
+                capture.println("Could not find class: " + testClass);
+                return 1;
+            }
+            JUnitCore core = new JUnitCore();
+            core.addListener(new TextListener(capture));
+            return core.run(test).wasSuccessful() ? 0 : 1;
+        } catch (Throwable t) {
+            t.printStackTrace(capture);
+            return 1;
+        }
+    }
+}
@@ -0,0 +1,8 @@
+#!/bin/sh
+# Junit compilation template file, run once per set of sources
+# $1 = tmp directory
+# $2 = lib directory
+# $3 = directory to write the compiled classes to
+# Exit the script with $? so that the javac exit code is recorded
+javac -cp .:$2/junit.jar:$2/hamcrest.jar -d $3 *.java
+exit $?
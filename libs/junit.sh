@@ -2,8 +2,14 @@
 # Junit testing template file
 # $1 = tmp directory
 # $2 = lib directory
+# $3 = directory of classes already compiled by junit-build.sh, if any
+# $TEST_REPORTS_DIR = where to write any JUnit XML reports, as TEST-*.xml
 # Exit the script with $? so that the java exit code is recorded
-cp $2/junit.jar $2/hamcrest.jar $1
-javac -cp .:junit.jar:hamcrest.jar *.java
-java -cp .:junit.jar:hamcrest.jar org.junit.runner.JUnitCore MyTest
+if [ -n "$3" ]; then
+    CLASSES=$3
+else
+    javac -cp .:$2/junit.jar:$2/hamcrest.jar *.java
+    CLASSES=.
+fi
+java -cp $CLASSES:$2/junit.jar:$2/hamcrest.jar org.junit.runner.JUnitCore MyTest
 exit $?
@@ -0,0 +1,72 @@
+"""Persistent Python test host, started by the runner when warm hosts are
+turned on. Reads one JSON request per line on stdin, naming the
+workspace to test, the file its output should go to, and the CPU
+(seconds), memory (MB) and output (bytes) limits of the run, if any.
+Writing to a file past the output limit fails, as Python ignores the
+SIGXFSZ it would be sent. Each run happens in a child forked from this
+process, so the interpreter and unittest are only loaded once, and
+anything the tests import or change goes away with the child. Writes the
+exit code of each run as one line on stdout, the same code that
+python.sh would have exited with."""
+
+import json
+import os
+import resource
+import sys
+import traceback
+import unittest
+
+
+def set_limits(cpu, memory, output):
+    if cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (cpu, cpu + 1))
+    if memory:
+        resource.setrlimit(resource.RLIMIT_DATA, (memory * 1024 * 1024, memory * 1024 * 1024))
+    if output:
+        resource.setrlimit(resource.RLIMIT_FSIZE, (output, output))
+
+
+def run_in_child(workspace, output, limits):
+    """Run the tests in @workspace as `python3 -m unittest discover -v -p "*.py"`
+    would, with stdout and stderr going to @output. Never returns"""
+    code = 1
+    try:
+        set_limits(limits.get('cpu'), limits.get('memory'), limits.get('output'))
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o600)
+        os.dup2(fd, 1)
+        os.dup2(fd, 2)
+        os.close(fd)
+        os.chdir(workspace)
+        program = unittest.main(module=None, exit=False,
+                                argv=['python3 -m unittest', 'discover', '-v', '-p', '*.py'])
+        code = 0 if program.result.wasSuccessful() else 1
+    except SystemExit as exception:
+        code = exception.code if isinstance(exception.code, int) else 1
+    except BaseException:
+        traceback.print_exc()
+    finally:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        os._exit(code)
+
+
+def run(workspace, output, limits):
+    """Fork a child to run the tests in @workspace, @return its exit code"""
+    sys.stdout.flush()
+    pid = os.fork()
+    if pid == 0:
+        run_in_child(workspace, output, limits)
+    _, status = os.waitpid(pid, 0)
+    if os.WIFSIGNALED(status):
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+
+def main():
+    for line in sys.stdin:
+        request = json.loads(line)
+        print(run(request['workspace'], request['output'], request.get('limits', {})), flush=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -3,5 +3,6 @@
 # Exit the script with $? so that the python exit code is recorded
 # $1 = tmp directory
 # $2 = lib directory
-python3 -m unittest discover -p "*.py"
+# $TEST_REPORTS_DIR = where to write any JUnit XML reports, as TEST-*.xml
+python3 -m unittest discover -v -p "*.py"
 exit $?
\ No newline at end of file
@@ -3,6 +3,7 @@ from django.conf import settings
 from django.contrib.auth.models import User, Group
 from django.db import transaction
 from common import models as m
+from common import permissions as cp
 import csv
 import logging
 
@@ -40,5 +41,6 @@ def enrol_new_user(backend, details, user=None, *args, **kwargs):
                     if not m.EnrolledUser.objects.filter(login=user, course=course).exists():
                         m.EnrolledUser(login=user, course=course).save()
                         logger.info('Enrolment of ' + userid + ' to ' + coursecode + ' as ' + role)
+                    cp.forget_roles(user)
     else:
         logger.info('New user (no email)')
@@ -43,6 +43,7 @@ INSTALLED_APPS = [
     'student',
     'teacher',
     'test_match',
+    'runner.apps.RunnerConfig',
     'django.contrib.sites',
     'django_comments',
     'social_django'
@@ -189,6 +190,76 @@ STATIC_ROOT = os.path.join(BASE_DIR, 'var/static/')
 MEDIA_URL = local.HTTP_PREFIX + '/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'var/uploads')
 MEDIA_TMP_TEST = os.path.join(BASE_DIR, 'var/tmp/test')
+SUBMISSION_STORAGE = 'directory'
+# 'directory' keeps a full copy of the files of every submission version
+# 'blobs' keeps each distinct file once and hard links it into the versions that have it, see common/blobs.py
+SUBMISSION_BLOB_ROOT = os.path.join(MEDIA_ROOT, '.blobs')
+# where blobs are kept, it must be on the same filesystem as MEDIA_ROOT
+GITLAB_FETCH_MAX_BYTES = 20 * 1024 * 1024
+# the most bytes of solution or test files kept from one fetch from GitLab
+# only files matching the coursework's path patterns count, the rest of the archive is skipped as it is read
+GITLAB_HARVEST_THREADS = 16
+# how many students' projects a harvest downloads at once, see ./manage.py harvest_gitlab
+GITLAB_HARVEST_BATCH = 50
+# how many students' fetched files a harvest stores in one transaction
+GITLAB_MAX_CONNECTIONS = 16
+# how many calls each process makes to GitLab at once, more wait for one to finish
+GITLAB_TIMEOUT_SECONDS = 30
+# how long to wait for GitLab to answer a call
+NOTIFICATION_SENDER_THREADS = 4
+# how many GitLab comments ./manage.py send_notifications posts at once
+NOTIFICATION_POLL_SECONDS = 5
+# how long the sender waits before checking an empty outbox again
+NOTIFICATION_MAX_ATTEMPTS = 6
+# a comment GitLab keeps failing to take is given up after this many tries
+NOTIFICATION_RETRY_SECONDS = 30
+# the wait before the first retry, doubled for each one after
+
+
+# Test runner
+RUNNER_USE_JOB_QUEUE = True
+# put new test matches on the job queue for ./manage.py run_test_worker
+# if False, each test match is run on a new thread of the web process
+RUNNER_WORKER_PROCESSES = os.cpu_count() or 1
+# how many tests a single worker runs at the same time
+RUNNER_JOB_LEASE_SECONDS = 90
+# a claimed job whose lease runs out is handed to another worker
+RUNNER_HEARTBEAT_SECONDS = 30
+# how often a worker renews the leases on the jobs it is running, well within the lease
+RUNNER_JOB_MAX_ATTEMPTS = 3
+# a job whose lease has run out this many times is marked as failed instead of reclaimed
+RUNNER_MAX_IN_FLIGHT_PER_USER = 2
+# how many of one student's tests may run at once, across all workers
+# signature tests go first, then self tests, peer tests and finally teachers' bulk runs
+RUNNER_POLL_SECONDS = 2
+# how long an idle worker waits before checking the queue again
+RUNNER_RESULT_CACHE = True
+# reuse the results of a test already run on byte-identical files and script
+RUNNER_BUILD_CACHE = os.path.join(BASE_DIR, 'var/cache/build')
+# where the output of build scripts (e.g. libs/junit-build.sh) is kept
+RUNNER_WARM_HOSTS = False
+# run tests on long running JVM / Python hosts instead of starting a new one each time
+RUNNER_HOST_SCRIPTS = {'python.sh': 'python', 'junit.sh': 'junit'}
+# which execute scripts a warm host can stand in for, and which kind of host
+RUNNER_HOST_MAX_RUNS = 50
+# a warm host is replaced after this many runs, or straight away if anything goes wrong
+RUNNER_SCRATCH_ROOT = None
+# where test workspaces are made, e.g. '/dev/shm/peer-testing' for a tmpfs
+# None uses the system temp directory
+RUNNER_STAGING_METHODS = ('reflink', 'copy')
+# how files are put in a test workspace, tried in order: 'reflink', 'link' or 'copy'
+# only add 'link' if tests can't write to var/uploads, see runner/staging.py
+RUNNER_CGROUP_ROOT = None
+# a cgroup v2 directory delegated to the test workers, e.g. '/sys/fs/cgroup/peer-testing'
+# if set, each test gets its own cgroup for its memory and process limits, see runner/limits.py
+RUNNER_OUTPUT_LIMIT = 1024 * 1024
+# bytes of output kept for a test whose coursework doesn't set an output limit
+# the start and end of longer output are kept, see runner/capture.py
+RUNNER_KEEP_LOGS = True
+# keep the compressed output of each test run, as well as its test case results
+RUNNER_METRICS_TOKEN = None
+# lets a scraper read teacher/metrics with the header 'Authorization: Bearer <token>'
+# without it, only logged in teachers can read the runner metrics
 
 
 # Auth URLconf
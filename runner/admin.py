@@ -0,0 +1,6 @@
+from django.contrib import admin
+import runner.models as m
+
+admin.site.register(m.TestJob)
+admin.site.register(m.CachedResult)
+admin.site.register(m.RunnerMetric)
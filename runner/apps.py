@@ -0,0 +1,10 @@
+from django.apps import AppConfig
+
+
+class RunnerConfig(AppConfig):
+    name = 'runner'
+
+    def ready(self):
+        import common.models as cm
+        import runner.rerun as rerun
+        cm.version_incremented.connect(rerun.version_incremented, sender=cm.Submission)
@@ -0,0 +1,75 @@
+"""Cache of build outputs, e.g. compiled classes, for execute scripts that
+have a companion build script. For an execute script libs/NAME.sh the
+build script is libs/NAME-build.sh; it is given the staged sources, the
+lib directory and an empty output directory. Whatever it writes there is
+kept under the hash of the sources it was built from, and that directory
+is passed on to the execute script instead of building again."""
+
+import hashlib
+import os
+import shutil
+import tempfile
+
+from django.conf import settings
+
+import runner.cache as cache
+
+import logging
+logger = logging.getLogger("django")
+
+
+def build_script_for(execute_script):
+    """@return the path to the build script that goes
+    with @execute_script, or None if it doesn't have one"""
+    stem, extension = os.path.splitext(execute_script)
+    build_script = stem + '-build' + extension
+    return build_script if os.path.isfile(build_script) else None
+
+
+def build_key(sols_dir, test_dir, build_script):
+    """Hash of everything that goes into building the
+    sources in @sols_dir and @test_dir with @build_script"""
+    sha = hashlib.sha256()
+    for part in [cache.directory_digest(sols_dir),
+                 cache.directory_digest(test_dir),
+                 cache.file_digest(build_script)]:
+        sha.update(part.encode('ascii') + b'\0')
+    return sha.hexdigest()
+
+
+def build_path(key):
+    """Where the output of the build with @key is kept"""
+    return os.path.join(settings.RUNNER_BUILD_CACHE, key[:2], key)
+
+
+def cached_build(key):
+    """@return the directory of a finished build for @key, or None"""
+    path = build_path(key)
+    return path if os.path.isdir(path) else None
+
+
+def new_staging_dir(key):
+    """Make an empty directory, next to where the build
+    for @key will end up, for the build to write into"""
+    parent = os.path.dirname(build_path(key))
+    os.makedirs(parent, exist_ok=True)
+    return tempfile.mkdtemp(dir=parent, prefix=key + '.')
+
+
+def publish(staging_dir, key):
+    """Move a finished build in @staging_dir to its place in the cache.
+    If another worker built the same @key first, theirs is kept.
+    @return the directory of the build for @key"""
+    path = build_path(key)
+    try:
+        os.rename(staging_dir, path)
+    except OSError:
+        shutil.rmtree(staging_dir)
+    return path
+
+
+def clear():
+    """Remove every cached build"""
+    if os.path.isdir(settings.RUNNER_BUILD_CACHE):
+        shutil.rmtree(settings.RUNNER_BUILD_CACHE)
+    logger.info("Removed all cached builds")
@@ -0,0 +1,117 @@
+"""Cache of test results, keyed on the content of everything that went
+into running a test: the solution files, the test files, the execute
+script and the limits it ran within. A new test match whose inputs are
+byte for byte the same as one that has already been run gets that run's
+results without executing."""
+
+import hashlib
+import os
+
+from django.conf import settings
+from django.db.models import F
+
+import runner.metrics as metrics
+import runner.results as results
+from runner.models import CachedResult
+
+import logging
+logger = logging.getLogger("django")
+
+# Outcomes that depend on the load of the machine rather than the code
+UNCACHEABLE_ERROR_LEVELS = [101, 102]
+
+
+def file_digest(path):
+    """sha256 hex digest of the file at @path, read in chunks"""
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(65536), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def directory_digest(path):
+    """Hash the names and contents of the files directly in @path"""
+    sha = hashlib.sha256()
+    if os.path.isdir(path):
+        for name in sorted(os.listdir(path)):
+            full_path = os.path.join(path, name)
+            if os.path.isfile(full_path):
+                sha.update(name.encode('utf-8') + b'\0' +
+                           file_digest(full_path).encode('ascii') + b'\0')
+    return sha.hexdigest()
+
+
+def manifest_digest(manifest):
+    """The directory_digest of a version's directory, from its
+    SubmissionVersion @manifest rather than its files"""
+    sha = hashlib.sha256()
+    for file in sorted(manifest.files.all(), key=lambda file: file.name):
+        sha.update(file.name.encode('utf-8') + b'\0' + file.sha256.encode('ascii') + b'\0')
+    return sha.hexdigest()
+
+
+def version_digest(submission, version):
+    """The directory_digest of @version of @submission, from its
+    manifest, or from its files if it was uploaded without one"""
+    manifest = submission.manifest(version)
+    if manifest is not None:
+        return manifest_digest(manifest)
+    return directory_digest(submission.originals_path(version))
+
+
+def result_key(coursework, solution_digest, test_digest, execute_script, build_script,
+               limits, host_kind):
+    """The cache key for running, for @coursework, the test with the
+    digest @test_digest against the solution with @solution_digest using
+    @execute_script, and @build_script if it has one, within @limits in
+    a warm host of @host_kind, or None if it is run in a fresh process"""
+    sha = hashlib.sha256()
+    for part in [str(coursework.id),
+                 solution_digest,
+                 test_digest,
+                 file_digest(execute_script),
+                 file_digest(build_script) if build_script is not None else '',
+                 hashlib.sha256(repr(tuple(limits)).encode('ascii')).hexdigest(),
+                 host_kind or '']:
+        sha.update(part.encode('ascii') + b'\0')
+    return sha.hexdigest()
+
+
+def lookup(key, coursework, labels):
+    """Find the cached result for @key of @coursework, counting the hit
+    or miss against the metric @labels, see runner.metrics.test_labels.
+    @return None if nothing has been cached for it"""
+    if not settings.RUNNER_RESULT_CACHE:
+        return None
+    cached = CachedResult.objects.filter(key=key, coursework=coursework).first()
+    if cached is None:
+        metrics.increment(metrics.CACHE_LOOKUPS, dict(labels, result='miss'))
+        return None
+    metrics.increment(metrics.CACHE_LOOKUPS, dict(labels, result='hit'))
+    CachedResult.objects.filter(key=key).update(hits=F('hits') + 1)
+    return cached
+
+
+def store(key, coursework, error_level, output, report=results.EMPTY):
+    """Remember the @error_level, @output and runner.results.Report
+    @report of running @key for @coursework"""
+    if not settings.RUNNER_RESULT_CACHE or error_level in UNCACHEABLE_ERROR_LEVELS:
+        return
+    CachedResult.objects.get_or_create(key=key, defaults={
+        'coursework': coursework,
+        'error_level': error_level,
+        'output': output,
+        'report': results.to_json(report)
+    })
+
+
+def invalidate(coursework=None):
+    """Forget the cached results for @coursework, or for everything.
+    @return how many results were removed"""
+    cached = CachedResult.objects.all()
+    if coursework is not None:
+        cached = cached.filter(coursework=coursework)
+    count, _ = cached.delete()
+    logger.info("Removed %d cached test results for %s" % (count, coursework or "all courseworks"))
+    return count
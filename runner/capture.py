@@ -0,0 +1,130 @@
+"""Capture the output of a test straight to a file as it is produced, so
+a test that prints without end costs the worker a fixed amount of memory.
+Once the output passes the byte limit, the first half of the limit is
+kept from the start of the output and the second half from the end, and
+what was in between is replaced by a note of how much was left out."""
+
+import codecs
+import os
+import select
+import tempfile
+import time
+
+from django.conf import settings
+
+import runner.staging as staging
+
+CHUNK = 65536
+
+# Seconds to wait for the last of the output of a test that has been killed
+DRAIN_SECONDS = 1
+
+# Longest marker looked for in the output, see OutputCapture
+MARKER_OVERLAP = 64
+
+
+def new_output_file():
+    """@return the path of a new empty file to capture output into"""
+    fd, path = tempfile.mkstemp(prefix='output-', suffix='.txt', dir=staging.scratch_root())
+    os.close(fd)
+    os.chmod(path, 0o644)
+    return path
+
+
+def text_file(text):
+    """@return the path of a new output file holding just @text"""
+    path = new_output_file()
+    with open(path, 'w', encoding='utf-8') as f:
+        f.write(text)
+    return path
+
+
+def read_text(path):
+    with open(path, encoding='utf-8', errors='replace') as f:
+        return f.read()
+
+
+def output_limit(limits):
+    """The most bytes of output kept for a test run within @limits"""
+    return limits.output or settings.RUNNER_OUTPUT_LIMIT
+
+
+class OutputCapture:
+    """Writes the output of one run to the file at @path, under a
+    @message heading, keeping at most @limit bytes of it, and noting
+    which of the ascii @markers appear anywhere in it"""
+    def __init__(self, path, limit, message='Result', markers=()):
+        self.path = path
+        self.limit = limit
+        self.head_left = limit - limit // 2
+        self.tail_size = limit // 2
+        self.tail = bytearray()
+        self.total = 0
+        self.carry = b''
+        self.markers = [marker.encode('ascii') for marker in markers]
+        self.seen = set()
+        self.decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+        self.file = open(path, 'w', encoding='utf-8')
+        self.file.write(message + ": \n")
+
+    def write(self, data):
+        """Add the bytes @data to the output"""
+        self.total += len(data)
+        searched = self.carry + data
+        for marker in self.markers:
+            if marker in searched:
+                self.seen.add(marker.decode('ascii'))
+        self.carry = searched[-MARKER_OVERLAP:]
+        if self.head_left > 0:
+            head = data[:self.head_left]
+            self.head_left -= len(head)
+            self.file.write(self.decoder.decode(head))
+            data = data[len(head):]
+        if data and self.tail_size:
+            self.tail += data
+            if len(self.tail) > self.tail_size:
+                del self.tail[:len(self.tail) - self.tail_size]
+
+    def saw(self, markers):
+        """Did any of @markers, given when this was made, appear in the output"""
+        return any(marker in self.seen for marker in markers)
+
+    def exceeded(self):
+        """Was there more output than the limit allows"""
+        return self.total > self.limit
+
+    def copy_from(self, stream, deadline):
+        """Write everything read from the pipe @stream to the output until
+        it is closed. @return False if the @deadline, a time.monotonic
+        time, passes first"""
+        fd = stream.fileno()
+        while True:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return False
+            readable, _, _ = select.select([fd], [], [], remaining)
+            if not readable:
+                return False
+            data = os.read(fd, CHUNK)
+            if not data:
+                return True
+            self.write(data)
+
+    def copy_file(self, path):
+        """Write the content of the file at @path to the output"""
+        with open(path, 'rb') as f:
+            for data in iter(lambda: f.read(CHUNK), b''):
+                self.write(data)
+
+    def close(self, note=None):
+        """Finish the output file, ending it with @note if given"""
+        omitted = self.total - (self.limit - self.limit // 2 - self.head_left) - len(self.tail)
+        if omitted > 0:
+            self.file.write(self.decoder.decode(b'', final=True))
+            self.file.write("\n\n... %d bytes of output left out ...\n\n" % omitted)
+            self.file.write(bytes(self.tail).decode('utf-8', errors='replace'))
+        else:
+            self.file.write(self.decoder.decode(bytes(self.tail), final=True))
+        if note is not None:
+            self.file.write("\n" + note + "\n")
+        self.file.close()
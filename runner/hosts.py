@@ -0,0 +1,234 @@
+"""Warm test hosts: long running JVM and Python processes that tests are
+handed to, instead of paying for a fresh interpreter on every run. Each
+process that runs tests keeps at most one host of each kind, started on
+first use. A host is thrown away and replaced after a number of runs, or
+as soon as anything goes wrong with it: a timeout, a crash, or a reply
+that doesn't make sense."""
+
+import hashlib
+import json
+import os
+import select
+import shutil
+import signal
+import subprocess
+import tempfile
+
+from django.conf import settings
+
+import common.models as m
+import runner.capture as capture
+import runner.limits as rl
+import runner.staging as staging
+
+import logging
+logger = logging.getLogger("django")
+
+PYTHON = 'python'
+JUNIT = 'junit'
+
+# The test class junit.sh runs
+JUNIT_TEST_CLASS = 'MyTest'
+
+_hosts = {}
+
+
+class HostError(Exception):
+    """The host stopped, or sent back something that wasn't an exit code"""
+
+
+def lib_dir():
+    return os.path.join(settings.BASE_DIR, 'libs')
+
+
+def kind_for(execute_script, limits):
+    """@return which kind of host can run tests for @execute_script within
+    @limits, or None if warm hosts are turned off or can't run it. The JVM
+    host can't hold a test to CPU, memory or process limits, so JUnit tests
+    with any of them are run without it"""
+    if not settings.RUNNER_WARM_HOSTS:
+        return None
+    kind = settings.RUNNER_HOST_SCRIPTS.get(os.path.basename(execute_script))
+    if kind == JUNIT and (limits.cpu or limits.memory or limits.processes):
+        return None
+    return kind
+
+
+def junit_classpath(*paths):
+    return ':'.join(list(paths) + [os.path.join(lib_dir(), 'junit.jar'),
+                                   os.path.join(lib_dir(), 'hamcrest.jar')])
+
+
+def compiled_junit_host():
+    """Compile libs/JUnitHost.java, once per version of it.
+    @return the directory holding JUnitHost.class"""
+    source = os.path.join(lib_dir(), 'JUnitHost.java')
+    with open(source, 'rb') as f:
+        digest = hashlib.sha256(f.read()).hexdigest()
+    classes = os.path.join(settings.RUNNER_BUILD_CACHE, 'hosts', digest)
+    if not os.path.isdir(classes):
+        os.makedirs(os.path.dirname(classes), exist_ok=True)
+        staging = tempfile.mkdtemp(dir=os.path.dirname(classes), prefix=digest + '.')
+        subprocess.check_call(['javac', '-cp', junit_classpath(), '-d', staging, source])
+        try:
+            os.rename(staging, classes)
+        except OSError:
+            shutil.rmtree(staging)
+    return classes
+
+
+class TestHost:
+    """One warm process of a given @kind, and how many runs it has done.
+    The JVM can't change its working directory for each run, so the JVM
+    host gets a working directory of its own, that each run's files are
+    moved into"""
+    def __init__(self, kind):
+        self.kind = kind
+        self.proc = None
+        self.runs = 0
+        self.workdir = None
+
+    def command(self):
+        if self.kind == PYTHON:
+            return ['python3', os.path.join(lib_dir(), 'python-host.py')]
+        return ['java', '-cp', junit_classpath(compiled_junit_host()), 'JUnitHost']
+
+    def request(self, workspace, built_dir, output, limits):
+        """The line that asks this host to run the tests in @workspace.
+        The Python host applies the CPU and memory @limits to each run,
+        but not the process limit, as it isn't in a cgroup; the JVM host
+        is shared between runs, so it is only given JUnit tests held to
+        no more than the wall time and output limits, see kind_for.
+        Either host stops writing to @output one byte past the output
+        limit, so that a run which goes over it can be told apart. The
+        JVM host asks to be replaced after a run that leaves threads
+        running or replaces System.out or System.err"""
+        output_cap = capture.output_limit(limits) + 1
+        if self.kind == PYTHON:
+            return json.dumps({'workspace': workspace, 'output': output,
+                               'limits': {'cpu': limits.cpu, 'memory': limits.memory,
+                                          'output': output_cap}})
+        return '\t'.join([workspace, built_dir, output, JUNIT_TEST_CLASS, str(output_cap)])
+
+    def start(self):
+        logger.info("Starting %s test host" % self.kind)
+        # anything left of a host that ended by itself
+        self.stop()
+        if self.kind == JUNIT:
+            self.workdir = tempfile.mkdtemp(prefix='host-', dir=staging.scratch_root())
+        self.proc = subprocess.Popen(self.command(), cwd=self.workdir or tempfile.gettempdir(),
+                                     stdin=subprocess.PIPE,
+                                     stdout=subprocess.PIPE,
+                                     stderr=subprocess.DEVNULL,
+                                     start_new_session=True,
+                                     universal_newlines=True)
+        self.runs = 0
+
+    def stop(self):
+        """Kill the host and anything it is still running"""
+        if self.proc is not None:
+            try:
+                os.killpg(self.proc.pid, signal.SIGKILL)
+            except OSError:
+                pass
+            self.proc.wait()
+            self.proc = None
+        if self.workdir is not None:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+            self.workdir = None
+
+    def move_in(self, workspace):
+        """Move the files staged in @workspace into the working directory
+        of the host. @return that directory"""
+        for name in os.listdir(workspace):
+            os.rename(os.path.join(workspace, name), os.path.join(self.workdir, name))
+        return self.workdir
+
+    def clear_workdir(self):
+        """Remove what the last run left in the working directory, or
+        replace the host if that can't be done"""
+        try:
+            for name in os.listdir(self.workdir):
+                path = os.path.join(self.workdir, name)
+                if os.path.isdir(path) and not os.path.islink(path):
+                    shutil.rmtree(path)
+                else:
+                    os.remove(path)
+        except OSError as exception:
+            logger.error("Could not clear the %s test host's directory: %s" % (self.kind, exception))
+            self.stop()
+
+    def is_running(self):
+        return self.proc is not None and self.proc.poll() is None
+
+    def reply(self, timeout):
+        """Wait up to @timeout seconds for the host to answer. @return the
+        exit code it sent and whether the host must be replaced before the
+        next run, or None if it took too long. If the tests ended the JVM
+        host themselves with System.exit, its exit code is theirs"""
+        readable, _, _ = select.select([self.proc.stdout], [], [], timeout)
+        if not readable:
+            return None
+        line = self.proc.stdout.readline()
+        if not line:
+            code = self.proc.wait()
+            if self.kind != JUNIT or code < 0:
+                raise HostError("%s test host stopped with %d" % (self.kind, code))
+            return code, True
+        reply = line.strip().split('\t')
+        if not reply[0].lstrip('-').isdigit() or reply[1:] not in ([], ['restart']):
+            raise HostError("Unexpected reply from %s test host: %r" % (self.kind, line))
+        return int(reply[0]), reply[1:] == ['restart']
+
+    def run(self, workspace, built_dir, limits):
+        """Run the tests staged in @workspace, using the classes in
+        @built_dir for JUnit. @return the exit code, the path of a file
+        holding the output and the ExecutionLimit that stopped the tests,
+        if one did"""
+        if not self.is_running():
+            self.start()
+        fd, output = tempfile.mkstemp(prefix='host-output-', dir=staging.scratch_root())
+        os.close(fd)
+        try:
+            if self.workdir is not None:
+                workspace = self.move_in(workspace)
+            try:
+                self.proc.stdin.write(self.request(workspace, built_dir, output, limits) + '\n')
+                self.proc.stdin.flush()
+                reply = self.reply(limits.wall)
+            except (OSError, HostError) as exception:
+                logger.error(str(exception))
+                self.stop()
+                return 102, capture_output(output, limits, "Execution error: the test host stopped")[0], None
+            if reply is None:
+                self.stop()
+                return 101, capture_output(output, limits, "Time Out")[0], m.ExecutionLimit.WALL_TIME
+            code, restart = reply
+            self.runs += 1
+            if restart or self.runs >= settings.RUNNER_HOST_MAX_RUNS:
+                self.stop()
+            result, captured = capture_output(output, limits)
+            if self.kind != PYTHON:
+                return code, result, m.ExecutionLimit.OUTPUT if captured.exceeded() else None
+            return code, result, rl.Sandbox(limits).exceeded(code, False, captured)
+        finally:
+            os.remove(output)
+            if self.workdir is not None:
+                self.clear_workdir()
+
+
+def capture_output(path, limits, note=None):
+    """Copy what a host wrote to @path into a new output file, within
+    the output limit. @return its path and the OutputCapture"""
+    result = capture.new_output_file()
+    captured = capture.OutputCapture(result, capture.output_limit(limits), markers=rl.MARKERS)
+    captured.copy_file(path)
+    captured.close(note)
+    return result, captured
+
+
+def run(kind, workspace, built_dir, limits):
+    """Run the tests in @workspace on this process's host of @kind"""
+    if kind not in _hosts:
+        _hosts[kind] = TestHost(kind)
+    return _hosts[kind].run(workspace, built_dir, limits)
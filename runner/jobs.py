@@ -0,0 +1,256 @@
+"""The persistent job queue that sits between the web process, which
+creates test matches, and the worker processes that actually run them.
+A job is a row keyed on its test match, so anything queued survives a
+restart of either side."""
+
+import os
+import socket
+from collections import namedtuple, OrderedDict
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, F, Min, Q
+from django.utils import timezone
+
+import common.models as cm
+from runner.models import TestJob, JobState, JobPriority
+
+import logging
+logger = logging.getLogger("django")
+
+
+def default_worker_id():
+    """Name this worker process so that claimed
+    jobs can be traced back to where they ran"""
+    return "%s:%s" % (socket.gethostname(), os.getpid())
+
+
+def priority_for(test_match):
+    """The JobPriority of running @test_match"""
+    if test_match.type == cm.TestType.TEACHER:
+        return JobPriority.BULK
+    if test_match.test.type == cm.SubmissionType.SIGNATURE_TEST:
+        return JobPriority.SIGNATURE
+    if test_match.type == cm.TestType.SELF:
+        return JobPriority.SELF
+    return JobPriority.PEER
+
+
+def owner_for(test_match):
+    """The ID of the student whose share of the workers running @test_match
+    uses: whoever uploaded the test, or the solution if the test is the
+    coursework's own. None for a teacher's test match"""
+    if test_match.type == cm.TestType.TEACHER:
+        return None
+    if test_match.test.type == cm.SubmissionType.TEST_CASE:
+        return test_match.test.creator_id
+    return test_match.solution.creator_id
+
+
+def new_job(test_match, bulk=False):
+    """An unsaved job for @test_match, which is part of a @bulk run if set"""
+    if bulk:
+        return TestJob(test_match=test_match, priority=JobPriority.BULK, owner_id=None)
+    return TestJob(test_match=test_match, priority=priority_for(test_match), owner_id=owner_for(test_match))
+
+
+@transaction.atomic
+def enqueue(test_match):
+    """Put @test_match on the queue, unless it is already waiting or
+    a worker is running it"""
+    job = new_job(test_match)
+    existing = TestJob.objects.select_for_update().filter(test_match=test_match).first()
+    if existing is None:
+        job.save()
+    elif existing.state not in [JobState.QUEUED, JobState.RUNNING]:
+        job.created = existing.created
+        job.save()
+    else:
+        job = existing
+    return job
+
+
+@transaction.atomic
+def enqueue_unrun_in_coursework(coursework):
+    """Put every test match in @coursework that hasn't been run yet on the
+    queue as a bulk run, in a fixed number of queries however many there
+    are. Matches whose job previously failed are queued again, so calling
+    this again resumes an interrupted batch. @return how many jobs were
+    (re)queued"""
+    unrun = cm.TestMatch.objects.filter(coursework=coursework, error_level=None)
+    requeued = TestJob.objects.filter(test_match__in=unrun) \
+        .exclude(state__in=[JobState.QUEUED, JobState.RUNNING]) \
+        .update(state=JobState.QUEUED, claimed_by=None, lease_expires=None, finished=None,
+                attempts=0, priority=JobPriority.BULK, owner=None)
+    new_jobs = [TestJob(test_match_id=tm_id, priority=JobPriority.BULK) for tm_id in
+                unrun.filter(job__isnull=True).values_list('id', flat=True)]
+    TestJob.objects.bulk_create(new_jobs)
+    return requeued + len(new_jobs)
+
+
+def enqueue_batch(test_matches, bulk=False):
+    """Put the newly created @test_matches on the queue in one query,
+    as a @bulk run if set"""
+    TestJob.objects.bulk_create([new_job(tm, bulk) for tm in test_matches])
+
+
+def claimable_jobs(coursework=None):
+    """Jobs that are waiting, or that were claimed by a worker whose lease
+    has since run out. Optionally only those belonging to @coursework"""
+    jobs = TestJob.objects.filter(
+        Q(state=JobState.QUEUED) |
+        Q(state=JobState.RUNNING, lease_expires__lt=timezone.now(),
+          attempts__lt=settings.RUNNER_JOB_MAX_ATTEMPTS))
+    if coursework is not None:
+        jobs = jobs.filter(test_match__coursework=coursework)
+    return jobs
+
+
+def fail_abandoned_jobs():
+    """Give up on jobs whose lease has run out after being claimed
+    RUNNER_JOB_MAX_ATTEMPTS times, e.g. a test that takes down whichever
+    worker runs it. @return how many were given up on"""
+    now = timezone.now()
+    count = TestJob.objects.filter(state=JobState.RUNNING, lease_expires__lt=now,
+                                   attempts__gte=settings.RUNNER_JOB_MAX_ATTEMPTS) \
+        .update(state=JobState.FAILED, finished=now, lease_expires=None)
+    if count:
+        logger.warning("Gave up on %d test jobs abandoned by their workers too many times" % count)
+    return count
+
+
+def in_flight_by_owner():
+    """@return a dict of how many jobs each student has running"""
+    return dict(TestJob.objects.filter(state=JobState.RUNNING, lease_expires__gte=timezone.now(),
+                                       owner__isnull=False)
+                .values_list('owner_id').annotate(Count('pk')))
+
+
+def claim_next(worker_id, jobs):
+    """Claim the oldest of @jobs for @worker_id. The claim is a conditional
+    update, so two workers racing for the same job can't both win it.
+    @return the claimed job's test match ID, or None if there was none left"""
+    while True:
+        candidate = jobs.order_by('created').values_list('test_match_id', 'state', 'lease_expires').first()
+        if candidate is None:
+            return None
+        tm_id, state, lease_expires = candidate
+        now = timezone.now()
+        won = TestJob.objects.filter(test_match_id=tm_id, state=state, lease_expires=lease_expires) \
+            .update(state=JobState.RUNNING,
+                    claimed_by=worker_id,
+                    claimed_at=now,
+                    lease_expires=lease_expiry(),
+                    attempts=F('attempts') + 1)
+        if won:
+            return tm_id
+
+
+def claim_jobs(worker_id, count, coursework=None):
+    """Claim up to @count jobs for @worker_id, optionally only from
+    @coursework. Jobs are taken in priority order. Within a priority the
+    students with waiting jobs take turns, longest waiting first, and a
+    student who already has RUNNER_MAX_IN_FLIGHT_PER_USER jobs running
+    is skipped. @return a list of the claimed jobs"""
+    if count <= 0:
+        return []
+    fail_abandoned_jobs()
+    claimable = claimable_jobs(coursework)
+    in_flight = in_flight_by_owner()
+    turns = OrderedDict()
+    for priority, owner_id, _ in claimable.values_list('priority', 'owner_id') \
+            .annotate(oldest=Min('created')).order_by('priority', 'oldest'):
+        turns.setdefault(priority, []).append(owner_id)
+    claimed = []
+    for priority, owners in turns.items():
+        while owners and len(claimed) < count:
+            for owner_id in list(owners):
+                if len(claimed) >= count:
+                    break
+                if owner_id is not None and in_flight.get(owner_id, 0) >= settings.RUNNER_MAX_IN_FLIGHT_PER_USER:
+                    owners.remove(owner_id)
+                    continue
+                tm_id = claim_next(worker_id, claimable.filter(priority=priority, owner_id=owner_id))
+                if tm_id is None:
+                    owners.remove(owner_id)
+                    continue
+                claimed.append(tm_id)
+                in_flight[owner_id] = in_flight.get(owner_id, 0) + 1
+    return sorted(TestJob.objects.select_related(
+        'test_match', 'test_match__coursework', 'test_match__test', 'test_match__solution',
+        'test_match__test__coursework__course', 'test_match__solution__coursework__course',
+        'test_match__test__creator', 'test_match__solution__creator'
+    ).filter(test_match_id__in=claimed), key=lambda job: claimed.index(job.test_match_id))
+
+
+def lease_expiry():
+    return timezone.now() + timedelta(seconds=settings.RUNNER_JOB_LEASE_SECONDS)
+
+
+def extend_leases(worker_id, test_match_ids):
+    """Renew the leases @worker_id holds on the jobs of @test_match_ids.
+    @return the set of those it still holds; any others have been
+    reclaimed by another worker after the lease ran out"""
+    held = TestJob.objects.filter(test_match_id__in=test_match_ids,
+                                  claimed_by=worker_id,
+                                  state=JobState.RUNNING)
+    held_ids = set(held.values_list('test_match_id', flat=True))
+    TestJob.objects.filter(test_match_id__in=held_ids, claimed_by=worker_id,
+                           state=JobState.RUNNING).update(lease_expires=lease_expiry())
+    return held_ids
+
+
+def holds_claim(job, worker_id):
+    """Does @worker_id still hold the claim on @job. Inside a transaction
+    this locks the job, so the claim can't be taken over until it ends"""
+    return TestJob.objects.select_for_update().filter(test_match_id=job.test_match_id,
+                                                      claimed_by=worker_id,
+                                                      state=JobState.RUNNING).exists()
+
+
+def finish_job(job, worker_id, failed=False):
+    """Mark @job as no longer running, as long as
+    @worker_id still holds the claim on it"""
+    state = JobState.FAILED if failed else JobState.DONE
+    return TestJob.objects.filter(test_match_id=job.test_match_id,
+                                  claimed_by=worker_id,
+                                  state=JobState.RUNNING) \
+        .update(state=state, finished=timezone.now(), lease_expires=None) > 0
+
+
+def release_jobs(worker_id, started=()):
+    """Put the jobs @worker_id is still holding back on the queue, when it
+    stops before finishing them. A job it never started doesn't count as
+    an attempt. One whose test match ID is in @started does, as it may be
+    what stopped the worker, and is marked as failed instead once it has
+    had RUNNER_JOB_MAX_ATTEMPTS. @return how many were put back"""
+    held = TestJob.objects.filter(claimed_by=worker_id, state=JobState.RUNNING)
+    failed = held.filter(test_match_id__in=started, attempts__gte=settings.RUNNER_JOB_MAX_ATTEMPTS) \
+        .update(state=JobState.FAILED, finished=timezone.now(), lease_expires=None)
+    if failed:
+        logger.warning("Gave up on %d test jobs whose workers stopped while running them too many times" %
+                       failed)
+    released = held.filter(test_match_id__in=started) \
+        .update(state=JobState.QUEUED, claimed_by=None, lease_expires=None)
+    return released + held.update(state=JobState.QUEUED, claimed_by=None, lease_expires=None,
+                                  attempts=F('attempts') - 1)
+
+
+Progress = namedtuple('Progress', ['done', 'running', 'remaining', 'failed'])
+
+
+def coursework_progress(coursework):
+    """Summarise the jobs for @coursework as a Progress
+    of how many are done, running, waiting and failed"""
+    counts = dict(TestJob.objects.filter(test_match__coursework=coursework)
+                  .values_list('state').annotate(Count('pk')))
+    return Progress(done=counts.get(JobState.DONE, 0),
+                    running=counts.get(JobState.RUNNING, 0),
+                    remaining=counts.get(JobState.QUEUED, 0),
+                    failed=counts.get(JobState.FAILED, 0))
+
+
+def queue_depth():
+    """Count the jobs that are still waiting to be run"""
+    return TestJob.objects.filter(state=JobState.QUEUED).count()
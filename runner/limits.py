@@ -0,0 +1,138 @@
+"""Resource limits for running a test, taken from the execution profile
+of its coursework: wall time, CPU time, memory, number of processes and
+amount of output. CPU time and memory are enforced with rlimits on each
+of the test's processes. The memory rlimit is RLIMIT_DATA, which counts
+the private memory a process has made writable, so the address space a
+JVM reserves up front doesn't count against it.
+
+If RUNNER_CGROUP_ROOT points at a cgroup v2 directory delegated to the
+worker, each run also gets its own cgroup, which limits the memory and
+processes of the whole run rather than of each process, and reports
+exactly which limit was hit. The process limit is only enforced this
+way: RLIMIT_NPROC counts every process of the user the tests run as,
+which is shared with the web server and the other workers, so it can't
+limit one test."""
+
+import os
+import resource
+import signal
+import uuid
+from collections import namedtuple
+
+from django.conf import settings
+
+import common.models as m
+
+import logging
+logger = logging.getLogger("django")
+
+# @wall and @cpu are seconds, @memory is MB, @output is bytes. None means no limit
+Limits = namedtuple('Limits', ['wall', 'cpu', 'memory', 'processes', 'output'])
+
+# What a test says when it could not get the memory it asked for
+MARKERS = ['MemoryError', 'OutOfMemoryError', 'Cannot allocate memory']
+
+
+def limits_for(coursework):
+    """The Limits in the execution profile of @coursework"""
+    return Limits(wall=coursework.wall_time_limit,
+                  cpu=coursework.cpu_time_limit,
+                  memory=coursework.memory_limit,
+                  processes=coursework.process_limit,
+                  output=coursework.output_limit)
+
+
+def set_rlimits(limits):
+    """Apply the per process CPU and memory @limits to the calling process"""
+    if limits.cpu:
+        resource.setrlimit(resource.RLIMIT_CPU, (limits.cpu, limits.cpu + 1))
+    if limits.memory:
+        memory = limits.memory * 1024 * 1024
+        resource.setrlimit(resource.RLIMIT_DATA, (memory, memory))
+
+
+def cpu_limit_exceeded(returncode):
+    """Did a process end with @returncode because it ran out of CPU time,
+    either itself or as the last command of a shell script"""
+    return returncode in [-signal.SIGXCPU, 128 + signal.SIGXCPU]
+
+
+class Sandbox:
+    """The limits on one run of a test. Use as a context manager around
+    the run, and pass @preexec to the process that is started"""
+    def __init__(self, limits):
+        self.limits = limits
+        self.cgroup = None
+
+    def __enter__(self):
+        root = settings.RUNNER_CGROUP_ROOT
+        if root is not None and (self.limits.memory or self.limits.processes):
+            self.cgroup = os.path.join(root, 'test-' + uuid.uuid4().hex)
+            os.mkdir(self.cgroup)
+            try:
+                if self.limits.memory:
+                    self.write('memory.max', self.limits.memory * 1024 * 1024)
+                    self.write('memory.swap.max', 0)
+                if self.limits.processes:
+                    self.write('pids.max', self.limits.processes)
+            except OSError:
+                os.rmdir(self.cgroup)
+                self.cgroup = None
+                raise
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if self.cgroup is not None:
+            self.kill()
+            try:
+                os.rmdir(self.cgroup)
+            except OSError as exception:
+                logger.error("Could not remove cgroup %s: %s" % (self.cgroup, exception))
+            self.cgroup = None
+
+    def write(self, name, value):
+        with open(os.path.join(self.cgroup, name), 'w') as f:
+            f.write(str(value))
+
+    def events(self, name):
+        """Read a cgroup events file like memory.events as a dict"""
+        try:
+            with open(os.path.join(self.cgroup, name)) as f:
+                return {k: int(v) for k, v in (line.split() for line in f if line.strip())}
+        except OSError:
+            return {}
+
+    def kill(self):
+        """Kill anything of the run that is still left in the cgroup"""
+        try:
+            self.write('cgroup.kill', 1)
+        except OSError:
+            pass
+
+    def preexec(self):
+        """Run in the child process before it starts the test"""
+        if self.cgroup is None:
+            set_rlimits(self.limits)
+            return
+        self.write('cgroup.procs', 0)
+        set_rlimits(self.limits._replace(memory=None))
+
+    def exceeded(self, returncode, timed_out, capture):
+        """Which limit, if any, stopped the run that ended with @returncode,
+        given whether it @timed_out and the OutputCapture of its output,
+        which must have been watching for MARKERS.
+        @return an ExecutionLimit or None"""
+        if timed_out:
+            return m.ExecutionLimit.WALL_TIME
+        if self.limits.cpu and cpu_limit_exceeded(returncode):
+            return m.ExecutionLimit.CPU_TIME
+        if self.cgroup is not None:
+            if self.events('memory.events').get('oom_kill', 0) > 0:
+                return m.ExecutionLimit.MEMORY
+            if self.events('pids.events').get('max', 0) > 0:
+                return m.ExecutionLimit.PROCESSES
+        elif returncode != 0 and self.limits.memory and capture.saw(MARKERS):
+            return m.ExecutionLimit.MEMORY
+        if capture.exceeded():
+            return m.ExecutionLimit.OUTPUT
+        return None
@@ -0,0 +1,38 @@
+from django.core.management.base import BaseCommand, CommandError
+
+import common.models as m
+import runner.build as build
+import runner.cache as cache
+import runner.metrics as metrics
+from runner.models import CachedResult
+
+
+class Command(BaseCommand):
+    help = "Show how well the test result cache is doing, or clear it and the build cache"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--clear', action='store_true',
+                            help="Forget cached results, e.g. after the test environment changed")
+        parser.add_argument('--coursework', default=None,
+                            help="Only clear results for the coursework with this ID")
+
+    def handle(self, *args, **options):
+        coursework = None
+        if options['coursework'] is not None:
+            coursework = m.Coursework.objects.filter(id=options['coursework']).first()
+            if coursework is None:
+                raise CommandError("No coursework with ID %s" % options['coursework'])
+        if options['clear']:
+            count = cache.invalidate(coursework)
+            self.stdout.write("Removed %d cached results" % count)
+            if coursework is None:
+                build.clear()
+                self.stdout.write("Removed all cached builds")
+            return
+        hits = metrics.total(metrics.CACHE_LOOKUPS, result='hit')
+        misses = metrics.total(metrics.CACHE_LOOKUPS, result='miss')
+        self.stdout.write("Cached results: %d" % CachedResult.objects.count())
+        self.stdout.write("Hits: %d" % hits)
+        self.stdout.write("Misses: %d" % misses)
+        if hits + misses > 0:
+            self.stdout.write("Hit rate: %.1f%%" % (100.0 * hits / (hits + misses)))
@@ -0,0 +1,32 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import common.models as m
+import runner.jobs as jobs
+from runner.worker import Worker
+
+
+class Command(BaseCommand):
+    help = "Queue every test match of a coursework that hasn't been run, and run them all now"
+
+    def add_arguments(self, parser):
+        parser.add_argument('coursework', help="ID of the coursework")
+        parser.add_argument('--processes', type=int, default=settings.RUNNER_WORKER_PROCESSES,
+                            help="How many tests to run at once")
+        parser.add_argument('--poll', type=float, default=settings.RUNNER_POLL_SECONDS,
+                            help="Seconds to wait for a running test before checking again")
+
+    def handle(self, *args, **options):
+        coursework = m.Coursework.objects.filter(id=options['coursework']).first()
+        if coursework is None:
+            raise CommandError("No coursework with ID %s" % options['coursework'])
+        queued = jobs.enqueue_unrun_in_coursework(coursework)
+        self.stdout.write("Queued %d test matches for %s" % (queued, coursework))
+
+        def report():
+            progress = jobs.coursework_progress(coursework)
+            self.stdout.write("%d done, %d running, %d remaining, %d failed" % progress)
+
+        worker = Worker(options['processes'], coursework=coursework)
+        worker.run(options['poll'], drain=True, report=report)
+        report()
@@ -0,0 +1,30 @@
+import signal
+import sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from runner.worker import Worker
+
+
+class Command(BaseCommand):
+    help = "Run the test matches waiting on the job queue, a bounded number at a time"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=int, default=settings.RUNNER_WORKER_PROCESSES,
+                            help="How many tests to run at once")
+        parser.add_argument('--poll', type=float, default=settings.RUNNER_POLL_SECONDS,
+                            help="Seconds to wait between checks of an empty queue")
+        parser.add_argument('--worker-id', default=None,
+                            help="Name recorded against claimed jobs, defaults to host:pid")
+        parser.add_argument('--drain', action='store_true',
+                            help="Exit once the queue is empty instead of waiting for more")
+
+    def handle(self, *args, **options):
+        worker = Worker(options['processes'], options['worker_id'])
+        # stop as for ^C when the service is stopped, so unfinished jobs are put back
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        try:
+            worker.run(options['poll'], drain=options['drain'])
+        except KeyboardInterrupt:
+            self.stdout.write("Stopping test worker %s" % worker.worker_id)
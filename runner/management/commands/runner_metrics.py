@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+import runner.metrics as metrics
+
+
+class Command(BaseCommand):
+    help = "Print the test runner's metrics in the Prometheus text format, or reset them"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--reset', action='store_true',
+                            help="Forget every counter and histogram after printing them")
+
+    def handle(self, *args, **options):
+        self.stdout.write(metrics.exposition(), ending='')
+        if options['reset']:
+            count = metrics.reset()
+            self.stderr.write("Removed %d metric series" % count)
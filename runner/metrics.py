@@ -0,0 +1,178 @@
+"""Counters and latency histograms for the runner, kept in the database so
+that every worker process on every machine adds to the same series, and
+exposed in the Prometheus text format by the teacher metrics page and
+`manage.py runner_metrics`. Most series are labelled with the coursework
+and its execute script."""
+
+import re
+
+from django.db import IntegrityError, transaction
+from django.db.models import Count, F
+
+from runner.models import RunnerMetric, TestJob, JobState
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+GAUGE = 'gauge'
+
+TESTS = 'runner_tests_total'
+CACHE_LOOKUPS = 'runner_result_cache_lookups_total'
+QUEUE_WAIT = 'runner_queue_wait_seconds'
+STAGE = 'runner_stage_seconds'
+BUILD = 'runner_build_seconds'
+RUN = 'runner_run_seconds'
+JOBS = 'runner_jobs'
+
+METRICS = {
+    TESTS: (COUNTER, "Tests run, by outcome: success, failure, timeout (101) or error (102)"),
+    CACHE_LOOKUPS: (COUNTER, "Result cache lookups, by whether they hit"),
+    QUEUE_WAIT: (HISTOGRAM, "Time from a job being queued to a worker claiming it"),
+    STAGE: (HISTOGRAM, "Time to put a test's files into its workspace"),
+    BUILD: (HISTOGRAM, "Time to run a build script, when its output wasn't cached"),
+    RUN: (HISTOGRAM, "Time to run a test"),
+    JOBS: (GAUGE, "Jobs on the queue, by state"),
+}
+
+# Upper bounds of the histogram buckets, in seconds
+BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300]
+
+# The bound of a histogram bucket in its series name
+BOUND = re.compile(r'[{,]le="([^"]*)"')
+
+# What a test's exit code says about how it went
+OUTCOMES = {0: 'success', 101: 'timeout', 102: 'error'}
+
+
+def escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def series(name, labels):
+    """The text format name of the series @name with the dict of @labels"""
+    if not labels:
+        return name
+    return name + '{' + ','.join('%s="%s"' % (k, escape(v)) for k, v in sorted(labels.items())) + '}'
+
+
+def test_labels(coursework):
+    """The labels of the series about running a test for @coursework"""
+    return {'coursework': coursework.id, 'script': coursework.execute_script}
+
+
+def add(names, amount):
+    """Add @amount to each of the series @names, creating any that are new"""
+    with transaction.atomic():
+        updated = RunnerMetric.objects.filter(series__in=names).update(value=F('value') + amount)
+        if updated == len(names):
+            return
+        existing = set(RunnerMetric.objects.filter(series__in=names).values_list('series', flat=True))
+        for name in set(names) - existing:
+            try:
+                with transaction.atomic():
+                    RunnerMetric.objects.create(series=name, value=amount)
+            except IntegrityError:
+                RunnerMetric.objects.filter(series=name).update(value=F('value') + amount)
+
+
+def increment(name, labels, amount=1):
+    """Add @amount to the counter @name with @labels"""
+    add([series(name, labels)], amount)
+
+
+def observe(name, labels, seconds):
+    """Record that something took @seconds in the histogram @name with @labels.
+    Only the bucket that @seconds falls in is written, along with the sum
+    and count; exposition adds the buckets up, see cumulative_buckets"""
+    bound = next((bound for bound in BUCKETS if seconds <= bound), None)
+    bucket = series(name + '_bucket', dict(labels, le='+Inf' if bound is None else repr(float(bound))))
+    add([series(name + '_count', labels), bucket], 1)
+    add([series(name + '_sum', labels)], seconds)
+
+
+def record_test(labels, error_level, timings):
+    """Count a test with @labels that ended with @error_level, and
+    record its @timings, a dict of STAGE, BUILD and RUN to seconds"""
+    outcome = OUTCOMES.get(error_level, 'failure')
+    increment(TESTS, dict(labels, outcome=outcome))
+    for name, seconds in timings.items():
+        observe(name, labels, seconds)
+
+
+def value(name, labels):
+    """The current value of the series @name with @labels, 0 if it is new"""
+    metric = RunnerMetric.objects.filter(series=series(name, labels)).first()
+    return 0 if metric is None else metric.value
+
+
+def total(name, **labels):
+    """The sum of the counter @name over all of its series that have @labels"""
+    metrics = RunnerMetric.objects.filter(series__startswith=name + '{')
+    for label in sorted(labels.items()):
+        metrics = metrics.filter(series__contains='%s="%s"' % (label[0], escape(label[1])))
+    return sum(metrics.values_list('value', flat=True))
+
+
+def base_name(series_name):
+    name = series_name.split('{')[0]
+    for suffix in ['_bucket', '_sum', '_count']:
+        if name.endswith(suffix) and name[:-len(suffix)] in METRICS:
+            return name[:-len(suffix)]
+    return name
+
+
+def exposition():
+    """All the metrics, in the Prometheus text format"""
+    values = cumulative_buckets({metric.series: metric.value for metric in RunnerMetric.objects.all()})
+    states = dict(JobState.POSSIBLE_STATES)
+    counts = dict(TestJob.objects.values_list('state').annotate(Count('pk')))
+    for state in states:
+        values[series(JOBS, {'state': state})] = counts.get(state, 0)
+    by_metric = {}
+    for name in values:
+        by_metric.setdefault(base_name(name), []).append(name)
+    lines = []
+    for metric in sorted(by_metric):
+        if metric in METRICS:
+            lines.append("# HELP %s %s" % (metric, METRICS[metric][1]))
+            lines.append("# TYPE %s %s" % (metric, METRICS[metric][0]))
+        for name in sorted(by_metric[metric], key=bucket_order):
+            lines.append("%s %s" % (name, format_value(values[name])))
+    return '\n'.join(lines) + '\n'
+
+
+def cumulative_buckets(values):
+    """The buckets of each histogram in @values, a dict of series to their
+    values, hold how many observations fell in them. @return @values with
+    those replaced by the cumulative counts of the text format, with every
+    bucket of a histogram written"""
+    histograms = {}
+    for name in [name for name in values if '_bucket{' in name]:
+        bound = BOUND.search(name)
+        if bound is not None:
+            key = (name[:bound.start(1)], name[bound.end(1):])
+            histograms.setdefault(key, {})[float(bound.group(1))] = values.pop(name)
+    for (before, after), counts in histograms.items():
+        running = 0
+        for bound in sorted(set(float(bound) for bound in BUCKETS + ['inf']) | set(counts)):
+            running += counts.get(bound, 0)
+            values[before + ('+Inf' if bound == float('inf') else repr(bound)) + after] = running
+    return values
+
+
+def bucket_order(series_name):
+    """Sort the buckets of a histogram by their bound, after its other series"""
+    if 'le="' not in series_name:
+        return series_name, 0.0
+    before, after = series_name.split('le="', 1)
+    bound = after.split('"', 1)[0]
+    return before, float('inf') if bound == '+Inf' else float(bound)
+
+
+def format_value(number):
+    return repr(int(number)) if float(number).is_integer() else repr(number)
+
+
+def reset():
+    """Forget every counter and histogram. @return how many series were removed"""
+    count, _ = RunnerMetric.objects.all().delete()
+    return count
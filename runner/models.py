@@ -0,0 +1,82 @@
+from django.contrib.auth.models import User
+from django.db import models as m
+
+import common.models as cm
+
+
+class JobState:
+    QUEUED = 'q'
+    RUNNING = 'r'
+    DONE = 'd'
+    FAILED = 'f'
+    POSSIBLE_STATES = (
+        (QUEUED, 'Waiting for a worker to pick it up'),
+        (RUNNING, 'Claimed by a worker and currently running'),
+        (DONE, 'Finished running, results have been stored'),
+        (FAILED, 'Could not be run by the worker'),
+    )
+
+
+class JobPriority:
+    """Jobs of a lower priority number are claimed first"""
+    SIGNATURE = 0
+    SELF = 1
+    PEER = 2
+    BULK = 3
+    POSSIBLE_PRIORITIES = (
+        (SIGNATURE, 'Signature test of a new solution'),
+        (SELF, 'Self test started by a student'),
+        (PEER, 'Peer test started by a student'),
+        (BULK, 'Run started by a teacher for many test matches'),
+    )
+
+
+# noinspection PyClassHasNoInit
+class TestJob(m.Model):
+    test_match = m.OneToOneField(cm.TestMatch, m.CASCADE, primary_key=True, related_name="job")
+    state = m.CharField(max_length=1,
+                        choices=JobState.POSSIBLE_STATES,
+                        default=JobState.QUEUED)
+    priority = m.IntegerField(choices=JobPriority.POSSIBLE_PRIORITIES, default=JobPriority.BULK)
+    # The student whose share of the workers this job uses, None for bulk runs
+    owner = m.ForeignKey(User, m.SET_NULL, null=True)
+    created = m.DateTimeField(auto_now_add=True)
+    claimed_by = m.CharField(max_length=128, null=True)
+    claimed_at = m.DateTimeField(null=True)
+    lease_expires = m.DateTimeField(null=True)
+    attempts = m.IntegerField(default=0)
+    finished = m.DateTimeField(null=True)
+
+    class Meta:
+        index_together = (('state', 'priority', 'created'),)
+
+    def __str__(self):
+        return "%s (%s)" % (self.test_match_id, self.get_state_display())
+
+
+# noinspection PyClassHasNoInit
+class CachedResult(m.Model):
+    """The outcome of running a test, keyed on a hash of exactly what
+    was run, so that identical test matches don't have to be run again"""
+    key = m.CharField(max_length=64, primary_key=True)
+    coursework = m.ForeignKey(cm.Coursework, m.CASCADE)
+    error_level = m.IntegerField()
+    output = m.TextField()
+    # The test cases found in the output, see runner.results.to_json
+    report = m.TextField(default='')
+    created = m.DateTimeField(auto_now_add=True)
+    hits = m.IntegerField(default=0)
+
+    def __str__(self):
+        return "%s - %s" % (self.coursework, self.key)
+
+
+# noinspection PyClassHasNoInit
+class RunnerMetric(m.Model):
+    """One counter or histogram series, keyed on its name and labels as
+    written in the Prometheus text format, see runner.metrics"""
+    series = m.CharField(max_length=255, primary_key=True)
+    value = m.FloatField(default=0)
+
+    def __str__(self):
+        return "%s %s" % (self.series, self.value)
@@ -0,0 +1,79 @@
+"""Keep test matches up to date with the submissions they use. For a
+coursework that opts in with rerun_on_new_version, a new version of a
+solution or test case makes the latest match of every test / solution
+pair it is part of stale. Once the new files are in place, each stale
+pair gets a new match at the latest versions, queued in one batch. If the
+new version has exactly the same files as the one a match used, the
+match is left alone."""
+
+from django.db import transaction
+from django.db.models import Q
+
+import common.models as m
+import feedback.models as fm
+import runner.cache as cache
+import runner.runner as r
+
+import logging
+logger = logging.getLogger("django")
+
+# Submissions whose new versions can make a match stale
+RERUN_TYPES = [m.SubmissionType.SOLUTION, m.SubmissionType.TEST_CASE]
+
+
+def version_incremented(sender, submission, **kwargs):
+    """Receiver for common.models.version_incremented"""
+    if submission.type not in RERUN_TYPES or not submission.coursework.rerun_on_new_version:
+        return
+    transaction.on_commit(lambda: rerun_stale_matches(submission.id))
+
+
+def rerun_stale_matches(submission_id):
+    """Create and schedule the matches that bring every pair the
+    submission with @submission_id is part of up to date"""
+    submission = m.Submission.objects.get(id=submission_id)
+    new_tms = create_stale_matches(submission)
+    r.schedule_tests(new_tms)
+    logger.info("Re-running %d test matches for new version %d of %s" %
+                (len(new_tms), submission.latest_version, submission.id))
+    return new_tms
+
+
+@transaction.atomic
+def create_stale_matches(submission):
+    """For each test / solution pair that @submission is part of, whose
+    latest match used an older version of it with different files,
+    create a match of the latest versions, with the same type and access
+    control. @return the list of new test matches"""
+    latest = {}
+    for tm in m.TestMatch.objects.filter(Q(solution=submission) | Q(test=submission)) \
+            .select_related('test', 'solution').order_by('timestamp'):
+        latest[(tm.test_id, tm.solution_id, tm.type)] = tm
+    digests = {}
+
+    def digest(version):
+        if version not in digests:
+            digests[version] = cache.version_digest(submission, version)
+        return digests[version]
+
+    stale = []
+    for tm in latest.values():
+        used = tm.solution_version if tm.solution_id == submission.id else tm.test_version
+        if used == submission.latest_version or digest(used) == digest(submission.latest_version):
+            continue
+        stale.append(tm)
+    access = {tac.test_id: tac for tac in
+              fm.TestAccessControl.objects.filter(test__in=[tm.id for tm in stale])}
+    new_tms = m.bulk_create_with_new_slugs(m.TestMatch, [
+        m.TestMatch(test=tm.test,
+                    test_version=tm.test.latest_version,
+                    solution=tm.solution,
+                    solution_version=tm.solution.latest_version,
+                    coursework_id=tm.coursework_id,
+                    type=tm.type)
+        for tm in stale])
+    fm.TestAccessControl.objects.bulk_create([
+        fm.TestAccessControl(test=new_tm, group_id=access[tm.id].group_id,
+                             initiator_id=access[tm.id].initiator_id)
+        for tm, new_tm in zip(stale, new_tms) if tm.id in access])
+    return new_tms
@@ -0,0 +1,173 @@
+"""Turn the output of a test run into one row per test case, so results
+can be counted without reading logs. Understands JUnit XML reports
+written as TEST-*.xml to the directory named by TEST_REPORTS_DIR, the
+verbose and plain text output of python's unittest, and the text output
+of JUnitCore. Output it doesn't recognise gives no cases and no counts.
+Reports are never read from the workspace, as it holds files students
+uploaded, which could include a made up report."""
+
+import glob
+import json
+import os
+import re
+import xml.etree.ElementTree as ET
+from collections import namedtuple
+
+import common.models as m
+
+# One test case: its name, TestStatus, seconds it took if known, and why it didn't pass
+Case = namedtuple('Case', ['name', 'status', 'duration', 'message'])
+
+# The cases found in a run, and how many tests ran and passed, None if unknown
+Report = namedtuple('Report', ['cases', 'run', 'passed'])
+
+EMPTY = Report([], None, None)
+
+# Characters kept of the reason a test didn't pass
+MESSAGE_LENGTH = 1000
+
+# The environment variable that tells an execute script where to write JUnit XML reports
+REPORTS_VARIABLE = 'TEST_REPORTS_DIR'
+
+# JUnit XML reports bigger than this aren't read
+XML_REPORT_LIMIT = 16 * 1024 * 1024
+
+UNITTEST_STATUSES = {
+    'ok': m.TestStatus.PASS,
+    'FAIL': m.TestStatus.FAIL,
+    'ERROR': m.TestStatus.ERROR,
+    'expected failure': m.TestStatus.PASS,
+    'unexpected success': m.TestStatus.FAIL,
+}
+
+UNITTEST_CASE = re.compile(r'^(\w+) \(([\w.]+)\)(?:\n[^\n]*?)? \.\.\. ?(.*)$', re.MULTILINE)
+UNITTEST_SECTION = re.compile(r'^={70}\n(FAIL|ERROR): (\w+) \(([\w.]+)\)[^\n]*\n-{70}\n(.*?)(?=^={70}$|^-{70}$|\Z)',
+                              re.MULTILINE | re.DOTALL)
+UNITTEST_RAN = re.compile(r'^Ran (\d+) tests? in [\d.]+s$', re.MULTILINE)
+UNITTEST_OUTCOME = re.compile(r'^(?:OK|FAILED)(?: \((.*)\))?$', re.MULTILINE)
+
+JUNIT_FAILURE = re.compile(r'^\d+\) (\w+)\(([\w.$]+)\)\n([^\n]*)', re.MULTILINE)
+JUNIT_OK = re.compile(r'^OK \((\d+) tests?\)$', re.MULTILINE)
+JUNIT_FAILED = re.compile(r'^Tests run: (\d+),\s+Failures: (\d+)$', re.MULTILINE)
+
+
+def message(text):
+    return text.strip()[:MESSAGE_LENGTH]
+
+
+def last_line(text):
+    lines = [line for line in text.strip().splitlines() if line.strip()]
+    return lines[-1] if lines else ''
+
+
+def full_name(name, cls):
+    """The name of test @name of class @cls, which newer
+    pythons already end with the test's name"""
+    return cls if cls.endswith('.' + name) else "%s.%s" % (cls, name)
+
+
+def parse_junit_xml(paths):
+    """@return a Report of the JUnit XML reports at @paths"""
+    cases = []
+    for path in paths:
+        if os.path.getsize(path) > XML_REPORT_LIMIT:
+            continue
+        try:
+            root = ET.parse(path).getroot()
+        except ET.ParseError:
+            continue
+        for case in root.iter('testcase'):
+            name = "%s.%s" % (case.get('classname'), case.get('name')) if case.get('classname') else case.get('name')
+            try:
+                duration = float(case.get('time'))
+            except (TypeError, ValueError):
+                duration = None
+            status, reason = m.TestStatus.PASS, ''
+            for tag, tag_status in [('failure', m.TestStatus.FAIL), ('error', m.TestStatus.ERROR),
+                                    ('skipped', m.TestStatus.SKIP)]:
+                found = case.find(tag)
+                if found is not None:
+                    status, reason = tag_status, found.get('message') or found.text or ''
+                    break
+            cases.append(Case(name or '', status, duration, message(reason)))
+    if not cases:
+        return EMPTY
+    run = sum(1 for case in cases if case.status != m.TestStatus.SKIP)
+    return Report(cases, run, sum(1 for case in cases if case.status == m.TestStatus.PASS))
+
+
+def parse_unittest(output):
+    """@return a Report of the @output of python's unittest, or None if it isn't one"""
+    ran = UNITTEST_RAN.search(output)
+    if ran is None:
+        return None
+    reasons = {}
+    for status, name, cls, body in UNITTEST_SECTION.findall(output):
+        reasons[full_name(name, cls)] = (UNITTEST_STATUSES[status], message(last_line(body)))
+    cases = []
+    for name, cls, result in UNITTEST_CASE.findall(output):
+        case_name = full_name(name, cls)
+        result = result.strip()
+        if result.startswith('skipped'):
+            cases.append(Case(case_name, m.TestStatus.SKIP, None, message(result[len('skipped'):].strip(" '"))))
+        else:
+            # a test that printed has its result on a later line, failures are named again below
+            status, reason = reasons.get(case_name, (UNITTEST_STATUSES.get(result, m.TestStatus.PASS), ''))
+            cases.append(Case(case_name, status, None, reason))
+    named = {case.name for case in cases}
+    # without -v, only the tests that didn't pass are named
+    for case_name, (status, reason) in sorted(reasons.items()):
+        if case_name not in named:
+            cases.append(Case(case_name, status, None, reason))
+    run = int(ran.group(1))
+    counts = {}
+    outcome = UNITTEST_OUTCOME.search(output, ran.end())
+    if outcome is not None and outcome.group(1):
+        for part in outcome.group(1).split(','):
+            key, _, value = part.strip().partition('=')
+            if value.isdigit():
+                counts[key] = int(value)
+    not_passed = counts.get('failures', 0) + counts.get('errors', 0) + counts.get('unexpected successes', 0)
+    run -= counts.get('skipped', 0)
+    return Report(cases, run, max(run - not_passed, 0))
+
+
+def parse_junitcore(output):
+    """@return a Report of the @output of JUnitCore, or None if it isn't one"""
+    passed = JUNIT_OK.search(output)
+    if passed is not None:
+        return Report([], int(passed.group(1)), int(passed.group(1)))
+    failed = JUNIT_FAILED.search(output)
+    if failed is None:
+        return None
+    cases = []
+    for name, cls, reason in JUNIT_FAILURE.findall(output):
+        status = m.TestStatus.FAIL if 'AssertionError' in reason or 'ComparisonFailure' in reason \
+            else m.TestStatus.ERROR
+        cases.append(Case(full_name(name, cls), status, None, message(reason)))
+    run, failures = int(failed.group(1)), int(failed.group(2))
+    return Report(cases, run, max(run - failures, 0))
+
+
+def parse(output_file, reports_dir=None):
+    """@return the Report of a run whose output is in @output_file,
+    preferring any JUnit XML reports it wrote to @reports_dir"""
+    if reports_dir is not None:
+        reports = sorted(glob.glob(os.path.join(reports_dir, '**', 'TEST-*.xml'), recursive=True))
+        if reports:
+            return parse_junit_xml(reports)
+    with open(output_file, encoding='utf-8', errors='replace') as f:
+        output = f.read()
+    return parse_unittest(output) or parse_junitcore(output) or EMPTY
+
+
+def to_json(report):
+    return json.dumps([report.cases, report.run, report.passed])
+
+
+def from_json(text):
+    """The Report written by to_json as @text, EMPTY for old cache entries"""
+    if not text:
+        return EMPTY
+    cases, run, passed = json.loads(text)
+    return Report([Case(*case) for case in cases], run, passed)
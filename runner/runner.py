@@ -1,85 +1,214 @@
 import threading
+from concurrent.futures import ThreadPoolExecutor
 from django.db import transaction
 import common.models as m
 import test_match.matcher as matcher
+import runner.jobs as jobs
+import runner.cache as cache
+import runner.build as build
+import runner.hosts as hosts
+import runner.staging as staging
+import runner.limits as rl
+import runner.capture as capture
+import runner.metrics as metrics
+import runner.results as results
 import os
 import tempfile
-import re
 import shutil
+import signal
 import subprocess
+import time
 from django.conf import settings
 
 
-def execute_test(sols_dir, test_dir, execute_script):
+def execute_test(sols_dir, test_dir, execute_script, limits):
     """Execute test
     @sols_dir - path to where solution files located
     @test_dir - path to where testing files located
     @execute_script - point to a file in lib dir that
        executes the test and any additional steps
-       like compilation or editing"""
+       like compilation or editing. If the script has a
+       companion build script, its output is cached
+    @limits - the coursework's execution profile, see runner.limits
+    @return the exit code, the path of a file holding the output,
+       which the caller must remove, the ExecutionLimit that
+       stopped the test, if one did, a dict of how many seconds
+       each step took, see runner.metrics.record_test, and the
+       runner.results.Report of its test cases"""
+    timings = {}
     tmp_dir = prepare_temp_directory()
-    copy_all(sols_dir, tmp_dir)
-    copy_all(test_dir, tmp_dir)
-    lib_dir = os.path.join(settings.BASE_DIR, 'libs')
-    args = [execute_script, tmp_dir, lib_dir]
-    proc = subprocess.Popen(" ".join(args), cwd=tmp_dir,
-                            stdout=subprocess.PIPE,
-                            stderr=subprocess.PIPE,
-                            shell=True)
+    # outside the workspace, so no uploaded file can pass for a report
+    reports_dir = tempfile.mkdtemp(prefix='reports-', dir=staging.scratch_root())
     try:
-        outb, errb = proc.communicate(timeout=30)
-        code = proc.returncode
-        output = process_output(outb, errb, 'Result')
-    except subprocess.TimeoutExpired:
-        proc.kill()
-        output = process_output(outb,errb,"Time Out")
-        code = 101
-    except (OSError, subprocess.CalledProcessError) as exception:
-        output = "Execution error: "+str(exception)
-        code = 102
+        started = time.monotonic()
+        copy_all(sols_dir, tmp_dir)
+        copy_all(test_dir, tmp_dir)
+        timings[metrics.STAGE] = time.monotonic() - started
+        lib_dir = os.path.join(settings.BASE_DIR, 'libs')
+        args = [execute_script, tmp_dir, lib_dir]
+        built_dir = None
+        build_script = build.build_script_for(execute_script)
+        if build_script is not None:
+            outcome, built_dir = build_once(sols_dir, test_dir, build_script, tmp_dir, lib_dir,
+                                            limits, timings)
+            if built_dir is None:
+                return outcome + (timings, results.EMPTY)
+            args.append(built_dir)
+        started = time.monotonic()
+        host_kind = hosts.kind_for(execute_script, limits)
+        if host_kind == hosts.PYTHON or (host_kind == hosts.JUNIT and built_dir is not None):
+            outcome = hosts.run(host_kind, tmp_dir, built_dir, limits)
+        else:
+            outcome = run_script(args, tmp_dir, limits, {results.REPORTS_VARIABLE: reports_dir})
+        timings[metrics.RUN] = time.monotonic() - started
+        return outcome + (timings, results.parse(outcome[1], reports_dir))
     finally:
         shutil.rmtree(tmp_dir)
-        return proc.returncode, output
+        shutil.rmtree(reports_dir)
+
+
+def build_once(sols_dir, test_dir, build_script, tmp_dir, lib_dir, limits, timings):
+    """Run @build_script over the files staged in @tmp_dir, unless this
+    exact set of sources from @sols_dir and @test_dir has been built before,
+    noting in @timings how long it took if it ran.
+    @return the outcome of a failed build as run_script does, or None, and
+    the directory holding what was built, which is None if the build failed"""
+    key = build.build_key(sols_dir, test_dir, build_script)
+    built_dir = build.cached_build(key)
+    if built_dir is not None:
+        return None, built_dir
+    staging_dir = build.new_staging_dir(key)
+    started = time.monotonic()
+    outcome = run_script([build_script, tmp_dir, lib_dir, staging_dir], tmp_dir, limits)
+    timings[metrics.BUILD] = time.monotonic() - started
+    if outcome[0] != 0:
+        shutil.rmtree(staging_dir)
+        return outcome, None
+    os.remove(outcome[1])
+    return None, build.publish(staging_dir, key)
+
+
+def run_script(args, cwd, limits, env=None):
+    """Run the command line @args in @cwd within @limits, killing it and
+    anything it started if it takes too long, with the variables in the
+    dict @env added to its environment. Its output is streamed to a new
+    file, see runner.capture. @return its exit code, the path of that
+    file and the ExecutionLimit that stopped it, if one did"""
+    output = capture.new_output_file()
+    try:
+        with rl.Sandbox(limits) as sandbox:
+            proc = subprocess.Popen(" ".join(args), cwd=cwd,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.STDOUT,
+                                    shell=True,
+                                    start_new_session=True,
+                                    env=dict(os.environ, **(env or {})),
+                                    preexec_fn=sandbox.preexec)
+            with proc.stdout:
+                captured = capture.OutputCapture(output, capture.output_limit(limits), markers=rl.MARKERS)
+                finished = captured.copy_from(proc.stdout, time.monotonic() + limits.wall)
+                if not finished:
+                    os.killpg(proc.pid, signal.SIGKILL)
+                    captured.copy_from(proc.stdout, time.monotonic() + capture.DRAIN_SECONDS)
+            proc.wait()
+            if not finished:
+                captured.close("Time Out")
+                return 101, output, m.ExecutionLimit.WALL_TIME
+            captured.close()
+            return proc.returncode, output, sandbox.exceeded(proc.returncode, False, captured)
+    except (OSError, subprocess.CalledProcessError) as exception:
+        os.remove(output)
+        return 102, capture.text_file("Execution error: " + str(exception)), None
+
 
 def prepare_temp_directory():
     """Create or clean up a temporary
     working directory at @path"""
-    tmp_dir = tempfile.mkdtemp()
+    tmp_dir = tempfile.mkdtemp(dir=staging.scratch_root())
     init_dir = os.path.join(tmp_dir, '__init__.py')
     with open(init_dir, 'w+') as f:
         f.write('')
     return tmp_dir
 
-def process_output(outb,errb,message):
-    outs = "" if outb is None else outb.decode('utf-8')
-    errs = "" if errb is None else errb.decode('utf-8')
-    output = message + ": \n" + outs + errs
-    return output
 
 def copy_all(paths, tmp_dir):
-    """for list of at @path,
+    """for list of at @path, link or
     copy them to @tmp_dir"""
-    for file in os.listdir(paths):
-        full_src_path = os.path.join(paths, file)
-        if os.path.isfile(full_src_path):
-            full_dst_path = os.path.join(tmp_dir, file)
-            shutil.copy(full_src_path, full_dst_path)
+    staging.stage_directory(paths, tmp_dir)
+
+
+def test_arguments(test_match):
+    """Work out what @test_match needs to be executed: the solution
+    and test directories, the fully qualified execute script and
+    the coursework's limits. @return None if the coursework has
+    nothing to execute"""
+    execute_script = test_match.coursework.execute_script
+    if execute_script == '':
+        return None
+    sols_dir = test_match.solution.originals_path(test_match.solution_version)
+    test_dir = test_match.test.originals_path(test_match.test_version)
+    fully_qualified_script = os.path.join(settings.BASE_DIR, 'libs', execute_script)
+    return sols_dir, test_dir, fully_qualified_script, rl.limits_for(test_match.coursework)
+
+
+def result_key(test_match, arguments):
+    """The cache key for executing @test_match with its @arguments
+    from test_arguments, hashing its versions from their manifests"""
+    execute_script, limits = arguments[2:]
+    return cache.result_key(test_match.coursework,
+                            cache.version_digest(test_match.solution, test_match.solution_version),
+                            cache.version_digest(test_match.test, test_match.test_version),
+                            execute_script, build.build_script_for(execute_script), limits,
+                            hosts.kind_for(execute_script, limits))
+
+
+def record_result(test_match, error_level, result_file=None, cache_key=None, limit_exceeded=None,
+                  timings=None, report=results.EMPTY):
+    """Store the @error_level of running @test_match, the limit, if any,
+    that stopped it, the output in @result_file and the @report of its
+    test cases. If a @cache_key is given and no limit was hit, cache
+    them for identical test matches. If it was executed, count it in the
+    metrics along with its @timings, once any transaction this is part of
+    has committed, so that no locks are held while the shared metric rows
+    are written"""
+    test_match.set_error_level(error_level, limit_exceeded)
+    if timings is not None:
+        labels = metrics.test_labels(test_match.coursework)
+        transaction.on_commit(lambda: metrics.record_test(labels, error_level, timings))
+    if result_file is not None:
+        output = capture.read_text(result_file)
+        if cache_key is not None and limit_exceeded is None:
+            cache.store(cache_key, test_match.coursework, error_level, output, report)
+        test_match.store_results(output, *report)
+
+
+def use_cached_result(test_match, cache_key):
+    """If a test identical to @test_match, given its @cache_key, has
+    already been run, record that result. @return bool if it was"""
+    cached = cache.lookup(cache_key, test_match.coursework, metrics.test_labels(test_match.coursework))
+    if cached is None:
+        return False
+    test_match.set_error_level(cached.error_level)
+    test_match.store_results(cached.output, *results.from_json(cached.report))
+    return True
+
 
 def run_test_in_thread(test_match):
     """Look at the specified @test_match, acquire the relevant files for
     the testing to happen, and then determine which execution / testing
     module should be used ot test it and execute appropriately"""
-    solutions = test_match.solution.get_files()
-    sols_dir = test_match.solution.originals_path()
-    test_dir = test_match.test.originals_path()
-    execute_script = test_match.coursework.execute_script
-    if execute_script != '':
-        fully_qualified_script = os.path.join(settings.BASE_DIR, 'libs', execute_script)
-        error_level, result = execute_test(sols_dir, test_dir, fully_qualified_script)
-        test_match.set_error_level(error_level)
-        test_match.store_results(result)
-    else:
-        test_match.set_error_level(0)
+    arguments = test_arguments(test_match)
+    if arguments is None:
+        record_result(test_match, 0)
+        return
+    cache_key = result_key(test_match, arguments)
+    if not use_cached_result(test_match, cache_key):
+        error_level, result_file, limit_exceeded, timings, report = execute_test(*arguments)
+        try:
+            record_result(test_match, error_level, result_file, cache_key, limit_exceeded, timings, report)
+        finally:
+            if os.path.exists(result_file):
+                os.remove(result_file)
 
 
 def run_test_on_thread(test_instance):
@@ -89,19 +218,50 @@ def run_test_on_thread(test_instance):
     running.start()
 
 
+def schedule_test(test_instance):
+    """Arrange for @test_instance to be run. This puts it on the job
+    queue for the test workers, or if the queue is turned off in
+    settings, falls back to running it on a thread of this process"""
+    if settings.RUNNER_USE_JOB_QUEUE:
+        jobs.enqueue(test_instance)
+    else:
+        run_test_on_thread(test_instance)
+
+
+def run_tests_in_thread(test_matches):
+    """Run each of @test_matches, several at a time"""
+    with ThreadPoolExecutor(max_workers=settings.RUNNER_WORKER_PROCESSES) as pool:
+        for test_match in test_matches:
+            pool.submit(run_test_in_thread, test_match)
+
+
+def schedule_tests(test_matches, bulk=False):
+    """Arrange for a batch of newly created @test_matches to be run,
+    as schedule_test does for one. A @bulk batch, e.g. one a teacher
+    started, waits for the tests students started"""
+    if settings.RUNNER_USE_JOB_QUEUE:
+        jobs.enqueue_batch(test_matches, bulk)
+    else:
+        running = threading.Thread(target=run_tests_in_thread, args=(test_matches,))
+        running.start()
+
+
 def run_queued_tests_in_thread(coursework):
     """go through all of the test data instances that are
-    tagged as waiting to run for @coursework, and run them"""
-    while False:
-        tests = m.TestMatch.objects.filter(coursework=coursework, error_level=None)
-        if tests.count() == 0:
-            return
-        for test in tests:
-            run_test_in_thread(test)
+    tagged as waiting to run for @coursework, and run them,
+    several at a time"""
+    tests = m.TestMatch.objects.select_related(
+        'coursework', 'test__coursework__course', 'solution__coursework__course',
+        'test__creator', 'solution__creator'
+    ).filter(coursework=coursework, error_level=None)
+    run_tests_in_thread(tests.iterator())
 
 
 def run_queued_tests_on_thread(coursework):
-    """Run all queued test sin @coursework, but on a new thread"""
+    """Run all queued tests in @coursework. With the job queue these are
+    handed to the test workers, otherwise they are run on a new thread"""
+    if settings.RUNNER_USE_JOB_QUEUE:
+        return jobs.enqueue_unrun_in_coursework(coursework)
     running = threading.Thread(target=run_queued_tests_in_thread, args=(coursework,))
     running.start()
 
@@ -111,4 +271,4 @@ def run_signature_test(solution):
     and we wish to run it against the appropriate
     signature test for that coursework"""
     tm = matcher.create_self_test_for_new_solution(solution)
-    run_test_on_thread(tm)
+    schedule_test(tm)
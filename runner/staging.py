@@ -0,0 +1,87 @@
+"""Put the files for a test run into its workspace as cheaply as the
+filesystem allows. The originals of a submission version never change,
+so rather than copying bytes, a workspace can share them:
+
+- 'reflink' clones the file (copy on write, e.g. btrfs or xfs), so the
+  workspace gets its own file that costs no data to make
+- 'link' hardlinks the original. Only use this when the tests can't
+  write to the originals, e.g. the worker runs as a user who only has
+  read access to var/uploads, as a test could otherwise change them
+- 'copy' copies the bytes, and always works
+
+The methods in RUNNER_STAGING_METHODS are tried in order. One that
+fails between a pair of filesystems isn't tried between them again."""
+
+import errno
+import fcntl
+import os
+import shutil
+import stat
+
+from django.conf import settings
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Errors that mean a method can't work between two filesystems
+UNSUPPORTED = {errno.EXDEV, errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL,
+               errno.EPERM, errno.EMLINK, errno.ENOSYS}
+
+_unsupported = set()
+
+
+def reflink(src, dst):
+    with open(src, 'rb') as source, open(dst, 'wb') as destination:
+        fcntl.ioctl(destination.fileno(), FICLONE, source.fileno())
+
+
+def link(src, dst):
+    os.link(src, dst)
+
+
+def copy(src, dst):
+    shutil.copy(src, dst)
+    # blobs are read only, see common.blobs, but a workspace's own copy needn't be
+    os.chmod(dst, os.stat(dst).st_mode | stat.S_IWUSR)
+
+
+METHODS = {'reflink': reflink, 'link': link, 'copy': copy}
+
+
+def stage_file(src, dst, devices):
+    """Put the file at @src into a workspace at @dst, using the first
+    staging method that works between the pair of filesystem @devices.
+    A file already at @dst is replaced, never written through, as it may
+    be a link to another submission's original"""
+    if os.path.lexists(dst):
+        os.remove(dst)
+    for name in settings.RUNNER_STAGING_METHODS:
+        if (name, devices) in _unsupported:
+            continue
+        try:
+            METHODS[name](src, dst)
+            return name
+        except OSError as exception:
+            if exception.errno not in UNSUPPORTED or name == 'copy':
+                raise
+            _unsupported.add((name, devices))
+            if os.path.lexists(dst):
+                os.remove(dst)
+    copy(src, dst)
+    return 'copy'
+
+
+def stage_directory(src_dir, dst_dir):
+    """Stage every file directly in @src_dir into @dst_dir"""
+    devices = (os.stat(src_dir).st_dev, os.stat(dst_dir).st_dev)
+    for entry in os.scandir(src_dir):
+        if entry.is_file():
+            stage_file(entry.path, os.path.join(dst_dir, entry.name), devices)
+
+
+def scratch_root():
+    """Where workspaces are made, e.g. a tmpfs, or None for the system default"""
+    root = settings.RUNNER_SCRATCH_ROOT
+    if root is not None:
+        os.makedirs(root, exist_ok=True)
+    return root
@@ -0,0 +1,170 @@
+"""A worker takes jobs off the queue and runs them through a fixed size
+pool of processes, so the number of tests being compiled and executed
+at once is bounded by the pool rather than by how many were submitted.
+Only the pool processes run tests; the database is only ever touched
+from the worker's own process.
+
+Any number of workers, on any number of machines, can share the queue,
+as long as they share the database and the upload directory. A worker
+renews the leases on the jobs it is running every
+RUNNER_HEARTBEAT_SECONDS. If it dies, its leases run out and other
+workers reclaim its jobs. A worker that has lost a job's lease doesn't
+record its result."""
+
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from django import db
+from django.conf import settings
+from django.db import transaction
+
+import runner.capture as capture
+import runner.jobs as jobs
+import runner.metrics as metrics
+import runner.runner as r
+
+import logging
+logger = logging.getLogger("django")
+
+
+class Worker:
+    """Claims jobs from the queue and runs up to @processes of them at once.
+    If a @coursework is given, only jobs for that coursework are claimed"""
+    def __init__(self, processes, worker_id=None, coursework=None):
+        self.processes = processes
+        self.worker_id = worker_id if worker_id is not None else jobs.default_worker_id()
+        self.coursework = coursework
+        self.in_flight = {}
+        self.next_heartbeat = 0
+
+    def run(self, poll_seconds, drain=False, report=None):
+        """Keep running jobs, checking the queue every @poll_seconds when idle.
+        If @drain is set, return as soon as the queue has been emptied.
+        @report is called with no arguments whenever some jobs finish"""
+        logger.info("Test worker %s starting with %d processes" % (self.worker_id, self.processes))
+        # pool processes are forked from this one, don't let them share its connection
+        db.connections.close_all()
+        started = set()
+        try:
+            with ProcessPoolExecutor(max_workers=self.processes) as pool:
+                try:
+                    self.loop(pool, poll_seconds, drain, report)
+                finally:
+                    started = self.cancel_unstarted()
+        finally:
+            released = jobs.release_jobs(self.worker_id, started)
+            if released:
+                logger.info("Test worker %s put %d unfinished jobs back on the queue" %
+                            (self.worker_id, released))
+
+    def loop(self, pool, poll_seconds, drain, report):
+        """Hand jobs to the @pool and record their results, see run"""
+        while True:
+            claimed = self.fill(pool)
+            if not self.in_flight:
+                if claimed:
+                    continue
+                if drain:
+                    return
+                time.sleep(poll_seconds)
+                continue
+            done, _ = wait(self.in_flight, timeout=poll_seconds, return_when=FIRST_COMPLETED)
+            for future in done:
+                job, cache_key = self.in_flight[future]
+                self.complete(job, cache_key, future)
+                # only now, so a job whose result stopped the worker counts as started
+                del self.in_flight[future]
+            self.heartbeat()
+            if done and report is not None:
+                report()
+
+    def cancel_unstarted(self):
+        """Take back the jobs handed to the pool that it hasn't started.
+        @return the test match IDs of the jobs it may have started"""
+        return {job.test_match_id for future, (job, _) in self.in_flight.items() if not future.cancel()}
+
+    def heartbeat(self):
+        """Every RUNNER_HEARTBEAT_SECONDS, renew the leases on the jobs
+        being run, and warn about any that were lost"""
+        if time.monotonic() < self.next_heartbeat or not self.in_flight:
+            return
+        self.next_heartbeat = time.monotonic() + settings.RUNNER_HEARTBEAT_SECONDS
+        running = {job.test_match_id for job, _ in self.in_flight.values()}
+        for lost in running - jobs.extend_leases(self.worker_id, running):
+            logger.warning("Test worker %s lost its lease on %s, its result will be discarded" %
+                           (self.worker_id, lost))
+
+    def fill(self, pool):
+        """Claim enough jobs to keep every process in the @pool busy.
+        @return how many jobs were claimed"""
+        claimed = jobs.claim_jobs(self.worker_id, self.processes - len(self.in_flight),
+                                  self.coursework)
+        for job in claimed:
+            try:
+                arguments, cache_key = self.prepare(job)
+            except Exception as exception:
+                logger.error("Test worker %s failed to start %s: %s" %
+                             (self.worker_id, job, exception))
+                self.fail(job, exception)
+                continue
+            if arguments is not None:
+                self.in_flight[pool.submit(r.execute_test, *arguments)] = (job, cache_key)
+        return len(claimed)
+
+    def prepare(self, job):
+        """Work out what @job needs to be executed, finishing it straight
+        away if it has no need to be. @return its arguments to execute_test
+        and its cache key, or None and None if it was finished"""
+        test_match = job.test_match
+        metrics.observe(metrics.QUEUE_WAIT, metrics.test_labels(test_match.coursework),
+                        (job.claimed_at - job.created).total_seconds())
+        if test_match.has_been_run():
+            jobs.finish_job(job, self.worker_id)
+            return None, None
+        arguments = r.test_arguments(test_match)
+        if arguments is None:
+            r.record_result(test_match, 0)
+            jobs.finish_job(job, self.worker_id)
+            return None, None
+        cache_key = r.result_key(test_match, arguments)
+        if r.use_cached_result(test_match, cache_key):
+            jobs.finish_job(job, self.worker_id)
+            return None, None
+        return arguments, cache_key
+
+    def fail(self, job, exception):
+        """Record the @exception that stopped @job from being started as
+        an execution error, e.g. its execute script is missing, or if even
+        that can't be done mark the job as failed"""
+        result_file = capture.text_file("Execution error: " + str(exception))
+        try:
+            with transaction.atomic():
+                r.record_result(job.test_match, 102, result_file)
+                jobs.finish_job(job, self.worker_id)
+        except Exception as exception:
+            logger.error("Test worker %s failed to record the error of %s: %s" %
+                         (self.worker_id, job, exception))
+            jobs.finish_job(job, self.worker_id, failed=True)
+        finally:
+            os.remove(result_file)
+
+    def complete(self, job, cache_key, future):
+        """Record what the pool process running @job returned in @future"""
+        result_file = None
+        try:
+            error_level, result_file, limit_exceeded, timings, report = future.result()
+            with transaction.atomic():
+                if not jobs.holds_claim(job, self.worker_id):
+                    logger.warning("Test worker %s no longer holds %s, discarding its result" %
+                                   (self.worker_id, job))
+                    return
+                r.record_result(job.test_match, error_level, result_file, cache_key, limit_exceeded,
+                                timings, report)
+                jobs.finish_job(job, self.worker_id)
+        except Exception as exception:
+            logger.error("Test worker %s failed to run %s: %s" % (self.worker_id, job, exception))
+            jobs.finish_job(job, self.worker_id, failed=True)
+        finally:
+            if result_file is not None and os.path.exists(result_file):
+                os.remove(result_file)
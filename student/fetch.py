@@ -0,0 +1,317 @@
+"""Fetching the files of submissions from the students' GitLab projects"""
+
+import os
+import re
+import shutil
+import tarfile
+import tempfile
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import transaction
+
+import common.blobs as blobs
+import common.gitlab as gitlab
+import common.models as m
+import runner.cache as rc
+
+import requests
+from requests.packages.urllib3.exceptions import HTTPError as StreamError
+
+import logging
+logger = logging.getLogger("django")
+
+# What harvesting a student's project did
+NEW = 'new version'
+UNCHANGED = 'up to date'
+FAILED = 'failed'
+
+
+class GitlabFetchError(Exception):
+    """The files fetched from GitLab couldn't be used"""
+    pass
+
+
+class GitlabFetcher:
+    """Context manager which handles fetching gitlab files"""
+    def __init__(self, user, project, path_re, token=None, client=None):
+        """user A user object from django
+        @path A string project name in gitlab
+        Will be joined to fetch from /user/project in gitlab
+        Only files whose names match @path_re are kept
+        Uses the user's own gitlab login unless given another @token,
+        and the shared GitlabClient unless given another @client"""
+        self.user = user
+        self.project = project
+        self.token = token
+        self.gitlab = client or gitlab.client()
+        self.path = str(user) + '%2F' + str(project)
+        self.path_re = path_re
+        self.has_fetched = False
+        self.tmp_dir = None
+        self.files = {}
+        self.commit_sha = None
+
+    def api_params(self):
+        if self.token is not None:
+            return {'access_token': self.token}
+        social = self.user.social_auth.get(provider='gitlab')
+        return {'access_token': social.extra_data['access_token']}
+
+    def head_commit(self):
+        """Ask gitlab for the latest commit on the project's default
+        branch, which fetch_and_unpack will then fetch.
+        @return its sha, or None if gitlab doesn't say"""
+        response = self.gitlab.get(self.gitlab.project_url(self.user, self.project, "/repository/commits"),
+                                   params=dict(self.api_params(), per_page=1))
+        try:
+            commits = response.json() if response.status_code == 200 else []
+        except ValueError:
+            commits = []
+        if not commits or not isinstance(commits, list):
+            logger.info("No head commit for %s: %s" % (self.path, response.status_code))
+            return None
+        self.commit_sha = commits[0].get('id')
+        return self.commit_sha
+
+    def is_up_to_date(self, submission):
+        """@return True if the latest version of @submission was
+        fetched from the head commit, so there is nothing to download"""
+        if self.commit_sha is None:
+            return False
+        manifest = submission.manifest()
+        return manifest is not None and manifest.commit_sha == self.commit_sha
+
+    def record_commit(self, submission):
+        """Note that the latest version of @submission has the files
+        of the commit that was fetched"""
+        if self.commit_sha is not None:
+            m.SubmissionVersion.objects.filter(submission=submission, version=submission.latest_version) \
+                .update(commit_sha=self.commit_sha)
+
+    def fetch_and_unpack(self):
+        """fetch the archive of the project and, as it is
+        downloaded, unpack only the files matching path_re to a
+        temporary directory. use the context manager to
+        auto clean up
+        @returns a string of the tmp dir location"""
+        if self.has_fetched == True:
+            return self.tmp_dir
+        gitlab_params = self.api_params()
+        if self.token is None:
+            # Adding Peer-Testing to project as Reporter, which only the student can do
+            self.gitlab.add_reporter(self.user, self.project, gitlab_params)
+        # Fetching archive
+        gitlab_archive_req = self.gitlab.project_url(self.user, self.project, "/repository/archive.tar.gz")
+        if self.commit_sha is not None:
+            # the files of the commit that will be recorded, even if more have been pushed since
+            gitlab_params['sha'] = self.commit_sha
+        self.tmp_dir = tempfile.mkdtemp()
+        self.has_fetched = True
+        with self.gitlab.download(gitlab_archive_req, params=gitlab_params) as response:
+            if response.status_code != 200:
+                raise GitlabFetchError("GitLab answered %d for %s" % (response.status_code, self.path))
+            # undo any transfer encoding, leaving the .tar.gz itself
+            response.raw.decode_content = True
+            logger.info("Extracting files in dir: " + self.tmp_dir)
+            self.unpack(response.raw)
+        return self.tmp_dir
+
+    def unpack(self, stream):
+        """Read the tar.gz archive from @stream in one pass, writing the
+        files whose names match path_re to the tmp dir and hashing them
+        as they are written. Of several files with the same name, the
+        last one is kept. Nothing else in the archive touches the disk.
+        The download failing part way is a GitlabFetchError too"""
+        kept = 0
+        try:
+            with tarfile.open(fileobj=stream, mode='r|gz') as archive:
+                for member in archive:
+                    file_name = os.path.basename(member.name)
+                    if not member.isfile() or file_name in ('', '.', '..') \
+                            or not re.search(self.path_re, file_name):
+                        continue
+                    kept += member.size - self.files.get(file_name, (None, 0, None))[1]
+                    if kept > settings.GITLAB_FETCH_MAX_BYTES:
+                        raise GitlabFetchError("The files in %s are bigger than %d bytes"
+                                               % (self.path, settings.GITLAB_FETCH_MAX_BYTES))
+                    source = archive.extractfile(member)
+                    path = os.path.join(self.tmp_dir, file_name)
+                    with open(path, 'wb') as destination:
+                        size, sha256 = blobs.write(iter(lambda: source.read(65536), b''), destination)
+                    self.files[file_name] = (path, size, sha256)
+        except (tarfile.TarError, EOFError, StreamError, requests.RequestException) as e:
+            raise GitlabFetchError("Couldn't read the archive of %s: %s" % (self.path, e))
+
+    def check_for_changes(self, old_submission):
+        """check if the files in @old_submission object have been
+        changed in the newer upload and @return if so bool
+        Compares file names, sizes and hashes with those in the old version's manifest"""
+        new_files = {name: (size, sha256) for name, (_, size, sha256) in self.files.items()}
+        manifest = old_submission.manifest()
+        if manifest is not None:
+            old_files = {file.name: (file.size, file.sha256) for file in manifest.files.all()}
+        else:
+            # uploaded before manifests were kept, so the old files have to be read
+            old_sub_path = old_submission.originals_path()
+            old_files = {}
+            for file_name in old_submission.get_files():
+                old_file_path = os.path.join(old_sub_path, file_name)
+                old_files[file_name] = (os.path.getsize(old_file_path), rc.file_digest(old_file_path))
+        return old_files != new_files
+
+    def copy_gitlab_files_to_submission(self, submission):
+        """copy new version of files from temp directory
+        to the @submission object"""
+        for path, _, _ in self.files.values():
+            submission.copy_file(path)
+        if not self.files:
+            submission.save_content_file("NO_FILE_FETCHED_FROM_GITLAB", "NO_FILE_FETCHED_FROM_GITLAB")
+
+    def __enter__(self):
+        if not self.has_fetched:
+            try:
+                self.fetch_and_unpack()
+            except BaseException:
+                self.__exit__(None, None, None)
+                raise
+        return self
+
+    def __exit__(self, etype, value, traceback):
+        if self.has_fetched:
+            logger.info("Removing dir: " + self.tmp_dir)
+            shutil.rmtree(self.tmp_dir)
+            self.has_fetched = False
+            self.tmp_dir = None
+            self.files = {}
+
+
+def fetch_submission(user, cw, file_type, client=None):
+    """Fetch the @file_type files of @user for @cw from gitlab,
+    unless their latest version is of the latest commit. Uses the
+    shared GitlabClient unless given another @client.
+    @return bool if anything was actually fetched"""
+    path_re = cw.test_path_re if file_type == m.SubmissionType.TEST_CASE else cw.sol_path_re
+    fetcher = GitlabFetcher(user, str(cw.name), path_re, client=client)
+    fetcher.head_commit()
+    latest_submission = m.Submission.objects.filter(coursework=cw, creator=user, type=file_type).first()
+    if latest_submission is not None and fetcher.is_up_to_date(latest_submission):
+        return False
+    with fetcher:
+        return save_fetched_files(fetcher, user, cw, file_type, latest_submission)
+
+
+@transaction.atomic
+def save_fetched_files(fetcher, user, cw, file_type, latest_submission):
+    """Store the files @fetcher got as a new version of @latest_submission,
+    if they changed, or as a new @file_type submission of @user for @cw
+    if there is no @latest_submission.
+    @return bool if a new version was made"""
+    if latest_submission is not None:
+        if fetcher.check_for_changes(latest_submission):
+            latest_submission.increment_version()
+            latest_submission.save()
+            fetcher.copy_gitlab_files_to_submission(latest_submission)
+            fetcher.record_commit(latest_submission)
+            return True
+        # the same files, so later fetches can skip this commit
+        fetcher.record_commit(latest_submission)
+        return False
+    name = "Solution" if file_type == m.SubmissionType.SOLUTION else "Test Case"
+    new_submission = m.Submission(coursework=cw,
+        creator=user, type=file_type,
+        display_name=name)
+    m.save_with_new_slug(new_submission)
+    fetcher.copy_gitlab_files_to_submission(new_submission)
+    fetcher.record_commit(new_submission)
+    return True
+
+
+def students(coursework):
+    """The users enrolled on the course of @coursework who aren't teachers"""
+    return User.objects.filter(enrolleduser__course=coursework.course) \
+        .exclude(groups__name='teacher').order_by('username')
+
+
+def harvest(coursework, file_type, threads=None, report=None):
+    """Fetch the @file_type files of every student of @coursework from
+    gitlab, as each of them fetching their own would. Projects are
+    downloaded on @threads threads through the shared GitlabClient, and
+    the files stored here as they arrive, GITLAB_HARVEST_BATCH students to
+    a transaction. Uses the Peer-Testing user's
+    token, so only projects it was added to by a student's fetch can be
+    read. Calls @report with how many are done, of how many, the student,
+    what happened and why it failed, after each one.
+    @return a dict of each outcome to how many students had it"""
+    threads = threads or settings.GITLAB_HARVEST_THREADS
+    path_re = coursework.test_path_re if file_type == m.SubmissionType.TEST_CASE else coursework.sol_path_re
+    users = list(students(coursework))
+    # like fetch_submission, a student's first submission of the type gets the new version
+    submissions = m.load_manifests(m.Submission.objects.filter(coursework=coursework, type=file_type,
+                                                               creator__in=users).order_by('-id'))
+    submissions = {submission.creator_id: submission for submission in submissions}
+    fetched_commits = {user_id: submission.manifest().commit_sha
+                       for user_id, submission in submissions.items() if submission.manifest() is not None}
+
+    def download(user):
+        """Runs on the pool, so mustn't use the database"""
+        fetcher = GitlabFetcher(user, str(coursework.name), path_re,
+                                token=settings.PEER_TESTING_API_ACCESS_TOKEN)
+        try:
+            head = fetcher.head_commit()
+            if head is None or head != fetched_commits.get(user.id):
+                fetcher.fetch_and_unpack()
+        except BaseException:
+            fetcher.__exit__(None, None, None)
+            raise
+        return fetcher
+
+    counts = {NEW: 0, UNCHANGED: 0, FAILED: 0}
+    done = []
+
+    def finish(user, outcome, reason=''):
+        counts[outcome] += 1
+        done.append(user)
+        if report is not None:
+            report(len(done), len(users), user, outcome, reason)
+
+    def store(batch):
+        """Save the files of each (user, fetcher) in @batch in one
+        transaction, each student in a savepoint of their own"""
+        with transaction.atomic():
+            for user, fetcher in batch:
+                outcome, reason = UNCHANGED, ''
+                try:
+                    if save_fetched_files(fetcher, user, coursework, file_type, submissions.get(user.id)):
+                        outcome = NEW
+                except Exception as e:
+                    logger.exception("Couldn't store the files fetched for %s" % user)
+                    outcome, reason = FAILED, str(e)
+                finally:
+                    fetcher.__exit__(None, None, None)
+                finish(user, outcome, reason)
+        del batch[:]
+
+    batch = []
+    try:
+        with ThreadPoolExecutor(max_workers=threads) as pool:
+            futures = {pool.submit(download, user): user for user in users}
+            for future in as_completed(futures):
+                user = futures[future]
+                try:
+                    fetcher = future.result()
+                except (GitlabFetchError, requests.RequestException) as e:
+                    finish(user, FAILED, str(e))
+                    continue
+                if not fetcher.has_fetched:
+                    finish(user, UNCHANGED)
+                    continue
+                batch.append((user, fetcher))
+                if len(batch) >= settings.GITLAB_HARVEST_BATCH:
+                    store(batch)
+        store(batch)
+    finally:
+        for _, fetcher in batch:
+            fetcher.__exit__(None, None, None)
+    return counts
@@ -8,13 +8,11 @@ import common.permissions as p
 
 def coursework_available_for_user(user):
     """For a given @request, return a list of coursework available to the user"""
-    enrolled_courses = m.EnrolledUser.objects.filter(login=user).values('course')
-    courses_for_user = m.Course.objects.filter(code__in=enrolled_courses)
-    all_courseworks_for_user = m.Coursework.objects.filter(course__in=courses_for_user)
+    all_courseworks_for_user = m.Coursework.objects.filter(course__in=p.roles(user).courses)
     visible_courseworks = []
     for item in all_courseworks_for_user:
         if p.can_view_coursework(user, item):
-            visible_courseworks.append((item.id, item.state, item.course.code, item.name))
+            visible_courseworks.append((item.id, item.state, item.course_id, item.name))
     return visible_courseworks
 
 
@@ -61,20 +59,20 @@ def can_delete(submission):
 
 def get_descriptor_tuples(coursework):
     """Get the descriptors and files for @coursework"""
-    return [(s, s.get_files()) for s in m.Submission.objects.filter(
-        type=m.SubmissionType.CW_DESCRIPTOR, coursework=coursework)]
+    return [(s, s.get_files()) for s in m.load_manifests(m.Submission.objects.filter(
+        type=m.SubmissionType.CW_DESCRIPTOR, coursework=coursework))]
 
 
 def get_solution_tuples(coursework, user):
     """Get the solution submissions and files
     for @coursework by @user"""
     return [(s, s.get_files()) for s in
-            m.Submission.objects.filter(coursework=coursework, creator=user,
-                                        type=m.SubmissionType.SOLUTION)]
+            m.load_manifests(m.Submission.objects.filter(coursework=coursework, creator=user,
+                                                         type=m.SubmissionType.SOLUTION))]
 
 
 def get_test_triples(coursework, user):
     """Get the test submissions and files, and
     ability to delete for @coursework by @user"""
-    return [(t, t.get_files(), can_delete(t)) for t in m.Submission.objects.filter(
-        coursework=coursework, creator=user, type=m.SubmissionType.TEST_CASE)]
+    return [(t, t.get_files(), can_delete(t)) for t in m.load_manifests(m.Submission.objects.filter(
+        coursework=coursework, creator=user, type=m.SubmissionType.TEST_CASE))]
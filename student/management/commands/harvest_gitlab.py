@@ -0,0 +1,31 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+import common.models as m
+import student.fetch as sf
+
+TYPES = {'solution': m.SubmissionType.SOLUTION, 'test': m.SubmissionType.TEST_CASE}
+
+
+class Command(BaseCommand):
+    help = "Fetch the solutions or tests of every student of a coursework from GitLab"
+
+    def add_arguments(self, parser):
+        parser.add_argument('coursework', help="ID of the coursework")
+        parser.add_argument('--type', choices=sorted(TYPES), default='solution',
+                            help="Which files to fetch")
+        parser.add_argument('--threads', type=int, default=settings.GITLAB_HARVEST_THREADS,
+                            help="How many projects to download at once")
+
+    def handle(self, *args, **options):
+        coursework = m.Coursework.objects.filter(id=options['coursework']).first()
+        if coursework is None:
+            raise CommandError("No coursework with ID %s" % options['coursework'])
+
+        def report(done, total, user, outcome, reason):
+            line = "%d/%d %s: %s" % (done, total, user, outcome)
+            self.stdout.write(line + (" (%s)" % reason if reason else ""))
+
+        counts = sf.harvest(coursework, TYPES[options['type']], options['threads'], report)
+        self.stdout.write("%d new versions, %d up to date, %d failed" %
+                          (counts[sf.NEW], counts[sf.UNCHANGED], counts[sf.FAILED]))
@@ -1,23 +1,21 @@
-import os
-import tempfile
-import shutil
 import subprocess
-import re
-import hashlib
 
 from django.contrib.auth.decorators import login_required
+from django.contrib.contenttypes.models import ContentType
 from django.db import transaction
+from django.db.models import Count, Max, Q
 from django.http import HttpResponseForbidden
 from django.shortcuts import render
 from django.urls import reverse
 from django.conf import settings
-from django.core.exceptions import ObjectDoesNotExist
+from django_comments.models import Comment
 
 import common.forms as f
 import common.models as m
 import feedback.helpers as fh
 import feedback.enrol_to_group as fenrol
 import runner.runner as r
+import student.fetch as sf
 import student.helper as h
 from common.views import redirect
 from test_match import matcher
@@ -31,19 +29,6 @@ import logging
 logger = logging.getLogger("django")
 
 
-class cd:
-    """Context manager for changing the current working directory"""
-    def __init__(self, newPath):
-        self.newPath = os.path.expanduser(newPath)
-
-    def __enter__(self):
-        self.savedPath = os.getcwd()
-        os.chdir(self.newPath)
-
-    def __exit__(self, etype, value, traceback):
-        os.chdir(self.savedPath)
-
-
 @login_required()
 def index(request):
     return detail_coursework(request)
@@ -71,126 +56,15 @@ def upload_submission(request, cw):
             msg = save_new_test(request, cw)
     return redirect(request, "Upload completed." + msg, reverse("cw", args=[cw.id]))
 
-# GITLAB Submissions
-class GitlabFetcher:
-    """Context manager which handles fetching gitlab files"""
-    def __init__(self, user, project):
-        """user A user object from django
-        @path A string project name in gitlab
-        Will be joined to fetch from /user/project in gitlab"""
-        self.user = user
-        self.path = str(user) + '%2F' + str(project)
-        self.has_fetched = False
-        self.tmp_dir = None
-
-    def fetch_and_unpack(self):
-        """fetch all the files from an archive and unpack them
-        to a temporary directory. use the context manager to
-        auto clean up
-        @returns a string of the tmp dir location"""
-        if self.has_fetched == True:
-            return self.tmp_dir
-        social = self.user.social_auth.get(provider='gitlab')
-        gitlab_api_projects = local.SOCIAL_AUTH_GITLAB_API_URL + '/api/v4/projects/'
-        gitlab_params = {'access_token': social.extra_data['access_token']}
-        # Adding Peer-Testing to project as Reporter
-        logger.info("Add Peer-Testing as Raporter to " + self.path)
-        gitlab_add_pt_rep_data = { 'user_id' : local.GITLAB_PT_USER_ID,
-                                    'access_level' : local.GITLAB_PT_USER_ACCESS_LEVEL }
-        gitlab_add_pt_rep_req = gitlab_api_projects + self.path + "/members"
-        resp_add_pt_rep = requests.post(gitlab_add_pt_rep_req,
-                                        data=gitlab_add_pt_rep_data,
-                                        params=gitlab_params,
-                                        verify=False)
-        logger.info("Add Peer-Testing as Raporter to %s: %s" % (self.path, resp_add_pt_rep.content))
-        # Fetching archive
-        gitlab_archive_req = gitlab_api_projects + self.path + "/repository/archive.tar.gz"
-        response = requests.get(gitlab_archive_req,
-                                params=gitlab_params,
-                                verify=False)
-        gitlab_info = str(response.__dict__)
-        content=response.content
-        self.tmp_dir = tempfile.mkdtemp()
-        logger.info("Extracting files in dir: " + self.tmp_dir)
-        tmp_archive_file_name = "archive.tar.gz"
-        tmp_archive_file = os.path.join(self.tmp_dir, tmp_archive_file_name)
-        with open(tmp_archive_file, "wb") as file:
-            file.write(content)
-        shutil.unpack_archive(tmp_archive_file, self.tmp_dir)
-        os.remove(tmp_archive_file)
-        self.has_fetched = True
-        return self.tmp_dir
-
-    def check_for_changes(self, old_submission, coursework, file_type):
-        """check if the @file_type files in @old_submission object for @coursework have been
-        changed in the newer upload and @return if so bool
-        Checks file names, sizes and hashes"""
-        path_re = coursework.test_path_re if file_type == m.SubmissionType.TEST_CASE else coursework.sol_path_re
-        new_files = []
-        old_files = old_submission.get_files()
-        old_sub_path = old_submission.originals_path()
-        with cd(self.tmp_dir):
-            for dirpath, dirs, files in os.walk(os.getcwd()):
-                for file_name in files:
-                    if re.search(path_re, file_name):
-                        new_file_path = os.path.join(dirpath,file_name)
-                        # check for new file name
-                        if file_name not in old_files:
-                            return True
-                        new_files.append(file_name)
-                        old_file_path = os.path.join(old_sub_path, file_name)
-                        # check file sizes
-                        if os.stat(old_file_path).st_size != os.stat(new_file_path).st_size:
-                            return True
-                        # check file hashes
-                        with open(old_file_path, 'rb') as f:
-                            old_sha = hashlib.sha256()
-                            old_sha.update(f.read())
-                        with open(new_file_path, 'rb') as f:
-                            new_sha = hashlib.sha256()
-                            new_sha.update(f.read())
-                        if old_sha.hexdigest() != new_sha.hexdigest():
-                            return True
-        # check intersection lengths to check for removed files
-        return len(set(old_files) & set(new_files)) != len(old_files)
-
-    def copy_gitlab_files_to_submission(self, submission, cw, file_type):
-        """copy new version of files from temp directory
-        to the @submission object for coursework @cw, given
-        a specific @file_type of submission"""
-        file_copied=False
-        path_re = cw.test_path_re if file_type == m.SubmissionType.TEST_CASE else cw.sol_path_re
-        with cd(self.tmp_dir):
-            for dirpath, dirs, files in os.walk(os.getcwd()):
-                for file_name in files:
-                    if re.search(path_re, file_name):
-                        submission.copy_file(os.path.join(dirpath,file_name))
-                        file_copied=True
-        if not file_copied:
-            error_notification_file = os.path.join(self.tmp_dir, "NO_FILE_FETCHED_FROM_GITLAB")
-            with open(error_notification_file, "wb") as file:
-                file.write("NO_FILE_FETCHED_FROM_GITLAB")
-            submission.copy_file(error_notification_file)
-
-    def __enter__(self):
-        if not self.has_fetched:
-            self.fetch_and_unpack()
-        return self
-
-    def __exit__(self, etype, value, traceback):
-        if self.has_fetched:
-            logger.info("Removing dir: " + self.tmp_dir)
-            shutil.rmtree(self.tmp_dir)
-            self.has_fetched = False
-            self.tmp_dir = None
-
-
 # OLD submissions
 @transaction.atomic
 def re_version_submission(request, cw, submission):
     submission.increment_version()
     for each in request.FILES.getlist('chosen_files'):
         submission.save_uploaded_file(each)
+    if cw.rerun_on_new_version:
+        return "New version of files for '%s' has been uploaded. Tests that used the " \
+               "old version will be run again with it." % submission.display_name
     return "New version of files for '%s' has been uploaded. You should re-run " \
            "any tests again to use the new version." % submission.display_name
 
@@ -232,10 +106,10 @@ def save_new_test(request, cw):
 @transaction.atomic
 def save_new_submission(cw, request, file_type, name):
     """Do the atomic database actions required to save the new files"""
-    submission = m.Submission(id=m.new_random_slug(m.Submission), coursework=cw,
+    submission = m.Submission(coursework=cw,
                               creator=request.user, type=file_type,
                               display_name=name)
-    submission.save()
+    m.save_with_new_slug(submission)
     for each in request.FILES.getlist('chosen_files'):
         submission.save_uploaded_file(each)
     return submission
@@ -293,7 +167,11 @@ def gitlab_fetch(request, cw):
     """Given a @request to fetch a solution for @cw
     render the page or handle the requested fetch"""
     if request.POST:
-        did_fetch = do_gitlab_fetch(request, cw)
+        try:
+            did_fetch = do_gitlab_fetch(request, cw)
+        except (sf.GitlabFetchError, requests.RequestException) as e:
+            logger.warning("GitLab fetch failed: %s" % e)
+            return redirect(request, "Couldn't fetch your files from GitLab: %s" % e, reverse("cw", args=[cw.id]))
         if request.POST['file_type'] == m.SubmissionType.SOLUTION and did_fetch:
             notify_peers_of_new_versions(request, cw)
         message = "Fetched latest files from GitLab" if did_fetch else "Latest files from GitLab are up to date"
@@ -331,7 +209,6 @@ def render_gitlab_fetch_page(request, cw):
     }
     return render(request, 'student/gitlab_fetch.html', detail)
 
-@transaction.atomic
 def do_gitlab_fetch(request, cw):
     """Given this @request to fetch files for @cw,
     fetch the files from gitlab.
@@ -339,23 +216,7 @@ def do_gitlab_fetch(request, cw):
     file_type = request.POST['file_type']
     if not h.user_can_upload_of_type(request.user, cw, file_type):
         return HttpResponseForbidden("You can't upload submissions of this type")
-    with GitlabFetcher(request.user, str(cw.name)) as gf:
-        try:
-            latest_submission = m.Submission.objects.get(coursework=cw, creator=request.user, type=file_type)
-            if gf.check_for_changes(latest_submission, cw, file_type):
-                latest_submission.increment_version()
-                latest_submission.save()
-                gf.copy_gitlab_files_to_submission(latest_submission, cw, file_type)
-                return True
-            return False
-        except ObjectDoesNotExist as e:
-            name = "Solution" if file_type == m.SubmissionType.SOLUTION else "Test Case"
-            new_submission = m.Submission(id=m.new_random_slug(m.Submission), coursework=cw,
-                creator=request.user, type=file_type,
-                display_name=name)
-            new_submission.save()
-            gf.copy_gitlab_files_to_submission(new_submission, cw, file_type)
-            return True
+    return sf.fetch_submission(request.user, cw, file_type)
 
 def notify_peers_of_new_versions(request, cw):
     """after a new solution has been uploaded, notify the peers in that group
@@ -366,14 +227,9 @@ def notify_peers_of_new_versions(request, cw):
         all_users_in_group = fh.get_all_users_in_feedback_group(group)
         all_peer_users += [str(u[0]) for u in all_users_in_group]
     all_peer_users_uniq = list(dict.fromkeys(all_peer_users))
-    for peer_user in all_peer_users_uniq:
-        cw_name = str(cw.name)
-        url = request.build_absolute_uri(cw.id)
-        logger.info("New Sol: " + str(request.user))
-        logger.info("New Sol coursework: " + cw_name)
-        logger.info("New Sol url: " + url)
-        logger.info("New Sol peer:" + peer_user)
-        n.add_notification(peer_user,cw,"New peer solution uploaded at " + url)
+    url = request.build_absolute_uri(cw.id)
+    logger.info("New Sol: %s in %s at %s, for peers %s" % (request.user, cw.name, url, all_peer_users_uniq))
+    n.add_notifications(all_peer_users_uniq, cw, "New peer solution uploaded at " + url)
 
 # Rest of student view methods
 @login_required()
@@ -403,6 +259,8 @@ def single_coursework(request, cw):
     tests = h.get_test_triples(cw, request.user)
 
     testing_data = detail_self_test_matches(request.user, cw) + detail_peer_feedback_group(request.user, cw)
+    testing_data = [(match_form, with_comment_counts(tms), name, message)
+                    for match_form, tms, name, message in testing_data]
 
     details = {
         "cw": cw,
@@ -418,12 +276,24 @@ def single_coursework(request, cw):
     return render(request, 'student/detail_coursework.html', details)
 
 
+def with_comment_counts(tms):
+    """Add to each (test match, solution name, test name) in @tms
+    the number of comments on the test match and when the latest was
+    made, counted for all of them in one query"""
+    counts = {object_pk: (count, latest) for object_pk, count, latest in Comment.objects.filter(
+        content_type=ContentType.objects.get_for_model(m.TestMatch), object_pk__in=[tm.id for tm, _, _ in tms],
+        site_id=settings.SITE_ID, is_public=True, is_removed=False).values_list(
+        'object_pk').annotate(Count('id'), Max('submit_date')).order_by()}
+    return [(tm, sol, test) + counts.get(tm.id, (0, None)) for tm, sol, test in tms]
+
+
 def detail_self_test_matches(user, coursework):
     """For self testing for a @use rin a @coursework,
     prepare the match form and list results"""
     tms = [(tm, tm.solution.display_name, tm.test.display_name) for tm in
-           m.TestMatch.objects.filter(type=m.TestType.SELF, coursework=coursework) if
-           tm.solution.creator == user or tm.test.creator == user]
+           m.TestMatch.objects.filter(Q(solution__creator=user) | Q(test__creator=user),
+                                      type=m.TestType.SELF, coursework=coursework).select_related(
+               'solution', 'test').defer('log')]
     match_form = generate_self_match_form(coursework, user)
     return [(match_form, tms, "Self-Testing", """
 <ul>
@@ -479,19 +349,15 @@ def generate_peer_match_form(cw, user, group, post=None):
     test match form for peer testing purposes.
     If the form is to be used in validating a @post request,
     this may also be passed in"""
-    all_users = fh.get_all_users_in_feedback_group(group)
-    user_objects = [item[0] for item in all_users]
-    all_sols = m.Submission.objects.filter(coursework=cw,
-                                           creator__in=user_objects,
-                                           type=m.SubmissionType.SOLUTION)
+    nicknames = fh.nicknames_in_group(group)
     tests = [(t.id, t.display_name) for t in
              m.Submission.objects.filter(coursework=cw, creator=user,
                                          type=m.SubmissionType.TEST_CASE)]
     sols = [
-        (item.id, fh.nick_for_display(group, user, item, item.latest_version)) for item in
+        (item.id, fh.nick_for_display(group, user, item, item.latest_version, nicknames)) for item in
         m.Submission.objects.filter(coursework=cw,
-        creator__in=user_objects,
-        type__in=m.SubmissionType.SOLUTION)
+        creator__feedbackmembership__group=group,
+        type=m.SubmissionType.SOLUTION).select_related('creator')
     ]
     sig = m.Submission.objects.get(coursework=cw, type=m.SubmissionType.SIGNATURE_TEST)
     tests.append((sig.id, sig.display_name))
@@ -536,7 +402,7 @@ def create_new_test_match(request, cw):
     args.append(user)
     try:
         new_tm = method(*args)
-        r.run_test_on_thread(new_tm)
+        r.schedule_test(new_tm)
         return redirect(request, "Test Created", reverse("tm", args=[new_tm.id,'']))
     except Exception as e:
         return HttpResponseForbidden(str(e))
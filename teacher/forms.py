@@ -17,6 +17,12 @@ class CourseworkForm(f.Form):
     sol_path_re = f.CharField(label='Regular Expression indicating where to look for SOLUTION files when fetching from gitlab', max_length=256)
     test_path_re  = f.CharField(label='Regular Expression indicating where to look for TEST files when fetching from gitlab', max_length=256)
     execute_script = f.CharField(label='Name of script to use when executing a test. Leave blank if no compilation needed', max_length=64, required=False)
+    wall_time_limit = f.IntegerField(label='Seconds a test may run for', min_value=1, initial=30)
+    cpu_time_limit = f.IntegerField(label='CPU seconds a test may use. Leave blank for no limit', min_value=1, initial=30, required=False)
+    memory_limit = f.IntegerField(label='MB of memory a test may use. Leave blank for no limit', min_value=1, required=False)
+    process_limit = f.IntegerField(label='Processes and threads a test may start, only enforced where the runner has a cgroup. Leave blank for no limit', min_value=1, required=False)
+    output_limit = f.IntegerField(label='Bytes of output a test may produce. Leave blank for no limit', min_value=1, initial=1048576, required=False)
+    rerun_on_new_version = f.BooleanField(label='Re-run tests automatically when a new version of a solution or test is uploaded', required=False)
 
 
 # noinspection PyClassHasNoInit
@@ -18,5 +18,7 @@ urlpatterns = [
     url('updatecontent/', views.update_content, name='update_content'),
     url('test_all/(?P<c>[0-9a-zA-Z\-_]*)', views.run_all_test_in_cw, name='run_all_test_in_cw'),
     url('cw/(?P<c>[0-9a-zA-Z\-_]*)/make_tm', views.create_test_match, name='make_tm'),
+    url('cw/(?P<c>[0-9a-zA-Z\-_]*)/peer_matrix', views.create_peer_matrix, name='peer_matrix'),
+    url('metrics', views.metrics, name='runner_metrics'),
     url(r'^$', views.index, name='teacher_index'),
 ]
@@ -1,3 +1,4 @@
+import hmac
 from string import Template
 
 from django.http import HttpResponse
@@ -8,17 +9,22 @@ from django.db import reset_queries
 from django.http import HttpResponseForbidden, HttpResponseBadRequest
 from django.shortcuts import render
 from django.urls import reverse
+from django.conf import settings
 import django_comments.models as cm
 
 import common.forms as cf
 import common.models as m
 import common.permissions as p
 import feedback.forms as ff
+import feedback.models as fm
 import feedback.enrol_to_group as fenrol
 import teacher.forms as f
 from common.permissions import require_teacher
 from common.views import redirect
 from runner import runner as r
+from runner import jobs as rj
+from runner import cache as rc
+from runner import metrics as rm
 from test_match import matcher
 import common.notify as n
 
@@ -182,33 +188,38 @@ def create_coursework_update(user, request, course_code):
     if not cw_form.is_valid():
         return HttpResponseBadRequest("Form contained invalid data. Please try again")
     course = m.Course.objects.get(code=course_code)
-    coursework = m.Coursework(id=m.new_random_slug(m.Coursework),
-                              course=course,
+    coursework = m.Coursework(course=course,
                               name=cw_form.cleaned_data['name'],
                               state=cw_form.cleaned_data['state'],
                               execute_script=cw_form.cleaned_data['execute_script'],
                               sol_path_re=cw_form.cleaned_data['sol_path_re'],
-                              test_path_re=cw_form.cleaned_data['test_path_re'])
-    coursework.save()
-
-    descriptor = m.Submission(id=m.new_random_slug(m.Submission), coursework=coursework,
+                              test_path_re=cw_form.cleaned_data['test_path_re'],
+                              wall_time_limit=cw_form.cleaned_data['wall_time_limit'],
+                              cpu_time_limit=cw_form.cleaned_data['cpu_time_limit'],
+                              memory_limit=cw_form.cleaned_data['memory_limit'],
+                              process_limit=cw_form.cleaned_data['process_limit'],
+                              output_limit=cw_form.cleaned_data['output_limit'],
+                              rerun_on_new_version=cw_form.cleaned_data['rerun_on_new_version'])
+    m.save_with_new_slug(coursework)
+
+    descriptor = m.Submission(coursework=coursework,
                               creator=user, type=m.SubmissionType.CW_DESCRIPTOR,
                               display_name="Coursework Descriptor")
-    descriptor.save()
+    m.save_with_new_slug(descriptor)
     for each in request.FILES.getlist('descriptor'):
         descriptor.save_uploaded_file(each)
 
-    oracle_exec = m.Submission(id=m.new_random_slug(m.Submission), coursework=coursework,
+    oracle_exec = m.Submission(coursework=coursework,
                                creator=user, type=m.SubmissionType.ORACLE_EXECUTABLE,
                                display_name="Oracle Solution")
-    oracle_exec.save()
+    m.save_with_new_slug(oracle_exec)
     for each in request.FILES.getlist('oracle_exec'):
         oracle_exec.save_uploaded_file(each)
 
-    sig = m.Submission(id=m.new_random_slug(m.Submission), coursework=coursework,
+    sig = m.Submission(coursework=coursework,
                        creator=user, type=m.SubmissionType.SIGNATURE_TEST,
                        display_name="Signature Test")
-    sig.save()
+    m.save_with_new_slug(sig)
     for each in request.FILES.getlist('signature'):
         sig.save_uploaded_file(each)
 
@@ -234,11 +245,19 @@ def edit_coursework_update(new_details, old_coursework):
     updated_form = f.CourseworkForm(new_details)
     if not updated_form.is_valid():
         raise Exception("validity problem")
+    if old_coursework.execute_script != updated_form.cleaned_data['execute_script']:
+        rc.invalidate(old_coursework)
     old_coursework.name = updated_form.cleaned_data['name']
     old_coursework.state = updated_form.cleaned_data['state']
     old_coursework.execute_script = updated_form.cleaned_data['execute_script']
     old_coursework.sol_path_re = updated_form.cleaned_data['sol_path_re']
     old_coursework.test_path_re = updated_form.cleaned_data['test_path_re']
+    old_coursework.wall_time_limit = updated_form.cleaned_data['wall_time_limit']
+    old_coursework.cpu_time_limit = updated_form.cleaned_data['cpu_time_limit']
+    old_coursework.memory_limit = updated_form.cleaned_data['memory_limit']
+    old_coursework.process_limit = updated_form.cleaned_data['process_limit']
+    old_coursework.output_limit = updated_form.cleaned_data['output_limit']
+    old_coursework.rerun_on_new_version = updated_form.cleaned_data['rerun_on_new_version']
     old_coursework.save()
 
 
@@ -249,13 +268,19 @@ def edit_coursework_render(request, coursework):
     of course the metadata about the coursework itself"""
     desc_types = [m.SubmissionType.CW_DESCRIPTOR, m.SubmissionType.ORACLE_EXECUTABLE,
                   m.SubmissionType.SIGNATURE_TEST]
-    submissions = [(s, s.get_files()) for s in m.Submission.objects.filter(
-        coursework=coursework, type__in=desc_types)]
+    submissions = [(s, s.get_files()) for s in m.load_manifests(m.Submission.objects.filter(
+        coursework=coursework, type__in=desc_types))]
     initial = {"name": coursework.name,
                "state": coursework.state,
                "execute_script": coursework.execute_script,
                "sol_path_re": coursework.sol_path_re,
-               "test_path_re": coursework.test_path_re}
+               "test_path_re": coursework.test_path_re,
+               "wall_time_limit": coursework.wall_time_limit,
+               "cpu_time_limit": coursework.cpu_time_limit,
+               "memory_limit": coursework.memory_limit,
+               "process_limit": coursework.process_limit,
+               "output_limit": coursework.output_limit,
+               "rerun_on_new_version": coursework.rerun_on_new_version}
     cw_form = f.CourseworkForm(initial)
     detail = {
         "coursework": coursework,
@@ -303,7 +328,7 @@ def view_coursework_files(request, c):
     all_submissions = m.Submission.objects.filter(coursework=coursework).exclude(type=m.SubmissionType.TEST_RESULT).select_related(
         'creator','coursework','coursework__course'
     )
-    submissions = [(s, s.get_time_for_version(), s.get_files()) for s in all_submissions.iterator()]
+    submissions = [(s, s.get_time_for_version(), s.get_files()) for s in m.load_manifests(all_submissions)]
     tm_form = generate_teacher_easy_match_form(coursework)
     # string templates are faster than django templates
     rowTemplate = Template("""<tr>
@@ -325,7 +350,7 @@ def view_coursework_files(request, c):
             fileLinks += fileTemplate.substitute(url=thisUrl, name=f)
         response += rowTemplate.substitute(
             sid=sub.id,
-            time=sub.get_time_for_version(),
+            time=time,
             type=sub.type,
             creator=sub.creator,
             name=sub.display_name,
@@ -354,7 +379,7 @@ def view_coursework_tms(request, c):
     # Get all related objects in one query
     results = m.TestMatch.objects.select_related(
         'test__creator',
-        'solution__creator',).filter(coursework=coursework)
+        'solution__creator',).defer('log').filter(coursework=coursework)
     # built reversed URLs for links with string concat rather than calling method repeatedly
     tm_url = reverse("tm", kwargs={"test_match_id": '', "commented": ''})
     # get all of the comments for all test matches and group them and count them
@@ -363,8 +388,8 @@ def view_coursework_tms(request, c):
         comment_counts = {tm[0]: str(tm[1]) for tm in cursor.fetchall()}
     # build each row in the table
     if 'csv' in request.GET:
-        response = "id,time,tester,test,testver,developer,solution,solutionver,commentcount,errorlevel,type\n"
-        rowTemplate = Template("$tmid,$tmtime,$tester,$testname,$testver,$developer,$solname,$solver,$comments,$errorlevel,$type\n")
+        response = "id,time,tester,test,testver,developer,solution,solutionver,commentcount,errorlevel,limit,testsrun,testspassed,type\n"
+        rowTemplate = Template("$tmid,$tmtime,$tester,$testname,$testver,$developer,$solname,$solver,$comments,$errorlevel,$limit,$testsrun,$testspassed,$type\n")
     else:
         response = ""
         rowTemplate = Template("""<tr>
@@ -373,7 +398,8 @@ def view_coursework_tms(request, c):
             <td>$tester $testname $testver</td>
             <td>$developer $solname $solver</td>
             <td>$comments Comments</td>
-            <td>$errorlevel</td>
+            <td>$errorlevel $limit</td>
+            <td>$passed</td>
             <td>$type</td>
             </tr>""")
     # its faster to build the string in python than in the django template
@@ -393,6 +419,10 @@ def view_coursework_tms(request, c):
             solver="v"+str(r.solution_version) if has_sol else "",
             comments=comment_count,
             errorlevel="Success" if r.error_level==0 else "E"+str(r.error_level) if r.error_level is not None else "Queued",
+            limit=r.get_limit_exceeded_display() if r.limit_exceeded is not None else "",
+            testsrun=r.tests_run if r.tests_run is not None else "",
+            testspassed=r.tests_passed if r.tests_passed is not None else "",
+            passed=r.passed_summary(),
             type=r.type
         )
     # now pass everything to the renderer
@@ -404,6 +434,7 @@ def view_coursework_tms(request, c):
     detail = {
         "coursework": coursework,
         "results": response,
+        "queue_progress": queue_progress_message(coursework),
         "crumbs": [("Homepage", reverse("teacher_index")),
                    (coursework.course.code, reverse("edit_course", args=[coursework.course.code])),
                    (coursework.name, reverse('edit_cw', args=[coursework.id]))]
@@ -489,13 +520,33 @@ def manual_test_match_update(request, coursework):
             tm_form.cleaned_data['test'],
             coursework
         )
-        r.run_test_on_thread(new_tm)
+        r.schedule_test(new_tm)
     except Exception as e:
         return HttpResponseBadRequest(str(e))
     return redirect(request, "Test created",
                     reverse('view_cw_tms', args=[coursework.id]))
 
 
+@login_required()
+@require_teacher
+def create_peer_matrix(request, c):
+    """Create every peer test match within the feedback group in the POST
+    request, or within all feedback groups of coursework @c, and run them"""
+    coursework = m.Coursework.objects.get(id=c)
+    if not request.POST:
+        return HttpResponseForbidden("You're supposed to POST a form here")
+    if not p.is_enrolled_on_course(request.user, coursework.course):
+        return HttpResponseForbidden("You're not enrolled on this course")
+    group = request.POST.get('groupid') or None
+    if group is not None and not (group.isdigit() and
+                                  fm.FeedbackGroup.objects.filter(id=group, coursework=coursework).exists()):
+        return HttpResponseBadRequest("That feedback group is not part of this coursework")
+    new_tms = matcher.create_peer_matrix(coursework, group)
+    r.schedule_tests(new_tms, bulk=True)
+    return redirect(request, "Created %d peer test matches" % len(new_tms),
+                    reverse('view_cw_tms', args=[coursework.id]))
+
+
 @login_required()
 @require_teacher
 def run_all_test_in_cw(request, c):
@@ -507,6 +558,14 @@ def run_all_test_in_cw(request, c):
     return redirect(request, "Starting to run queued tests", reverse('view_cw_tms', args=[cw.id]))
 
 
+def queue_progress_message(coursework):
+    """Describe how far the test workers have got with @coursework"""
+    if not settings.RUNNER_USE_JOB_QUEUE:
+        return ""
+    progress = rj.coursework_progress(coursework)
+    return "Test queue: %d done, %d running, %d remaining, %d failed" % progress
+
+
 @login_required()
 @require_teacher
 @transaction.atomic()
@@ -520,6 +579,8 @@ def update_content(request):
     old_sub.increment_version()
     for each in request.FILES.getlist('new_content'):
         old_sub.save_uploaded_file(each)
+    if old_sub.type in [m.SubmissionType.ORACLE_EXECUTABLE, m.SubmissionType.SIGNATURE_TEST]:
+        rc.invalidate(old_sub.coursework)
 
     return redirect(request, "Content Updated", reverse('edit_cw', args=[old_sub.coursework.id]))
 
@@ -540,7 +601,7 @@ def view_timeline(request, c, s):
     submissions = m.Submission.objects.select_related('coursework',
      'coursework__course').filter(creator=student, coursework=coursework,
       type__in=[m.SubmissionType.TEST_CASE, m.SubmissionType.SOLUTION])
-    for submission in submissions.iterator():
+    for submission in m.load_manifests(submissions, all_versions=True):
         versions = submission.latest_version
         for i in range(0, submission.latest_version):
             date = submission.get_time_for_version(i).astimezone(tz=None)
@@ -580,3 +641,20 @@ def view_timeline(request, c, s):
                    (coursework.name, reverse('edit_cw', args=[coursework.id]))]
     }
     return render(request, 'teacher/timeline.html', detail)
+
+
+def has_metrics_token(request):
+    """Does @request carry the RUNNER_METRICS_TOKEN, for a scraper"""
+    token = settings.RUNNER_METRICS_TOKEN
+    header = request.META.get('HTTP_AUTHORIZATION', '')
+    if not token or not header.startswith('Bearer '):
+        return False
+    return hmac.compare_digest(header[len('Bearer '):].encode('utf-8'), token.encode('utf-8'))
+
+
+def metrics(request):
+    """The test runner's metrics in the Prometheus text format,
+    for teachers or for a scraper with the metrics token"""
+    if not has_metrics_token(request) and not (request.user.is_authenticated and p.is_teacher(request.user)):
+        return HttpResponseForbidden("You must be a teacher to view this page")
+    return HttpResponse(rm.exposition(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,88 @@
+import shutil
+import tempfile
+
+from django.contrib.auth.models import Group, User
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django_comments.models import Comment
+
+import common.models as m
+import feedback.models as fm
+from test_match import matcher
+
+
+def submission(coursework, user, file_type, name, file_name):
+    sub = m.Submission(coursework=coursework, creator=user, type=file_type, display_name=name)
+    m.save_with_new_slug(sub)
+    sub.save_content_file("print('%s')\n" % name, file_name)
+    return sub
+
+
+class CourseworkPageQueriesTest(TestCase):
+    """The student coursework page lists every test match of the student's
+    feedback group, but must load them in a fixed number of queries"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root, ALLOWED_HOSTS=['testserver'])
+        self.settings.enable()
+        teacher = User.objects.create(username='teacher')
+        Group.objects.create(name='teacher').user_set.add(teacher)
+        self.course = m.Course.objects.create(name='Course', code='C1')
+        self.coursework = m.Coursework.objects.create(id='cw1', name='cw', course=self.course,
+                                                      state=m.CourseworkState.FEEDBACK)
+        self.oracle = submission(self.coursework, teacher, m.SubmissionType.ORACLE_EXECUTABLE,
+                                 'Oracle Solution', 'sol.py')
+        submission(self.coursework, teacher, m.SubmissionType.SIGNATURE_TEST, 'Signature Test', 'SigTest.py')
+        submission(self.coursework, teacher, m.SubmissionType.CW_DESCRIPTOR, 'Descriptor', 'README.txt')
+        self.group = fm.FeedbackGroup.objects.create(coursework=self.coursework)
+        self.student, self.solution, self.test = self.add_student('student')
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def add_student(self, username):
+        """Enrol a new student in the feedback group, with a solution, a
+        test, and self tests. @return the student, solution and test"""
+        user = User.objects.create(username=username)
+        m.EnrolledUser.objects.create(login=user, course=self.course)
+        members = fm.FeedbackMembership.objects.filter(group=self.group).count()
+        fm.FeedbackMembership.objects.create(group=self.group, user=user, nickname='Peer #%d' % (members + 1))
+        solution = submission(self.coursework, user, m.SubmissionType.SOLUTION, 'Solution', 'sol.py')
+        test = submission(self.coursework, user, m.SubmissionType.TEST_CASE, 'Test Case #1', 'MyTest.py')
+        matcher.create_self_test(solution.id, test.id, self.coursework, user)
+        matcher.create_self_test(self.oracle.id, test.id, self.coursework, user)
+        return user, solution, test
+
+    def add_peers(self, count):
+        """Add @count students who test, and are tested by, the student,
+        with a comment on each of their test matches"""
+        for _ in range(count):
+            peer, solution, test = self.add_student('peer%d' % User.objects.count())
+            for tm in [matcher.create_peer_test(solution.id, self.test.id, self.coursework,
+                                                self.group.id, self.student),
+                       matcher.create_peer_test(self.solution.id, test.id, self.coursework,
+                                                self.group.id, peer)]:
+                Comment.objects.create(content_type=ContentType.objects.get_for_model(m.TestMatch),
+                                       object_pk=tm.id, site_id=1, user=peer, comment='Comment')
+
+    def page_queries(self):
+        """@return how many queries the student's coursework page took"""
+        self.client.force_login(self.student)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get('/student/cw/%s' % self.coursework.id)
+        self.assertEqual(response.status_code, 200)
+        return len(queries), response.content.decode()
+
+    def test_queries_independent_of_group_size(self):
+        self.add_peers(3)
+        small, page = self.page_queries()
+        self.assertEqual(page.count('with <b>1 comment</b>'), 6)
+        self.add_peers(9)
+        large, page = self.page_queries()
+        self.assertEqual(page.count('with <b>1 comment</b>'), 24)
+        self.assertEqual(small, large)
+        self.assertLessEqual(large, 40)
@@ -0,0 +1,112 @@
+import io
+import json
+import shutil
+import tarfile
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+from social_django.models import UserSocialAuth
+
+import common.gitlab as gitlab
+import common.models as m
+import student.fetch as sf
+
+
+def archive(files):
+    """@return a tar.gz of the dict @files, as GitLab would send it"""
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode='w:gz') as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo('project-master/' + name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+class StandInGitlab(BaseHTTPRequestHandler):
+    """Answers the calls a fetch makes with the server's head commit and
+    archive, and keeps the path of every call it was sent"""
+
+    def log_message(self, *args):
+        pass
+
+    def send(self, status, body):
+        self.send_response(status)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.server.calls.append(self.path)
+        if self.path.split('?')[0].endswith('/repository/commits'):
+            self.send(200, json.dumps([{'id': self.server.head}]).encode('ascii'))
+        elif self.path.split('?')[0].endswith('/repository/archive.tar.gz'):
+            self.send(200, self.server.archive)
+        else:
+            self.send(404, b'{}')
+
+    def do_POST(self):
+        self.server.calls.append(self.path)
+        self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        self.send(201, b'{}')
+
+
+class FetchSubmissionTest(TestCase):
+    """fetch_submission downloads a student's project only when its head
+    commit isn't the one their latest version was fetched from"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root)
+        self.settings.enable()
+        self.server = HTTPServer(('127.0.0.1', 0), StandInGitlab)
+        self.server.calls = []
+        self.server.head = 'a' * 40
+        self.server.archive = archive({'sol.py': b'print(1)\n', 'notes.txt': b'ignored\n'})
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+        self.client = gitlab.GitlabClient('http://127.0.0.1:%d' % self.server.server_port, 2, 5)
+        self.student = User.objects.create(username='student')
+        UserSocialAuth.objects.create(user=self.student, provider='gitlab', uid='1',
+                                      extra_data={'access_token': 'token'})
+        course = m.Course.objects.create(name='Course', code='C1')
+        self.coursework = m.Coursework.objects.create(id='cw1', name='cw', course=course,
+                                                      state=m.CourseworkState.UPLOAD,
+                                                      sol_path_re=r'.*\.py$')
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def fetch(self):
+        return sf.fetch_submission(self.student, self.coursework, m.SubmissionType.SOLUTION, self.client)
+
+    def archive_calls(self):
+        return [call for call in self.server.calls if '/repository/archive.tar.gz' in call]
+
+    def solution(self):
+        return m.Submission.objects.get(coursework=self.coursework, creator=self.student,
+                                        type=m.SubmissionType.SOLUTION)
+
+    def test_up_to_date_commit_is_not_downloaded(self):
+        self.assertTrue(self.fetch())
+        self.assertEqual(len(self.archive_calls()), 1)
+        self.assertEqual(self.solution().get_files(), ['sol.py'])
+        self.assertFalse(self.fetch())
+        self.assertEqual(len(self.archive_calls()), 1)
+
+    def test_new_commit_makes_a_new_version(self):
+        self.assertTrue(self.fetch())
+        first_version = self.solution().latest_version
+        self.server.head = 'b' * 40
+        self.server.archive = archive({'sol.py': b'print(2)\n'})
+        self.assertTrue(self.fetch())
+        self.assertEqual(len(self.archive_calls()), 2)
+        self.assertIn('sha=' + 'b' * 40, self.archive_calls()[1])
+        solution = self.solution()
+        self.assertEqual(solution.latest_version, first_version + 1)
+        self.assertEqual(solution.manifest().commit_sha, 'b' * 40)
@@ -0,0 +1,66 @@
+import os
+import shutil
+import stat
+import tempfile
+
+from django.test import SimpleTestCase, override_settings
+
+import runner.runner as r
+import runner.staging as staging
+
+
+def write(path, text):
+    with open(path, 'w') as f:
+        f.write(text)
+
+
+def read(path):
+    with open(path) as f:
+        return f.read()
+
+
+class StageOverlappingFilesTest(SimpleTestCase):
+    """A workspace already has an __init__.py, and test files replace
+    solution files of the same name, so staging must replace files"""
+
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.sols_dir = os.path.join(self.root, 'solution')
+        self.test_dir = os.path.join(self.root, 'test')
+        os.mkdir(self.sols_dir)
+        os.mkdir(self.test_dir)
+        write(os.path.join(self.sols_dir, '__init__.py'), 'solution init')
+        write(os.path.join(self.sols_dir, 'shared.py'), 'solution')
+        write(os.path.join(self.test_dir, 'shared.py'), 'test')
+        # originals are read only, as blobs are
+        for directory in (self.sols_dir, self.test_dir):
+            for name in os.listdir(directory):
+                os.chmod(os.path.join(directory, name), stat.S_IRUSR)
+        staging._unsupported.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def stage(self):
+        workspace = tempfile.mkdtemp(dir=self.root)
+        write(os.path.join(workspace, '__init__.py'), '')
+        r.copy_all(self.sols_dir, workspace)
+        r.copy_all(self.test_dir, workspace)
+        return workspace
+
+    def check(self, workspace):
+        self.assertEqual(read(os.path.join(workspace, '__init__.py')), 'solution init')
+        self.assertEqual(read(os.path.join(workspace, 'shared.py')), 'test')
+        self.assertEqual(read(os.path.join(self.sols_dir, 'shared.py')), 'solution')
+
+    @override_settings(RUNNER_STAGING_METHODS=('link', 'copy'))
+    def test_link(self):
+        self.check(self.stage())
+
+    @override_settings(RUNNER_STAGING_METHODS=('reflink', 'copy'))
+    def test_reflink(self):
+        self.check(self.stage())
+
+    @override_settings(RUNNER_STAGING_METHODS=('copy',))
+    def test_copy(self):
+        self.check(self.stage())
@@ -0,0 +1,49 @@
+import shutil
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import TestCase, override_settings
+
+import common.models as m
+
+
+def submission(coursework, user, file_type, file_name):
+    sub = m.Submission(coursework=coursework, creator=user, type=file_type, display_name=file_name)
+    m.save_with_new_slug(sub)
+    sub.save_content_file("pass\n", file_name)
+    return sub
+
+
+class StoreResultsTest(TestCase):
+    """The results of a test match are stored once, even when nothing
+    but its test cases was kept"""
+
+    def setUp(self):
+        self.media_root = tempfile.mkdtemp()
+        self.settings = override_settings(MEDIA_ROOT=self.media_root, RUNNER_KEEP_LOGS=False)
+        self.settings.enable()
+        user = User.objects.create(username='student')
+        course = m.Course.objects.create(name='Course', code='C1')
+        coursework = m.Coursework.objects.create(id='cw1', name='cw', course=course,
+                                                 state=m.CourseworkState.FEEDBACK)
+        solution = submission(coursework, user, m.SubmissionType.SOLUTION, 'sol.py')
+        test = submission(coursework, user, m.SubmissionType.TEST_CASE, 'MyTest.py')
+        self.test_match = m.TestMatch.objects.create(test=test, test_version=test.latest_version,
+                                                     solution=solution,
+                                                     solution_version=solution.latest_version,
+                                                     coursework=coursework, type=m.TestType.SELF)
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.media_root)
+
+    def test_stored_once(self):
+        cases = [('test_add', m.TestStatus.PASS, None, '')]
+        stale = m.TestMatch.objects.get(id=self.test_match.id)
+        self.test_match.store_results("output", cases)
+        self.assertTrue(m.TestMatch.objects.get(id=self.test_match.id).has_results())
+        with self.assertRaises(Exception):
+            self.test_match.store_results("output", cases)
+        with self.assertRaises(Exception):
+            stale.store_results("output", cases)
+        self.assertEqual(self.test_match.cases.count(), 1)
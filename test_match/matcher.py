@@ -1,3 +1,5 @@
+from collections import defaultdict
+
 from django.db import transaction
 
 import common.models as m
@@ -21,18 +23,64 @@ def create_peer_test(solution, test, cw, feedback_group, initiator):
             raise Exception("You need to do peer testing with your own test")
     if solution.type == m.SubmissionType.ORACLE_EXECUTABLE and test_case.type == m.SubmissionType.SIGNATURE_TEST:
         raise Exception("Either test, solution or both need to be a student upload")
-    new_tm = m.TestMatch(id=m.new_random_slug(m.TestMatch),
-                         test=test_case,
+    new_tm = m.TestMatch(test=test_case,
                          test_version=test_case.latest_version,
                          solution=solution,
                          solution_version=solution.latest_version,
                          coursework=cw,
                          type=m.TestType.PEER)
-    new_tm.save()
+    m.save_with_new_slug(new_tm)
     fm.TestAccessControl(test=new_tm, group=group, initiator=initiator).save()
     return new_tm
 
 
+@transaction.atomic()
+def create_peer_matrix(cw, feedback_group=None):
+    """Create a peer test match for every pairing of one member's test case
+    with another member's solution, within the feedback group with ID
+    @feedback_group, or within every feedback group of @cw. Uses the
+    latest version of each, and skips pairs that already have a peer test
+    match. The matches and their access control are created in bulk.
+    @return the list of new test matches, which haven't been scheduled"""
+    memberships = fm.FeedbackMembership.objects.filter(group__coursework=cw)
+    if feedback_group is not None:
+        memberships = memberships.filter(group_id=feedback_group)
+    members = defaultdict(list)
+    for group_id, user_id in memberships.values_list('group_id', 'user_id'):
+        members[group_id].append(user_id)
+    tests = defaultdict(list)
+    solutions = defaultdict(list)
+    for sub in m.Submission.objects.filter(coursework=cw, type__in=[m.SubmissionType.TEST_CASE,
+                                                                    m.SubmissionType.SOLUTION]):
+        (tests if sub.type == m.SubmissionType.TEST_CASE else solutions)[sub.creator_id].append(sub)
+    existing = set(m.TestMatch.objects.filter(coursework=cw, type=m.TestType.PEER).values_list(
+        'test_id', 'test_version', 'solution_id', 'solution_version'))
+    pairs = []
+    for group_id, user_ids in members.items():
+        for tester in user_ids:
+            for developer in user_ids:
+                if tester == developer:
+                    continue
+                for test_case in tests[tester]:
+                    for solution in solutions[developer]:
+                        key = (test_case.id, test_case.latest_version, solution.id, solution.latest_version)
+                        if key not in existing:
+                            existing.add(key)
+                            pairs.append((group_id, test_case, solution))
+    new_tms = m.bulk_create_with_new_slugs(m.TestMatch, [
+        m.TestMatch(test=test_case,
+                    test_version=test_case.latest_version,
+                    solution=solution,
+                    solution_version=solution.latest_version,
+                    coursework=cw,
+                    type=m.TestType.PEER)
+        for group_id, test_case, solution in pairs])
+    fm.TestAccessControl.objects.bulk_create([
+        fm.TestAccessControl(test=tm, group_id=group_id, initiator_id=test_case.creator_id)
+        for tm, (group_id, test_case, solution) in zip(new_tms, pairs)])
+    return new_tms
+
+
 @transaction.atomic()
 def create_teacher_test(solution, test, cw):
     """Create a new test match with data specified by the IDs of @solution,
@@ -41,14 +89,13 @@ def create_teacher_test(solution, test, cw):
      type__in=[m.SubmissionType.ORACLE_EXECUTABLE, m.SubmissionType.SOLUTION])
     test_case = m.Submission.objects.get(id=test, coursework=cw,
      type__in=[m.SubmissionType.TEST_CASE, m.SubmissionType.SIGNATURE_TEST])
-    new_tm = m.TestMatch(id=m.new_random_slug(m.TestMatch),
-                         test=test_case,
+    new_tm = m.TestMatch(test=test_case,
                          test_version=test_case.latest_version,
                          solution=solution,
                          solution_version=solution.latest_version,
                          coursework=cw,
                          type=m.TestType.TEACHER)
-    new_tm.save()
+    m.save_with_new_slug(new_tm)
     return new_tm
 
 
@@ -68,14 +115,13 @@ def create_self_test(solution, test, cw, initiator):
     if test_case.type != m.SubmissionType.SIGNATURE_TEST:
         if test_case.creator != initiator:
             raise Exception("You need to do self testing with your own test")
-    new_tm = m.TestMatch(id=m.new_random_slug(m.TestMatch),
-                         test=test_case,
+    new_tm = m.TestMatch(test=test_case,
                          test_version=test_case.latest_version,
                          solution=solution,
                          solution_version=solution.latest_version,
                          coursework=cw,
                          type=m.TestType.SELF)
-    new_tm.save()
+    m.save_with_new_slug(new_tm)
     return new_tm
 
 
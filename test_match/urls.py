@@ -4,5 +4,6 @@ from django.conf.urls import url
 from . import views
 
 urlpatterns = [
+    url('(?P<test_match_id>[0-9a-zA-Z\-_]*)/results', views.test_match_results, name='tm_results'),
     url('(?P<test_match_id>[0-9a-zA-Z\-_]*)(?P<commented>[@]*)', views.test_match_view, name='tm'),
 ]
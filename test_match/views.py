@@ -20,7 +20,7 @@ def test_match_view(request, test_match_id, commented=None):
     @test_match_id, and see all files associated with it"""
     test_match = m.TestMatch.objects.filter(id=test_match_id).first()
     if test_match is None:
-        return Http404("No test match with that ID exists")
+        raise Http404("No test match with that ID exists")
     perm = p.user_feedback_mode(request.user, test_match)
     if perm == p.TestMatchMode.DENY:
         return HttpResponseForbidden("You are not allowed to see this test data")
@@ -54,6 +54,7 @@ def test_match_view(request, test_match_id, commented=None):
         "can_submit": perm == p.TestMatchMode.WRITE,
         "test_files": test_match.test.get_files(test_match.test_version) if test_match.test else [],
         "result_files": test_match.result.get_files() if test_match.result else [],
+        "has_results": test_match.log is not None or test_match.tests_run is not None,
         "solution_files": test_match.solution.get_files(test_match.solution_version) if test_match.solution else [],
         "user_owns_test": test_match.test.creator == request.user,
         "user_owns_sol": test_match.solution.creator == request.user,
@@ -61,3 +62,21 @@ def test_match_view(request, test_match_id, commented=None):
         "comment_list": comment_list
     }
     return render(request, 'test_match/feedback.html', details)
+
+
+@login_required()
+def test_match_results(request, test_match_id):
+    """Show the test cases and the output of running
+    @test_match_id, for the results tab of its feedback page"""
+    test_match = m.TestMatch.objects.filter(id=test_match_id).first()
+    if test_match is None:
+        raise Http404("No test match with that ID exists")
+    perm = p.user_feedback_mode(request.user, test_match)
+    if perm == p.TestMatchMode.DENY or perm == p.TestMatchMode.WAIT:
+        return HttpResponseForbidden("You are not allowed to see this test data")
+    details = {
+        "test_match": test_match,
+        "cases": test_match.cases.all(),
+        "log": test_match.log_text()
+    }
+    return render(request, 'test_match/results.html', details)